@@ -0,0 +1,17 @@
+-- Adds product_latest_price, the latest price of each product kept up to date by load.py,
+-- and fills it from the existing price_changes history.
+
+CREATE TABLE IF NOT EXISTS product_latest_price (
+    product_id INT NOT NULL,
+    price FLOAT NOT NULL,
+    timestamp TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (product_id),
+    FOREIGN KEY (product_id) REFERENCES product(product_id)
+);
+
+INSERT INTO product_latest_price (product_id, price, timestamp)
+SELECT DISTINCT ON (product_id) product_id, price, timestamp
+FROM price_changes
+ORDER BY product_id, timestamp DESC
+ON CONFLICT (product_id) DO UPDATE
+SET price = EXCLUDED.price, timestamp = EXCLUDED.timestamp;
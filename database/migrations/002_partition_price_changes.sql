@@ -0,0 +1,81 @@
+-- Turns price_changes into a table partitioned by month, with an index on
+-- (product_id, timestamp DESC) that covers the price, plus the hourly and daily
+-- rollup tables that price_retention.py fills before dropping old partitions.
+-- Existing rows are copied into the new partitions with their price_id kept.
+
+CREATE OR REPLACE FUNCTION create_price_changes_partition(month DATE) RETURNS VOID AS $$
+DECLARE
+    start_time TIMESTAMPTZ := date_trunc('month', month)::TIMESTAMP AT TIME ZONE 'UTC';
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF price_changes FOR VALUES FROM (%L) TO (%L)',
+        'price_changes_' || to_char(month, 'YYYY_MM'),
+        start_time, start_time + INTERVAL '1 month');
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    first_month DATE;
+    month DATE;
+    next_id BIGINT;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table
+               WHERE partrelid = 'price_changes'::regclass) THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE price_changes RENAME TO price_changes_unpartitioned;
+
+    CREATE TABLE price_changes (
+        price_id INT GENERATED ALWAYS AS IDENTITY,
+        price FLOAT NOT NULL,
+        product_id INT NOT NULL,
+        timestamp TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (price_id, timestamp),
+        FOREIGN KEY (product_id) REFERENCES product(product_id)
+    ) PARTITION BY RANGE (timestamp);
+
+    CREATE INDEX price_changes_product_timestamp_idx
+        ON price_changes (product_id, timestamp DESC) INCLUDE (price);
+
+    SELECT COALESCE(MIN(timestamp AT TIME ZONE 'UTC'), NOW() AT TIME ZONE 'UTC')::DATE
+    INTO first_month FROM price_changes_unpartitioned;
+
+    month := date_trunc('month', first_month);
+    WHILE month <= (NOW() + INTERVAL '3 months')::DATE LOOP
+        PERFORM create_price_changes_partition(month);
+        month := month + INTERVAL '1 month';
+    END LOOP;
+
+    INSERT INTO price_changes (price_id, price, product_id, timestamp)
+    OVERRIDING SYSTEM VALUE
+    SELECT price_id, price, product_id, timestamp
+    FROM price_changes_unpartitioned;
+
+    SELECT COALESCE(MAX(price_id), 0) + 1 INTO next_id FROM price_changes;
+    EXECUTE format('ALTER TABLE price_changes ALTER COLUMN price_id RESTART WITH %s', next_id);
+
+    DROP TABLE price_changes_unpartitioned;
+END;
+$$;
+
+CREATE TABLE IF NOT EXISTS price_changes_hourly (
+    product_id INT NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    min_price FLOAT NOT NULL,
+    max_price FLOAT NOT NULL,
+    last_price FLOAT NOT NULL,
+    PRIMARY KEY (product_id, bucket),
+    FOREIGN KEY (product_id) REFERENCES product(product_id)
+);
+
+CREATE TABLE IF NOT EXISTS price_changes_daily (
+    product_id INT NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    min_price FLOAT NOT NULL,
+    max_price FLOAT NOT NULL,
+    last_price FLOAT NOT NULL,
+    PRIMARY KEY (product_id, bucket),
+    FOREIGN KEY (product_id) REFERENCES product(product_id)
+);
@@ -0,0 +1,8 @@
+-- Indexes the columns the ETL, notifier and dashboard look rows up by.
+-- price_changes(product_id) is already covered by price_changes_product_timestamp_idx.
+
+CREATE INDEX IF NOT EXISTS product_website_id_idx ON product (website_id);
+CREATE INDEX IF NOT EXISTS subscription_user_id_idx ON subscription (user_id);
+CREATE INDEX IF NOT EXISTS subscription_product_id_idx ON subscription (product_id);
+CREATE INDEX IF NOT EXISTS notifications_sent_user_product_price_idx
+    ON notifications_sent (user_id, product_id, price);
@@ -0,0 +1,17 @@
+-- Adds product_lease, from which ETL workers in the lease sharding mode claim
+-- products with FOR UPDATE SKIP LOCKED, and gives every product a lease row.
+
+CREATE TABLE IF NOT EXISTS product_lease (
+    product_id INT NOT NULL,
+    due_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    leased_until TIMESTAMPTZ,
+    leased_by VARCHAR(100),
+    PRIMARY KEY (product_id),
+    FOREIGN KEY (product_id) REFERENCES product(product_id)
+);
+
+CREATE INDEX IF NOT EXISTS product_lease_due_at_idx ON product_lease (due_at);
+
+INSERT INTO product_lease (product_id)
+SELECT product_id FROM product
+ON CONFLICT (product_id) DO NOTHING;
@@ -0,0 +1,23 @@
+-- Makes (user_id, product_id) unique in subscription, so the dashboard can upsert
+-- subscriptions with ON CONFLICT. Duplicate subscriptions keep their newest
+-- notification price on the oldest row. The unique index also serves lookups by
+-- user_id, so subscription_user_id_idx is dropped.
+
+UPDATE subscription AS s
+SET notification_price = newest.notification_price
+FROM (
+    SELECT DISTINCT ON (user_id, product_id) user_id, product_id, notification_price
+    FROM subscription
+    ORDER BY user_id, product_id, subscription_id DESC
+) AS newest
+WHERE s.user_id = newest.user_id AND s.product_id = newest.product_id;
+
+DELETE FROM subscription AS s
+USING subscription AS kept
+WHERE kept.user_id = s.user_id AND kept.product_id = s.product_id
+AND kept.subscription_id < s.subscription_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS subscription_user_product_idx
+    ON subscription (user_id, product_id);
+
+DROP INDEX IF EXISTS subscription_user_id_idx;
@@ -0,0 +1,22 @@
+-- Adds onboarding_job, the queue of products users have asked to track. The
+-- dashboard inserts a job and the onboarding worker scrapes and inserts the product.
+
+CREATE TABLE IF NOT EXISTS onboarding_job (
+    job_id INT GENERATED ALWAYS AS IDENTITY,
+    user_id INT NOT NULL,
+    url VARCHAR(2048) NOT NULL,
+    notification_price FLOAT NOT NULL,
+    status VARCHAR(10) NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    error VARCHAR(500),
+    product_id INT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (job_id),
+    CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (product_id) REFERENCES product(product_id)
+);
+
+CREATE INDEX IF NOT EXISTS onboarding_job_pending_idx ON onboarding_job (job_id)
+    WHERE status IN ('queued', 'running');
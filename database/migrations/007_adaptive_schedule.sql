@@ -0,0 +1,5 @@
+-- Stores each product's adaptive scrape interval, which the ETL grows while the
+-- price holds still and shrinks when it moves or nears a notification price.
+-- NULL until the product's first scrape under the adaptive schedule.
+
+ALTER TABLE product_lease ADD COLUMN IF NOT EXISTS interval_seconds FLOAT;
@@ -0,0 +1,34 @@
+-- Adds a default partition to price_changes, so inserts for a month whose
+-- partition has not been created yet land there instead of failing.
+-- create_price_changes_partition moves such rows into the month's partition
+-- when it is created.
+
+CREATE TABLE IF NOT EXISTS price_changes_default PARTITION OF price_changes DEFAULT;
+
+CREATE OR REPLACE FUNCTION create_price_changes_partition(month DATE) RETURNS VOID AS $$
+DECLARE
+    start_time TIMESTAMPTZ := date_trunc('month', month)::TIMESTAMP AT TIME ZONE 'UTC';
+    partition_name TEXT := 'price_changes_' || to_char(month, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+
+    -- Rows that landed in the default partition while the month had none are
+    -- moved out first, as the new partition cannot be attached over them.
+    CREATE TEMPORARY TABLE price_changes_moved AS
+    SELECT price_id, price, product_id, timestamp FROM price_changes_default
+    WHERE timestamp >= start_time AND timestamp < start_time + INTERVAL '1 month';
+    DELETE FROM price_changes_default
+    WHERE timestamp >= start_time AND timestamp < start_time + INTERVAL '1 month';
+
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF price_changes FOR VALUES FROM (%L) TO (%L)',
+        partition_name, start_time, start_time + INTERVAL '1 month');
+
+    INSERT INTO price_changes (price_id, price, product_id, timestamp)
+    OVERRIDING SYSTEM VALUE
+    SELECT price_id, price, product_id, timestamp FROM price_changes_moved;
+    DROP TABLE price_changes_moved;
+END;
+$$ LANGUAGE plpgsql;
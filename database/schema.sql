@@ -1,6 +1,11 @@
+DROP TABLE IF EXISTS onboarding_job CASCADE;
 DROP TABLE IF EXISTS notifications_sent CASCADE;
 DROP TABLE IF EXISTS subscription CASCADE;
+DROP TABLE IF EXISTS product_latest_price CASCADE;
+DROP TABLE IF EXISTS product_lease CASCADE;
 DROP TABLE IF EXISTS price_changes CASCADE;
+DROP TABLE IF EXISTS price_changes_hourly CASCADE;
+DROP TABLE IF EXISTS price_changes_daily CASCADE;
 DROP TABLE IF EXISTS product CASCADE;
 DROP TABLE IF EXISTS website CASCADE;
 DROP TABLE IF EXISTS users CASCADE;
@@ -37,10 +42,88 @@ CREATE TABLE price_changes (
     price FLOAT NOT NULL,
     product_id INT NOT NULL,
     timestamp TIMESTAMPTZ NOT NULL,
-    PRIMARY KEY (price_id),
+    PRIMARY KEY (price_id, timestamp),
+    FOREIGN KEY (product_id) REFERENCES product(product_id)
+) PARTITION BY RANGE (timestamp);
+
+CREATE INDEX price_changes_product_timestamp_idx
+    ON price_changes (product_id, timestamp DESC) INCLUDE (price);
+
+-- Catches rows for a month that has no partition yet, so an insert never fails
+-- if price_retention.py has not run in time to create it.
+CREATE TABLE price_changes_default PARTITION OF price_changes DEFAULT;
+
+CREATE OR REPLACE FUNCTION create_price_changes_partition(month DATE) RETURNS VOID AS $$
+DECLARE
+    start_time TIMESTAMPTZ := date_trunc('month', month)::TIMESTAMP AT TIME ZONE 'UTC';
+    partition_name TEXT := 'price_changes_' || to_char(month, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+
+    -- Rows that landed in the default partition while the month had none are
+    -- moved out first, as the new partition cannot be attached over them.
+    CREATE TEMPORARY TABLE price_changes_moved AS
+    SELECT price_id, price, product_id, timestamp FROM price_changes_default
+    WHERE timestamp >= start_time AND timestamp < start_time + INTERVAL '1 month';
+    DELETE FROM price_changes_default
+    WHERE timestamp >= start_time AND timestamp < start_time + INTERVAL '1 month';
+
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF price_changes FOR VALUES FROM (%L) TO (%L)',
+        partition_name, start_time, start_time + INTERVAL '1 month');
+
+    INSERT INTO price_changes (price_id, price, product_id, timestamp)
+    OVERRIDING SYSTEM VALUE
+    SELECT price_id, price, product_id, timestamp FROM price_changes_moved;
+    DROP TABLE price_changes_moved;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_price_changes_partition((NOW() + make_interval(months => months_ahead))::DATE)
+FROM generate_series(0, 3) AS months_ahead;
+
+CREATE TABLE price_changes_hourly (
+    product_id INT NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    min_price FLOAT NOT NULL,
+    max_price FLOAT NOT NULL,
+    last_price FLOAT NOT NULL,
+    PRIMARY KEY (product_id, bucket),
+    FOREIGN KEY (product_id) REFERENCES product(product_id)
+);
+
+CREATE TABLE price_changes_daily (
+    product_id INT NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    min_price FLOAT NOT NULL,
+    max_price FLOAT NOT NULL,
+    last_price FLOAT NOT NULL,
+    PRIMARY KEY (product_id, bucket),
+    FOREIGN KEY (product_id) REFERENCES product(product_id)
+);
+
+CREATE TABLE product_latest_price (
+    product_id INT NOT NULL,
+    price FLOAT NOT NULL,
+    timestamp TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (product_id),
     FOREIGN KEY (product_id) REFERENCES product(product_id)
 );
 
+CREATE TABLE product_lease (
+    product_id INT NOT NULL,
+    due_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    leased_until TIMESTAMPTZ,
+    leased_by VARCHAR(100),
+    interval_seconds FLOAT,
+    PRIMARY KEY (product_id),
+    FOREIGN KEY (product_id) REFERENCES product(product_id)
+);
+
+CREATE INDEX product_lease_due_at_idx ON product_lease (due_at);
+
 CREATE TABLE subscription (
     subscription_id INT GENERATED ALWAYS AS IDENTITY,
     user_id INT NOT NULL,
@@ -60,4 +143,30 @@ CREATE TABLE notifications_sent (
     PRIMARY KEY (notification_id),
     FOREIGN KEY (user_id) REFERENCES users(user_id),
     FOREIGN KEY (product_id) REFERENCES product(product_id)
-);
\ No newline at end of file
+);
+
+CREATE TABLE onboarding_job (
+    job_id INT GENERATED ALWAYS AS IDENTITY,
+    user_id INT NOT NULL,
+    url VARCHAR(2048) NOT NULL,
+    notification_price FLOAT NOT NULL,
+    status VARCHAR(10) NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    error VARCHAR(500),
+    product_id INT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (job_id),
+    CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (product_id) REFERENCES product(product_id)
+);
+
+CREATE INDEX onboarding_job_pending_idx ON onboarding_job (job_id)
+    WHERE status IN ('queued', 'running');
+
+CREATE INDEX product_website_id_idx ON product (website_id);
+CREATE UNIQUE INDEX subscription_user_product_idx ON subscription (user_id, product_id);
+CREATE INDEX subscription_product_id_idx ON subscription (product_id);
+CREATE INDEX notifications_sent_user_product_price_idx
+    ON notifications_sent (user_id, product_id, price);
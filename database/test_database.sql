@@ -42,6 +42,8 @@ Base Notes: Cypress wood, Guaiac wood, Amberwood, Musk', 'https://mediahub.deben
     ('Session Styling Hair Wax 50g', 'https://www.debenhams.com/product/percy-reed-session-styling-hair-wax-50g_p-5642bd83-da93-459c-8efa-beda5544f2c6?colour=Clear', 2, 16.70, '
 Elevate daily styles with Session Styling Hair Wax from Percy & Reed! This expert hair wax helps you style your hair with ease and retain shape for long-lasting hold. Key Features: Salon Professional Formula Blends Natural Clay and Styling Agents Long-Lasting, Flexible Finish No Stiffness or Over-Shine. Subtle Matte Finish Multi-Tasking Wax Protects for Stronger, Healthier Hair. Soft and Manageable Style', 'https://mediahub.debenhams.com/m5060265375225_clear_xl.jpeg?qlt=80&w=549&ssz=true&dpr=2');
 
+SELECT create_price_changes_partition('2024-12-01');
+
 INSERT INTO price_changes (price, product_id, timestamp)
 VALUES 
     -- Stardew Valley
@@ -151,4 +153,9 @@ VALUES
     (3, 4, 17.0), -- Euro Truck Simulator 2
     (3, 7, 60.0), -- Red Dead Redemption 2
     (3, 10, 60.0), -- Boss Bottled Eau De Toilette
-    (3, 12, 17.0); -- Session Styling Hair Wax
\ No newline at end of file
+    (3, 12, 17.0); -- Session Styling Hair Wax
+
+INSERT INTO product_latest_price (product_id, price, timestamp)
+SELECT DISTINCT ON (product_id) product_id, price, timestamp
+FROM price_changes
+ORDER BY product_id, timestamp DESC;
@@ -0,0 +1,373 @@
+"""Runs every SQL statement the project issues under EXPLAIN (ANALYZE, BUFFERS)
+against a seeded copy of the schema, and fails if any plan reads more than
+SEQ_SCAN_ROW_THRESHOLD rows with a sequential scan of a table it is not meant
+to read in full.
+
+The schema is created from database/schema.sql in a scratch query_audit schema,
+seeded at the scale given on the command line and dropped afterwards, so the
+real tables are never touched. Writes are rolled back after each statement.
+Usage: python audit_query_plans.py [products] [users] [prices per product]"""
+from os import environ as ENV
+import re
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from connect_to_database import get_connection
+from load import UPSERT_LATEST_PRICES_QUERY
+from remove_subscribers import (UNSUBSCRIBED_PRODUCTS_QUERY, LOCK_PRODUCTS_QUERY,
+                                get_delete_chunk_query)
+from scheduler import SCHEDULE_STATE_QUERY, SAVE_SCHEDULE_QUERY, SAVE_SCHEDULE_TEMPLATE
+
+SCHEMA = "query_audit"
+REPO_ROOT = Path(__file__).resolve().parent.parent
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+SEED = """
+SELECT create_price_changes_partition((NOW() - make_interval(months => months_ago))::DATE)
+FROM generate_series(1, 3) AS months_ago;
+
+INSERT INTO users (first_name, last_name, email_address, password)
+SELECT 'First', 'Last', 'user' || i || '@example.com', 'password'
+FROM generate_series(1, %(users)s) AS i;
+
+INSERT INTO website (website_name)
+SELECT 'https://website' || i || '.com' FROM generate_series(1, 20) AS i;
+
+INSERT INTO product (product_name, url, website_id, original_price)
+SELECT 'Product ' || i, 'https://website' || (i %% 20 + 1) || '.com/product/' || i,
+i %% 20 + 1, 20 FROM generate_series(1, %(products)s) AS i;
+
+INSERT INTO subscription (user_id, product_id, notification_price)
+SELECT u, (u * 31 + k * 997) %% %(products)s + 1, 10 + k
+FROM generate_series(1, %(users)s) AS u, generate_series(0, 2) AS k;
+
+INSERT INTO price_changes (price, product_id, timestamp)
+SELECT 5 + (p * 7 + i) %% 20, p, NOW() - i * INTERVAL '3 hours'
+FROM generate_series(1, %(products)s) AS p, generate_series(0, %(prices)s - 1) AS i;
+
+INSERT INTO product_latest_price (product_id, price, timestamp)
+SELECT DISTINCT ON (product_id) product_id, price, timestamp
+FROM price_changes ORDER BY product_id, timestamp DESC;
+
+INSERT INTO notifications_sent (user_id, product_id, price)
+SELECT user_id, product_id, notification_price - 1 FROM subscription;
+
+INSERT INTO onboarding_job (user_id, url, notification_price, status, product_id)
+SELECT user_id, 'https://website1.com/product/new/' || subscription_id, notification_price,
+CASE WHEN subscription_id %% 100 = 0 THEN 'queued' ELSE 'done' END, product_id
+FROM subscription;
+
+INSERT INTO product_lease (product_id, due_at)
+SELECT product_id, NOW() + (product_id %% 60) * INTERVAL '1 minute' FROM product;
+
+ANALYZE;
+"""
+
+# Each statement with parameters valid in the seeded data. "source" is the file
+# the statement is copied from, checked by the tests so the copies cannot drift;
+# statements that are built at runtime are imported instead, with the VALUES
+# that execute_values would fill in. "full_scans" are the tables the statement
+# is meant to read in full.
+QUERIES = [
+    {"name": "extract: product urls", "source": "pipeline/extract.py",
+     "query": "SELECT product_id,url FROM product;",
+     "params": None, "full_scans": {"product"}},
+    {"name": "extract: shard urls", "source": "pipeline/extract.py",
+     "query": "SELECT product_id,url FROM product WHERE product_id %% %s = %s;",
+     "params": (4, 1), "full_scans": {"product"}},
+    {"name": "extract: due urls", "source": "pipeline/extract.py",
+     "query": """SELECT p.product_id, p.url FROM product AS p
+LEFT JOIN product_lease AS l ON l.product_id = p.product_id
+WHERE l.due_at IS NULL OR l.due_at <= NOW();""",
+     "params": None, "full_scans": {"product", "product_lease"}},
+    {"name": "extract: due shard urls", "source": "pipeline/extract.py",
+     "query": """SELECT p.product_id, p.url FROM product AS p
+LEFT JOIN product_lease AS l ON l.product_id = p.product_id
+WHERE (l.due_at IS NULL OR l.due_at <= NOW()) AND p.product_id %% %s = %s;""",
+     "params": (4, 1), "full_scans": {"product", "product_lease"}},
+    {"name": "scheduler: schedule state",
+     "query": SCHEDULE_STATE_QUERY % "(%s, %s), (%s, %s), (%s, %s)",
+     "params": (1, 9.99, 2, 12.5, 3, 30.0), "full_scans": set()},
+    {"name": "scheduler: save schedule",
+     "query": SAVE_SCHEDULE_QUERY % SAVE_SCHEDULE_TEMPLATE,
+     "params": (1, 225.0, 225.0), "full_scans": set()},
+    {"name": "sharding: sync leases", "source": "pipeline/sharding.py",
+     "query": """INSERT INTO product_lease (product_id)
+    SELECT product_id FROM product
+    ON CONFLICT (product_id) DO NOTHING;""",
+     "params": None, "full_scans": {"product"}},
+    {"name": "sharding: claim products", "source": "pipeline/sharding.py",
+     "query": """UPDATE product_lease AS l
+    SET leased_by = %s, leased_until = NOW() + make_interval(secs => %s)
+    FROM product AS p
+    WHERE p.product_id = l.product_id
+    AND l.product_id IN (
+        SELECT product_id FROM product_lease
+        WHERE due_at <= NOW() AND (leased_until IS NULL OR leased_until < NOW())
+        ORDER BY due_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED)
+    RETURNING l.product_id, p.url;""",
+     "params": ("audit", 120, 100), "full_scans": set()},
+    {"name": "sharding: complete products", "source": "pipeline/sharding.py",
+     "query": """UPDATE product_lease
+    SET due_at = GREATEST(due_at, NOW() + make_interval(secs => %s)),
+        leased_until = NULL, leased_by = NULL
+    WHERE product_id = ANY(%s) AND leased_by = %s;""",
+     "params": (150, [1, 2, 3], "audit"), "full_scans": set()},
+    {"name": "load: insert price", "source": "pipeline/load.py",
+     "query": """INSERT INTO price_changes (price, product_id, timestamp)
+            VALUES (%s, %s, %s);""",
+     "params": (9.99, 1, "now"), "full_scans": set()},
+    {"name": "load: latest prices", "source": "pipeline/load.py",
+     "query": """SELECT product_id, price
+            FROM product_latest_price
+            WHERE product_id = ANY(%s);""",
+     "params": ([1, 2, 3],), "full_scans": set()},
+    {"name": "load: upsert latest price",
+     "query": UPSERT_LATEST_PRICES_QUERY % "(%s, %s, %s)",
+     "params": (1, 9.99, "now"), "full_scans": set()},
+    {"name": "email: pending notifications", "source": "pipeline/email_notifier.py",
+     "query": """SELECT s.user_id, s.product_id, s.notification_price, p.original_price,
+                   p.product_name, u.email_address, u.first_name, u.last_name,
+                   lp.price
+            FROM subscription s
+            JOIN product_latest_price lp ON lp.product_id = s.product_id
+            JOIN product p ON p.product_id = s.product_id
+            JOIN users u ON u.user_id = s.user_id
+            WHERE lp.price < s.notification_price
+            AND NOT EXISTS (
+                SELECT 1 FROM notifications_sent n
+                WHERE n.user_id = s.user_id
+                AND n.product_id = s.product_id
+                AND n.price = lp.price)""",
+     "params": None, "full_scans": {"subscription", "product_latest_price"}},
+    {"name": "remove subscribers: unsubscribed products",
+     "query": UNSUBSCRIBED_PRODUCTS_QUERY,
+     "params": (100,), "full_scans": {"product"}},
+    {"name": "remove subscribers: delete price chunk",
+     "query": get_delete_chunk_query("price_changes"),
+     "params": ([1, 2, 3], 5000), "full_scans": set()},
+    {"name": "remove subscribers: lock products",
+     "query": LOCK_PRODUCTS_QUERY,
+     "params": ([1, 2, 3],), "full_scans": set()},
+    {"name": "remove subscribers: clean websites", "source": "pipeline/remove_subscribers.py",
+     "query": """DELETE FROM website AS w
+    WHERE NOT EXISTS (
+        SELECT 1 FROM product AS p
+        WHERE p.website_id = w.website_id);""",
+     "params": None, "full_scans": {"website"}},
+    {"name": "dashboard: website id", "source": "streamlit_dashboard/database_connection.py",
+     "query": "SELECT website_id FROM website WHERE website_name = %s",
+     "params": ("https://website1.com",), "full_scans": set()},
+    {"name": "dashboard: onboard website", "source": "streamlit_dashboard/database_connection.py",
+     "query": """INSERT INTO website (website_name) VALUES (%s)
+        ON CONFLICT (website_name) DO UPDATE SET website_name = EXCLUDED.website_name
+        RETURNING website_id;""",
+     "params": ("https://website1.com",), "full_scans": set()},
+    {"name": "dashboard: onboard product", "source": "streamlit_dashboard/database_connection.py",
+     "query": """INSERT INTO product (product_name, url, website_id, original_price,
+            image_url, product_description)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (url) DO UPDATE SET url = EXCLUDED.url
+        RETURNING product_id;""",
+     "params": ("Product 1", "https://website2.com/product/1", 2, 20, None, None),
+     "full_scans": set()},
+    {"name": "dashboard: onboard subscription",
+     "source": "streamlit_dashboard/database_connection.py",
+     "query": """INSERT INTO subscription (user_id, product_id, notification_price)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (user_id, product_id) DO UPDATE
+        SET notification_price = EXCLUDED.notification_price;""",
+     "params": (1, 32, 15), "full_scans": set()},
+    {"name": "dashboard: enqueue onboarding job",
+     "source": "streamlit_dashboard/database_connection.py",
+     "query": """INSERT INTO onboarding_job (user_id, url, notification_price) VALUES (%s, %s, %s)
+                RETURNING job_id;""",
+     "params": (1, "https://website1.com/product/1", 15), "full_scans": set()},
+    {"name": "dashboard: onboarding jobs", "source": "streamlit_dashboard/database_connection.py",
+     "query": """SELECT job_id, url, status, error, product_id
+                FROM onboarding_job WHERE job_id = ANY(%s) ORDER BY job_id""",
+     "params": ([1, 2, 3],), "full_scans": set()},
+    {"name": "onboarding worker: claim jobs", "source": "streamlit_dashboard/onboarding_worker.py",
+     "query": """UPDATE onboarding_job
+    SET status = 'running', attempts = attempts + 1, updated_at = NOW()
+    WHERE job_id IN (
+        SELECT job_id FROM onboarding_job
+        WHERE status = 'queued'
+        OR (status = 'running' AND updated_at < NOW() - make_interval(secs => %s))
+        ORDER BY job_id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED)
+    RETURNING job_id, user_id, url, notification_price, attempts;""",
+     "params": (120, 20), "full_scans": set()},
+    {"name": "onboarding worker: finish job", "source": "streamlit_dashboard/onboarding_worker.py",
+     "query": """UPDATE onboarding_job
+    SET status = %s, error = %s, product_id = %s, updated_at = NOW()
+    WHERE job_id = %s;""",
+     "params": ("done", None, 1, 1), "full_scans": set()},
+    {"name": "onboarding worker: delete old jobs",
+     "source": "streamlit_dashboard/onboarding_worker.py",
+     "query": """DELETE FROM onboarding_job
+    WHERE status IN ('done', 'failed')
+    AND updated_at < NOW() - make_interval(hours => %s);""",
+     "params": (24,), "full_scans": {"onboarding_job"}},
+    {"name": "dashboard: user id", "source": "streamlit_dashboard/database_connection.py",
+     "query": "SELECT user_id FROM users WHERE email_address = %s",
+     "params": ("user1@example.com",), "full_scans": set()},
+    {"name": "dashboard: product id", "source": "streamlit_dashboard/database_connection.py",
+     "query": "SELECT product_id FROM product WHERE url = %s",
+     "params": ("https://website2.com/product/1",), "full_scans": set()},
+    {"name": "dashboard: subscription id", "source": "streamlit_dashboard/database_connection.py",
+     "query": "SELECT subscription_id FROM subscription WHERE user_id = %s and product_id = %s",
+     "params": (1, 32), "full_scans": set()},
+    {"name": "dashboard: subscribed products",
+     "source": "streamlit_dashboard/database_connection.py",
+     "query": "SELECT product_id FROM subscription WHERE user_id = %s",
+     "params": (1,), "full_scans": set()},
+    {"name": "dashboard: product cards", "source": "streamlit_dashboard/database_connection.py",
+     "query": """SELECT p.product_id, p.product_name, p.image_url, lp.price
+            FROM subscription AS s
+            JOIN product AS p ON p.product_id = s.product_id
+            LEFT JOIN product_latest_price AS lp ON lp.product_id = p.product_id
+            WHERE s.user_id = %s
+            ORDER BY s.subscription_id""",
+     "params": (1,), "full_scans": set()},
+    {"name": "dashboard: product info", "source": "streamlit_dashboard/database_connection.py",
+     "query": """SELECT product_name, url,
+            original_price, product_description,
+            image_url FROM product WHERE product_id = %s""",
+     "params": (1,), "full_scans": set()},
+    {"name": "dashboard: latest price", "source": "streamlit_dashboard/database_connection.py",
+     "query": "SELECT price FROM product_latest_price WHERE product_id = %s",
+     "params": (1,), "full_scans": set()},
+    {"name": "dashboard: unsubscribe", "source": "streamlit_dashboard/database_connection.py",
+     "query": "DELETE FROM subscription WHERE user_id = %s AND product_id = %s",
+     "params": (1, 32), "full_scans": set()},
+    {"name": "dashboard: login", "source": "streamlit_dashboard/dashboard.py",
+     "query": """SELECT EXISTS (
+            SELECT 1
+            FROM users
+            WHERE email_address = %s AND password = %s
+        );""",
+     "params": ("user1@example.com", "password"), "full_scans": set()},
+    {"name": "dashboard: user name", "source": "streamlit_dashboard/dashboard.py",
+     "query": """SELECT first_name
+            FROM users
+            WHERE user_id = %s;""",
+     "params": (1,), "full_scans": set()},
+    {"name": "dashboard: price chart", "source": "streamlit_dashboard/dashboard.py",
+     "query": """(SELECT price, timestamp
+    FROM price_changes
+    WHERE product_id = %s
+    AND timestamp < NOW() - make_interval(secs => %s)
+    ORDER BY timestamp DESC
+    LIMIT 1)
+    UNION ALL
+    (SELECT last_price, bucket
+    FROM price_changes_daily
+    WHERE product_id = %s
+    AND bucket < NOW() - make_interval(secs => %s)
+    ORDER BY bucket DESC
+    LIMIT 1)
+    UNION ALL
+    (SELECT price, timestamp
+    FROM product_latest_price
+    WHERE product_id = %s
+    AND timestamp < NOW() - make_interval(secs => %s))
+    UNION ALL
+    (SELECT DISTINCT ON (floor(extract(epoch FROM timestamp) / %s)) price, timestamp
+    FROM price_changes
+    WHERE product_id = %s
+    AND timestamp >= NOW() - make_interval(secs => %s)
+    ORDER BY floor(extract(epoch FROM timestamp) / %s), timestamp DESC)""",
+     "params": (1, 259200, 1, 259200, 1, 259200, 519, 1, 259200, 519), "full_scans": set()},
+]
+
+
+def normalise(text: str) -> str:
+    """Collapses whitespace so statements can be compared across indentation."""
+    return " ".join(text.split())
+
+
+def get_table(relation: str) -> str:
+    """Maps a monthly price_changes partition back to its table."""
+    return re.sub(r"_\d{4}_\d{2}$", "", relation)
+
+
+def find_seq_scans(plan: dict) -> list[tuple[str, int]]:
+    """Returns (table, rows read) for every sequential scan in a JSON plan."""
+    scans = []
+    if plan.get("Node Type") == "Seq Scan":
+        rows = (plan.get("Actual Rows", 0) + plan.get("Rows Removed by Filter", 0)) \
+            * plan.get("Actual Loops", 1)
+        scans.append((get_table(plan["Relation Name"]), rows))
+    for child in plan.get("Plans", []):
+        scans.extend(find_seq_scans(child))
+    return scans
+
+
+def get_violations(plan: dict, full_scans: set, threshold: int) -> list[tuple[str, int]]:
+    """Returns the sequential scans that read too many rows of a table that should be indexed."""
+    return [(table, rows) for table, rows in find_seq_scans(plan)
+            if table not in full_scans and rows > threshold]
+
+
+def explain(conn, query: dict) -> dict:
+    """Runs a statement under EXPLAIN (ANALYZE, BUFFERS) and rolls it back."""
+    with conn.cursor() as cur:
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query["query"],
+                    query["params"])
+        result = cur.fetchone()[0][0]
+    conn.rollback()
+    return result
+
+
+def seed(conn, products: int, users: int, prices: int) -> None:
+    """Creates the schema in the scratch schema and fills it."""
+    schema_sql = (REPO_ROOT / "database" / "schema.sql").read_text(encoding="utf-8")
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA};")
+        cur.execute(f"SET search_path TO {SCHEMA};")
+        cur.execute(schema_sql)
+        cur.execute(SEED, {"products": products, "users": users, "prices": prices})
+    conn.commit()
+
+
+def main_audit(products: int, users: int, prices: int) -> bool:
+    """Prints each statement's plan summary. Returns whether every plan passed."""
+    if ENV["DB_HOST"] not in LOCAL_HOSTS and not ENV.get("AUDIT_ALLOW_REMOTE"):
+        raise ValueError("Refusing to seed a remote database; set AUDIT_ALLOW_REMOTE to override.")
+    threshold = int(ENV.get("SEQ_SCAN_ROW_THRESHOLD", 10000))
+
+    conn = get_connection()
+    passed = True
+    try:
+        seed(conn, products, users, prices)
+        for query in QUERIES:
+            result = explain(conn, query)
+            plan = result["Plan"]
+            violations = get_violations(plan, query["full_scans"], threshold)
+            passed = passed and not violations
+            print(f"{'FAIL' if violations else 'ok':4} {query['name']}: "
+                  f"{result['Execution Time']:.2f}ms, "
+                  f"{plan.get('Shared Hit Blocks', 0)} buffers hit, "
+                  f"{plan.get('Shared Read Blocks', 0)} read")
+            for table, rows in violations:
+                print(f"     sequential scan of {rows} rows of {table}")
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        conn.commit()
+        conn.close()
+    return passed
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    sys.exit(0 if main_audit(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000,
+                             int(sys.argv[2]) if len(sys.argv) > 2 else 50_000,
+                             int(sys.argv[3]) if len(sys.argv) > 3 else 200) else 1)
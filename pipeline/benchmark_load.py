@@ -0,0 +1,76 @@
+"""Compares row-by-row and batched loading of price_changes on a local Postgres.
+
+The rows go into temporary price_changes and product_latest_price tables, which
+shadow the real ones for this connection only, so the benchmark never writes to
+the real tables and its made-up product_ids need no products.
+Usage: python benchmark_load.py [rows]"""
+import sys
+from datetime import datetime
+from time import perf_counter
+
+from dotenv import load_dotenv
+
+from connect_to_database import get_connection
+from load import bulk_load_price_changes
+
+BATCH_SIZES = [100, 1000, 5000]
+
+
+def make_rows(row_count: int) -> list[dict]:
+    """Returns row_count cleaned rows like transform.py produces."""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [{"price": round(10 + (i % 500) / 100, 2), "product_id": i % 1000,
+             "timestamp": timestamp} for i in range(row_count)]
+
+
+def load_row_by_row(rows: list[dict], conn) -> None:
+    """Inserts and commits the rows one statement at a time, the old load path."""
+    with conn.cursor() as cur:
+        for row in rows:
+            cur.execute(
+                "INSERT INTO price_changes (price, product_id, timestamp) VALUES (%s, %s, %s);",
+                (row["price"], row["product_id"], row["timestamp"]))
+    conn.commit()
+
+
+def time_load(conn, load_function, *args) -> float:
+    """Empties the temporary tables and returns how long one load takes."""
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE price_changes, product_latest_price;")
+    conn.commit()
+    start = perf_counter()
+    load_function(*args)
+    return perf_counter() - start
+
+
+def main_benchmark(row_count: int) -> None:
+    """Prints the load time of each path."""
+    rows = make_rows(row_count)
+    conn = get_connection()
+    with conn.cursor() as cur:
+        cur.execute("""CREATE TEMPORARY TABLE price_changes (
+            price_id INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+            price FLOAT NOT NULL,
+            product_id INT NOT NULL,
+            timestamp TIMESTAMPTZ NOT NULL);""")
+        cur.execute("""CREATE TEMPORARY TABLE product_latest_price (
+            product_id INT PRIMARY KEY,
+            price FLOAT NOT NULL,
+            timestamp TIMESTAMPTZ NOT NULL);""")
+    conn.commit()
+
+    row_by_row = time_load(conn, load_row_by_row, rows, conn)
+    print(f"row by row: {row_count} rows in {row_by_row:.2f}s")
+
+    for batch_size in BATCH_SIZES:
+        batched = time_load(conn, bulk_load_price_changes,
+                            rows, conn, batch_size)
+        print(f"batches of {batch_size}: {row_count} rows in {batched:.2f}s "
+              f"({row_by_row / batched:.1f}x)")
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    main_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,74 @@
+"""Compares per-page parse time of the HTML parser backends on product pages.
+
+Usage: python benchmark_parsers.py steam [saved_steam_page.html ...]
+       python benchmark_parsers.py debenhams [saved_debenhams_page.html ...]
+Without saved pages it benchmarks generated pages shaped like the real ones:
+scripts and styles in the head, the product near the top, and a long tail."""
+import sys
+from timeit import timeit
+
+from html_parsers import find_elements_streaming, find_elements_with_soup
+from scrapers import DEBENHAMS_TARGETS, STEAM_TARGETS, steam_elements_complete
+
+REPEATS = 20
+
+PRODUCTS = {
+    "steam": """<div id="appHubAppName" class="apphub_AppName">Generated Game</div>
+      <div id="game_area_purchase"><div class="discount_original_price">£19.99</div>
+      <div class="discount_final_price">£9.99</div></div>""",
+    "debenhams": """<h1 class="text-xl font-bold">Generated Product</h1>
+      <span data-test-id="product-price-current">£320.00</span>
+      <span data-test-id="product-price-was">£330.00</span>"""}
+
+
+def benchmark_page(html_content: bytes, targets: list[dict], is_complete=None) -> dict:
+    """Returns the average seconds per parse for each backend."""
+    soup_result = find_elements_with_soup(html_content, targets)
+    streaming_result = find_elements_streaming(
+        html_content, targets, is_complete)
+    if soup_result != streaming_result:
+        print("Warning: backends disagree:", soup_result, streaming_result)
+
+    return {
+        "bs4": timeit(lambda: find_elements_with_soup(html_content, targets),
+                      number=REPEATS) / REPEATS,
+        "fast": timeit(lambda: find_elements_streaming(html_content, targets, is_complete),
+                       number=REPEATS) / REPEATS}
+
+
+def generate_page(site: str, tail_sections: int) -> bytes:
+    """Returns a product page for site with tail_sections blocks of reviews and
+    recommendations after the product."""
+    head = ("<html><head><style>.price { color: red; }</style>"
+            + "<script>var config = {\"items\": [1, 2, 3]};</script>" * 20
+            + "</head><body><nav>" + "<a href='/x'>Link</a>" * 50 + "</nav>")
+    tail = ("<div class='review'><p>Great <b>value</b>, would buy again.</p>"
+            "<img src='r.jpg'><script>track('review');</script></div>") * tail_sections
+    return (head + PRODUCTS[site] + tail + "</body></html>").encode()
+
+
+def load_pages(site: str, paths: list[str]) -> list[tuple[str, bytes]]:
+    """Reads the saved pages, or generates small, medium and large ones."""
+    if not paths:
+        return [(f"generated {size}", generate_page(site, size)) for size in (10, 100, 1000)]
+    pages = []
+    for path in paths:
+        with open(path, "rb") as page:
+            pages.append((path, page.read()))
+    return pages
+
+
+def main_benchmark(site: str, paths: list[str]) -> None:
+    """Prints the parse times of each page."""
+    targets, is_complete = {"steam": (STEAM_TARGETS, steam_elements_complete),
+                            "debenhams": (DEBENHAMS_TARGETS, None)}[site]
+
+    for path, html_content in load_pages(site, paths):
+        times = benchmark_page(html_content, targets, is_complete)
+        print(f"{path}: {len(html_content)} bytes, bs4 {times['bs4'] * 1000:.2f} ms, "
+              f"fast {times['fast'] * 1000:.2f} ms "
+              f"({times['bs4'] / times['fast']:.1f}x)")
+
+
+if __name__ == "__main__":
+    main_benchmark(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,109 @@
+"""Compares latest-price and chart query times on the old heap price_changes
+table and the monthly partitioned one, seeded with the same rows.
+
+Both tables are built in a scratch benchmark_partitions schema that is dropped
+afterwards, so the benchmark never touches the real tables. Seeding 100 million
+rows takes a while and needs roughly 15GB of free disk.
+Usage: python benchmark_partitions.py [rows] [products] [months]"""
+import sys
+from statistics import median
+
+from dotenv import load_dotenv
+
+from connect_to_database import get_connection
+
+SCHEMA = "benchmark_partitions"
+RUNS = 5
+
+SETUP = """
+DROP SCHEMA IF EXISTS benchmark_partitions CASCADE;
+CREATE SCHEMA benchmark_partitions;
+SET search_path TO benchmark_partitions;
+
+CREATE TABLE heap_price_changes (
+    price_id INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    price FLOAT NOT NULL,
+    product_id INT NOT NULL,
+    timestamp TIMESTAMPTZ NOT NULL);
+
+CREATE TABLE partitioned_price_changes (
+    price_id INT GENERATED ALWAYS AS IDENTITY,
+    price FLOAT NOT NULL,
+    product_id INT NOT NULL,
+    timestamp TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (price_id, timestamp)) PARTITION BY RANGE (timestamp);
+"""
+
+CREATE_PARTITION = """CREATE TABLE partitioned_price_changes_{number}
+    PARTITION OF partitioned_price_changes
+    FOR VALUES FROM (date_trunc('month', NOW()) - make_interval(months => %(number)s))
+    TO (date_trunc('month', NOW()) - make_interval(months => %(number)s - 1));"""
+
+SEED = """INSERT INTO {table} (price, product_id, timestamp)
+    SELECT 10 + (i %% 500) / 100.0, i %% %(products)s,
+    NOW() - (i / %(products)s) * %(step)s * INTERVAL '1 second'
+    FROM generate_series(0, %(rows)s - 1) AS i;"""
+
+QUERIES = {
+    "latest price": """SELECT price FROM {table}
+        WHERE product_id = %(product_id)s ORDER BY timestamp DESC LIMIT 1;""",
+    "3 day chart": """SELECT price, timestamp FROM {table}
+        WHERE product_id = %(product_id)s AND timestamp >= NOW() - INTERVAL '3 days'
+        ORDER BY timestamp;""",
+}
+
+
+def seed(conn, rows: int, products: int, months: int) -> None:
+    """Creates both tables and fills them with the same rows, newest first."""
+    step = months * 30 * 24 * 3600 / (rows / products)
+    with conn.cursor() as cur:
+        cur.execute(SETUP)
+        for number in range(months + 2):
+            cur.execute(CREATE_PARTITION.format(number=number), {"number": number})
+        for table in ("heap_price_changes", "partitioned_price_changes"):
+            cur.execute(SEED.format(table=table),
+                        {"rows": rows, "products": products, "step": step})
+            print(f"Seeded {rows} rows into {table}.")
+        cur.execute("""CREATE INDEX ON partitioned_price_changes
+            (product_id, timestamp DESC) INCLUDE (price);""")
+        cur.execute("ANALYZE heap_price_changes; ANALYZE partitioned_price_changes;")
+    conn.commit()
+
+
+def time_query(conn, query: str, products: int) -> float:
+    """Returns the median server-side execution time of a query, in milliseconds."""
+    timings = []
+    with conn.cursor() as cur:
+        for run in range(RUNS):
+            cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query,
+                        {"product_id": run * 7919 % products})
+            timings.append(cur.fetchone()[0][0]["Execution Time"])
+    return median(timings)
+
+
+def main_benchmark(rows: int, products: int, months: int) -> None:
+    """Prints the query times on each table."""
+    conn = get_connection()
+    try:
+        seed(conn, rows, products, months)
+        with conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {SCHEMA};")
+        for name, query in QUERIES.items():
+            heap = time_query(conn, query.format(table="heap_price_changes"), products)
+            partitioned = time_query(
+                conn, query.format(table="partitioned_price_changes"), products)
+            print(f"{name}: heap {heap:.2f}ms, partitioned {partitioned:.2f}ms "
+                  f"({heap / partitioned:.1f}x)")
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    main_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000_000,
+                   int(sys.argv[2]) if len(sys.argv) > 2 else 10_000,
+                   int(sys.argv[3]) if len(sys.argv) > 3 else 12)
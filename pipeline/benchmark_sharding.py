@@ -0,0 +1,144 @@
+"""Checks lease sharding against one Postgres: throughput with 1, 2, 4 and 8
+worker processes, and that products leased by a crashed worker are still scraped.
+
+Scraping is simulated by sleeping SCRAPE_SECONDS per product, so the numbers
+show how well claiming scales rather than how fast any retailer answers. The
+tables are built in a scratch benchmark_sharding schema that is dropped afterwards.
+Usage: python benchmark_sharding.py [products] [batch size]"""
+import multiprocessing
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from connect_to_database import get_connection
+from sharding import claim_products, complete_products
+
+SCHEMA = "benchmark_sharding"
+SCRAPE_SECONDS = 0.005
+LEASE_SECONDS = 2
+WORKER_COUNTS = (1, 2, 4, 8)
+
+SETUP = """
+DROP SCHEMA IF EXISTS benchmark_sharding CASCADE;
+CREATE SCHEMA benchmark_sharding;
+SET search_path TO benchmark_sharding;
+
+CREATE TABLE product (
+    product_id INT PRIMARY KEY,
+    url VARCHAR(2048) NOT NULL);
+
+CREATE TABLE product_lease (
+    product_id INT NOT NULL,
+    due_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    leased_until TIMESTAMPTZ,
+    leased_by VARCHAR(100),
+    PRIMARY KEY (product_id),
+    FOREIGN KEY (product_id) REFERENCES product(product_id));
+
+CREATE INDEX product_lease_due_at_idx ON product_lease (due_at);
+
+INSERT INTO product SELECT i, 'https://example.com/product/' || i
+FROM generate_series(1, %(products)s) AS i;
+INSERT INTO product_lease (product_id) SELECT product_id FROM product;
+ANALYZE;
+"""
+
+RESET = """UPDATE product_lease
+    SET due_at = NOW() - INTERVAL '1 second', leased_until = NULL, leased_by = NULL;"""
+
+
+def connect():
+    """Returns a connection that works in the scratch schema."""
+    conn = get_connection()
+    with conn.cursor() as cur:
+        cur.execute(f"SET search_path TO {SCHEMA};")
+    conn.commit()
+    return conn
+
+
+def run_worker(worker_id: str, batch_size: int, crash_after: int = 0) -> None:
+    """Claims, "scrapes" and completes batches until nothing is due.
+    With crash_after, the process dies holding its leases after that many batches."""
+    conn = connect()
+    batches = 0
+    while batch := claim_products(conn, worker_id, batch_size, LEASE_SECONDS):
+        time.sleep(SCRAPE_SECONDS * len(batch))
+        batches += 1
+        if crash_after and batches == crash_after:
+            os._exit(1)
+        complete_products(conn, worker_id, [product_id for product_id, _ in batch], 3600)
+    conn.close()
+
+
+def run_workers(count: int, batch_size: int, crash_first: bool = False) -> float:
+    """Runs count worker processes to completion, returning the seconds taken."""
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker,
+                               args=(f"worker-{i}", batch_size,
+                                     1 if crash_first and i == 0 else 0))
+               for i in range(count)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def count_due(conn) -> int:
+    """Returns how many products have not been completed."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM product_lease WHERE due_at <= NOW();")
+        return cur.fetchone()[0]
+
+
+def reset(conn) -> None:
+    """Makes every product due again."""
+    with conn.cursor() as cur:
+        cur.execute(RESET)
+    conn.commit()
+
+
+def main_benchmark(products: int, batch_size: int) -> bool:
+    """Prints throughput per worker count and checks crashed leases are recovered.
+    Returns whether every product was scraped in every run."""
+    conn = get_connection()
+    passed = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SETUP, {"products": products})
+        conn.commit()
+        with conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {SCHEMA};")
+
+        baseline = None
+        for count in WORKER_COUNTS:
+            reset(conn)
+            elapsed = run_workers(count, batch_size)
+            throughput = products / elapsed
+            baseline = baseline or throughput
+            print(f"{count} workers: {throughput:.0f} products/s, "
+                  f"{throughput / baseline / count:.0%} scaling efficiency")
+            passed = passed and count_due(conn) == 0
+
+        reset(conn)
+        run_workers(4, batch_size, crash_first=True)
+        time.sleep(LEASE_SECONDS + 1)
+        run_workers(1, batch_size)
+        remaining = count_due(conn)
+        print(f"{remaining} products still due after a worker crashed holding its leases.")
+        return passed and remaining == 0
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    sys.exit(0 if main_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 4000,
+                                 int(sys.argv[2]) if len(sys.argv) > 2 else 50) else 1)
@@ -1,13 +1,29 @@
 """Script to notify users via email when the price of a product drops below a certain threshold."""
 
 from os import environ as ENV
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from time import sleep
+import json
 import logging
 
 import boto3
 from boto3.exceptions import Boto3Error
+from botocore.exceptions import ClientError
 from psycopg2.extensions import connection
+from psycopg2.extras import execute_values
 
 from connect_to_database import configure_logging, get_connection, get_cursor
+from rate_limiter import TokenBucket, get_backoff_delay
+from metrics import increment, timer
+
+NOTIFICATION_FIELDS = ("user_id", "product_id", "notification_price", "original_price",
+                       "product_name", "email_address", "first_name", "last_name",
+                       "current_price")
+
+THROTTLING_ERROR_CODES = {"Throttling", "ThrottlingException"}
+
+MAX_BULK_DESTINATIONS = 50
 
 
 def get_ses_client() -> boto3.client:
@@ -26,62 +42,72 @@ def get_ses_client() -> boto3.client:
                         aws_secret_access_key=aws_secret_access_key)
 
 
-def get_subscriptions_and_products(conn: connection) -> list[tuple[int, float, str, str]]:
-    """Returns all active subscriptions along with product and user details."""
+def get_pending_notifications(conn: connection) -> list[tuple]:
+    """Returns every subscription whose product's latest price is below its
+    notification price and that has not already been notified at that price,
+    along with the product and user details needed for the email."""
 
     with get_cursor(conn) as cur:
         cur.execute("""
-            SELECT s.product_id, s.notification_price, p.original_price, p.product_name, u.email_address, u.first_name, u.last_name
+            SELECT s.user_id, s.product_id, s.notification_price, p.original_price,
+                   p.product_name, u.email_address, u.first_name, u.last_name,
+                   lp.price
             FROM subscription s
-            JOIN product p ON s.product_id = p.product_id
-            JOIN users u ON s.user_id = u.user_id
+            JOIN product_latest_price lp ON lp.product_id = s.product_id
+            JOIN product p ON p.product_id = s.product_id
+            JOIN users u ON u.user_id = s.user_id
+            WHERE lp.price < s.notification_price
+            AND NOT EXISTS (
+                SELECT 1 FROM notifications_sent n
+                WHERE n.user_id = s.user_id
+                AND n.product_id = s.product_id
+                AND n.price = lp.price)
         """)
-        subscriptions = cur.fetchall()
+        pending_notifications = cur.fetchall()
 
-    return subscriptions
+    return pending_notifications
 
 
-def get_current_product_price(conn: connection, product_id: int) -> float:
-    """Returns the current price of a specified product."""
+def log_notifications_sent(conn: connection, notifications: list[tuple[int, int, float]]) -> None:
+    """Logs a batch of sent notifications, given as (user_id, product_id, price),
+    in the notifications_sent table with one statement."""
 
     with get_cursor(conn) as cur:
-        cur.execute("""
-            SELECT price FROM price_changes WHERE product_id = %s
-        """, (product_id,))
-        result = cur.fetchone()
-
-    return float(result["price"]) if result else None
-
-
-def has_notification_been_sent(conn: connection, user_id: int, product_id: int, price: float) -> bool:
-    """Checks if a notification has already been sent for a given user, product, and price."""
+        execute_values(cur, """
+            INSERT INTO notifications_sent (user_id, product_id, price, timestamp)
+            VALUES %s
+        """, notifications, template="(%s, %s, %s, NOW())")
 
-    with get_cursor(conn) as cur:
-        cur.execute("""
-            SELECT 1 FROM notifications_sent
-            WHERE user_id = %s AND product_id = %s AND price = %s
-        """, (user_id, product_id, price))
-        result = cur.fetchone()
-    return result is not None
 
+def is_throttling_error(error: ClientError) -> bool:
+    """Checks if SES rejected a request for going over the send rate."""
+    error_details = error.response.get("Error", {})
+    return error_details.get("Code") in THROTTLING_ERROR_CODES \
+        or "Maximum sending rate exceeded" in error_details.get("Message", "")
 
-def log_notification_sent(conn: connection, user_id: int, product_id: int, price: float) -> None:
-    """Logs a sent notification in the notifications_sent table."""
 
-    with get_cursor(conn) as cur:
-        cur.execute("""
-            INSERT INTO notifications_sent (user_id, product_id, price, timestamp)
-            VALUES (%s, %s, %s, NOW())
-        """, (user_id, product_id, price))
+def call_with_retries(ses_request, *args, **kwargs) -> dict:
+    """Calls an SES request, retrying throttling errors with jittered exponential backoff."""
+    max_attempts = int(ENV.get("SES_MAX_ATTEMPTS", "5"))
+    for attempt in range(max_attempts):
+        try:
+            return ses_request(*args, **kwargs)
+        except ClientError as e:
+            if not is_throttling_error(e) or attempt == max_attempts - 1:
+                raise
+            logging.warning("SES throttled the request, retrying.")
+            sleep(get_backoff_delay(attempt))
+    return None
 
 
-def send_email(to_address: str, subject: str, body: str) -> None:
-    """Sends an email using SES."""
+def send_email(to_address: str, subject: str, body: str, ses_client: boto3.client = None) -> bool:
+    """Sends an email using SES. Returns whether it was sent."""
 
-    ses_client = get_ses_client()
+    ses_client = ses_client or get_ses_client()
 
     try:
-        response = ses_client.send_email(
+        response = call_with_retries(
+            ses_client.send_email,
             Source=ENV["FROM_EMAIL"],
             Destination={"ToAddresses": [to_address]},
             Message={
@@ -92,9 +118,109 @@ def send_email(to_address: str, subject: str, body: str) -> None:
         logging.info(
             "Email sent to %s with status code %s.",
             to_address, response['ResponseMetadata']['HTTPStatusCode'])
+        return True
 
-    except Boto3Error as e:
+    except (Boto3Error, ClientError) as e:
         logging.error("Error sending email: %s", e)
+        return False
+
+
+def get_template_data(notification: dict) -> str:
+    """Returns the SES template replacement data for one notification."""
+    percentage_change = calculate_percentage_decrease(
+        notification["original_price"], notification["current_price"])
+    return json.dumps({
+        "first_name": notification["first_name"],
+        "last_name": notification["last_name"],
+        "product_name": notification["product_name"],
+        "change_type": determine_if_increase_or_decrease(percentage_change),
+        "percentage_change": abs(percentage_change),
+        "current_price": notification["current_price"],
+        "notification_price": notification["notification_price"]})
+
+
+def send_single_notification(notifications: list[dict], ses_client: boto3.client,
+                             rate_limiter: TokenBucket) -> list[dict]:
+    """Sends one plain-text alert. Returns the notifications that were sent."""
+    notification = notifications[0]
+    subject, body = build_email(
+        notification["first_name"], notification["last_name"],
+        notification["product_name"], notification["original_price"],
+        notification["current_price"], notification["notification_price"])
+
+    rate_limiter.acquire()
+    with timer("email_send_seconds"):
+        sent = send_email(notification["email_address"], subject, body, ses_client)
+    if not sent:
+        return []
+    logging.info("Notified %s about price drop for %s.",
+                 notification["email_address"], notification["product_name"])
+    return notifications
+
+
+def send_templated_notifications(notifications: list[dict], ses_client: boto3.client,
+                                 rate_limiter: TokenBucket) -> list[dict]:
+    """Sends alerts for one product to many recipients with a single
+    send_bulk_templated_email call. Returns the notifications that were sent."""
+    for _ in notifications:
+        rate_limiter.acquire()
+
+    try:
+        with timer("email_send_seconds"):
+            response = call_with_retries(
+                ses_client.send_bulk_templated_email,
+                Source=ENV["FROM_EMAIL"],
+                Template=ENV["SES_TEMPLATE_NAME"],
+                DefaultTemplateData=json.dumps(
+                    {"product_name": notifications[0]["product_name"]}),
+                Destinations=[{
+                    "Destination": {"ToAddresses": [notification["email_address"]]},
+                    "ReplacementTemplateData": get_template_data(notification)}
+                    for notification in notifications])
+    except (Boto3Error, ClientError) as e:
+        logging.error("Error sending bulk email: %s", e)
+        return []
+
+    sent = [notification for notification, status in zip(notifications, response["Status"])
+            if status["Status"] == "Success"]
+    logging.info("Notified %s of %s subscribers about price drop for %s.",
+                 len(sent), len(notifications), notifications[0]["product_name"])
+    return sent
+
+
+def get_notification_batches(notifications: list[dict]) -> list[list[dict]]:
+    """Groups notifications for the same product into bulk-sized batches when
+    SES_TEMPLATE_NAME is set, otherwise gives each notification its own batch."""
+    if not ENV.get("SES_TEMPLATE_NAME"):
+        return [[notification] for notification in notifications]
+
+    batches = []
+    by_product = sorted(notifications, key=lambda n: n["product_id"])
+    for _, product_notifications in groupby(by_product, key=lambda n: n["product_id"]):
+        product_notifications = list(product_notifications)
+        for start in range(0, len(product_notifications), MAX_BULK_DESTINATIONS):
+            batches.append(
+                product_notifications[start:start + MAX_BULK_DESTINATIONS])
+    return batches
+
+
+def send_notifications(notifications: list[dict], ses_client: boto3.client) -> list[dict]:
+    """Sends every notification from a thread pool, sharing one SES client and
+    keeping under SES_MAX_SEND_RATE emails a second. Returns the notifications sent."""
+    rate_limiter = TokenBucket(float(ENV.get("SES_MAX_SEND_RATE", "14")))
+    send_batch = send_templated_notifications if ENV.get("SES_TEMPLATE_NAME") \
+        else send_single_notification
+
+    with ThreadPoolExecutor(max_workers=int(ENV.get("SES_SEND_THREADS", "8"))) as executor:
+        futures = [executor.submit(send_batch, batch, ses_client, rate_limiter)
+                   for batch in get_notification_batches(notifications)]
+
+    sent = []
+    for future in futures:
+        sent.extend(future.result())
+    increment("emails_sent", len(sent))
+    increment("emails_failed", len(notifications) - len(sent))
+    return sent
 
 
 def calculate_percentage_decrease(initial: float, final: float) -> float:
@@ -110,62 +236,45 @@ def determine_if_increase_or_decrease(percentage: float) -> str:
         return "increased"
 
 
+def build_email(first_name: str, last_name: str, product_name: str, original_price: float,
+                current_price: float, notification_price: float) -> tuple[str, str]:
+    """Returns the subject and body of a price drop alert."""
+    percentage_change = calculate_percentage_decrease(
+        original_price, current_price)
+    change_type = determine_if_increase_or_decrease(percentage_change)
+
+    subject = f"Price Drop Alert: {product_name}"
+    body = (f"Dear {first_name} {last_name},\n\n"
+            f"The price for {product_name} has "
+            f"{change_type} by {abs(percentage_change)}%!\n"
+            "It is now"
+            f" £{current_price}, dropping below your threshold of "
+            f"£{notification_price}."
+            " Hurry before this sale ends!\n"
+            "Best wishes and happy shopping,\n"
+            "The Price Slashers Team.")
+    return subject, body
+
+
 def check_and_notify() -> None:
     """Checks product prices and notifies users via email if the price
     drops below their notification threshold."""
 
     with get_connection() as conn:
-        subscriptions = get_subscriptions_and_products(conn)
-
-        for product_id, notification_price, original_price, product_name, customer_email, first_name, last_name in subscriptions:
-            current_price = get_current_product_price(conn, product_id)
-
-            if current_price is None:
-                logging.warning("Product %s with ID %s not found.",
-                                product_name, product_id)
-                continue
-
-            percentage_change = calculate_percentage_decrease(
-                original_price, current_price)
-            change_type = determine_if_increase_or_decrease(percentage_change)
-
-            if current_price < notification_price:
-                with get_cursor(conn) as cur:
-                    cur.execute("""
-                        SELECT user_id FROM users 
-                        WHERE email_address = %s
-                    """, (customer_email,))
-                    user_result = cur.fetchone()
-
-                if not user_result:
-                    logging.warning(
-                        "No user found for email %s", customer_email)
-                    continue
-
-                user_id = user_result['user_id']
-
-                if has_notification_been_sent(conn, user_id, product_id, current_price):
-                    logging.info("Notification already sent for user %s and product %s at price %s.",
-                                 user_id, product_name, current_price)
-                    continue
-
-                subject = f"Price Drop Alert: {product_name}"
-                body = (f"Dear {first_name} {last_name},\n\n"
-                        f"The price for {product_name} has "
-                        f"{change_type} by {abs(percentage_change)}%!\n"
-                        "It is now"
-                        f" £{current_price}, dropping below your threshold of "
-                        f"£{notification_price}."
-                        " Hurry before this sale ends!\n"
-                        "Best wishes and happy shopping,\n"
-                        "The Price Slashers Team.")
-
-                send_email(customer_email, subject, body)
-
-                log_notification_sent(conn, user_id, product_id, current_price)
-
-                logging.info("Notified %s about price drop for %s.",
-                             customer_email, product_name)
+        pending_notifications = [dict(zip(NOTIFICATION_FIELDS, row))
+                                 for row in get_pending_notifications(conn)]
+        logging.info("%s notifications to send.", len(pending_notifications))
+        if not pending_notifications:
+            return
+
+        notifications_sent = send_notifications(
+            pending_notifications, get_ses_client())
+
+        if notifications_sent:
+            log_notifications_sent(conn, [
+                (notification["user_id"], notification["product_id"],
+                 notification["current_price"])
+                for notification in notifications_sent])
 
 
 if __name__ == "__main__":
@@ -1,22 +1,71 @@
 """This connects the whole ETL pipeline so that it can be run using one command"""
+from contextlib import closing
+import logging
 from dotenv import load_dotenv
-from extract import main_extraction_process
-from transform import main_transform_product_data
-from load import main_load
+from extract import extraction_run, stream_extraction
+from transform import transform_products
+from load import stream_load
 from email_notifier import check_and_notify
 from connect_to_database import configure_logging
+from host_guard import reset_hosts, log_host_stats
+from metrics import timer, reset_metrics, export_metrics
+from sharding import NOTIFY_LOCK_KEY, advisory_lock, get_shard_mode, leased_url_batches
+
+
+def stream_products(shard_mode: str) -> int:
+    """Streams this worker's products through extract, transform and load.
+    In the lease shard mode the worker keeps claiming batches until nothing is due,
+    sharing one HTTP cache, set of sessions and parse pool across every batch.
+    The extraction is closed as soon as loading stops, so a load error cancels
+    the scrape instead of waiting for it. Returns the number of rows scraped."""
+    if shard_mode != "lease":
+        with closing(stream_extraction()) as products:
+            return stream_load(transform_products(products))
+
+    rows = 0
+    with extraction_run() as extract:
+        for list_of_urls in leased_url_batches():
+            with closing(extract(list_of_urls)) as products:
+                rows += stream_load(transform_products(products))
+    return rows
+
+
+def notify(shard_mode: str) -> None:
+    """Sends notifications. When the catalogue is sharded, only one worker at a
+    time sends them so two workers cannot email the same alert."""
+    if shard_mode == "none":
+        check_and_notify()
+        return
+
+    with advisory_lock(NOTIFY_LOCK_KEY) as acquired:
+        if acquired:
+            check_and_notify()
+        else:
+            logging.info("Another worker is sending notifications.")
 
 
 def main_etl() -> None:
-    """This connects the extract, transform, load and email scripts to form the ETL pipeline."""
+    """This connects the extract, transform, load and email scripts to form the ETL pipeline.
+    Products stream through extract, transform and load one at a time, so each batch is
+    written as soon as it is full rather than after the whole catalogue has been scraped.
+    The run's duration is recorded and its metrics and per-website fetch stats
+    are reported at the end."""
     load_dotenv()
     configure_logging()
+    reset_metrics()
+    reset_hosts()
+    shard_mode = get_shard_mode()
 
-    raw_products_data = main_extraction_process()
-    print(raw_products_data)
-    cleaned_products_data = main_transform_product_data(raw_products_data)
-    main_load(cleaned_products_data)
-    check_and_notify()
+    try:
+        with timer("etl_seconds"):
+            with timer("stream_seconds"):
+                rows = stream_products(shard_mode)
+            logging.info("Scraped %s products.", rows)
+            with timer("notify_seconds"):
+                notify(shard_mode)
+    finally:
+        log_host_stats()
+        export_metrics()
 
 
 if __name__ == "__main__":
@@ -1,201 +1,439 @@
 """Extraction script that retrieves information from products with active subscriptions."""
+from os import environ as ENV
+import asyncio
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import os
+from urllib.parse import urlparse
 import logging
+from queue import Queue, Full
+import threading
+import time
+from typing import Awaitable, Callable, Iterator
 
 from dotenv import load_dotenv
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 from connect_to_database import get_connection, get_cursor
+from host_guard import guarded_request
+from metrics import increment, observe, timer
+from scheduler import get_schedule_mode
+from scrapers import PRICE_FIELDS, scrape_product
+from sharding import get_shard, get_shard_mode
+from http_cache import (NOT_MODIFIED, load_cache, save_cache, log_cache_stats,
+                        get_conditional_headers, record_response, record_not_modified,
+                        store_result, get_cached_result)
 
 QUERY_TO_FIND_URLS = """
 SELECT product_id,url FROM product;
 """
 
+QUERY_TO_FIND_SHARD_URLS = """
+SELECT product_id,url FROM product WHERE product_id %% %s = %s;
+"""
+
+QUERY_TO_FIND_DUE_URLS = """
+SELECT p.product_id, p.url FROM product AS p
+LEFT JOIN product_lease AS l ON l.product_id = p.product_id
+WHERE l.due_at IS NULL OR l.due_at <= NOW();
+"""
+
+QUERY_TO_FIND_DUE_SHARD_URLS = """
+SELECT p.product_id, p.url FROM product AS p
+LEFT JOIN product_lease AS l ON l.product_id = p.product_id
+WHERE (l.due_at IS NULL OR l.due_at <= NOW()) AND p.product_id %% %s = %s;
+"""
+
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
 
 def extract_urls_from_db() -> list[list[int, str]]:
     """Function to get urls from a database
-    returns the id of the product and its URL page in a list: [id,url]"""
+    returns the id of the product and its URL page in a list: [id,url]
+    In the modulo shard mode only this worker's shard is returned, and with the
+    adaptive SCRAPE_SCHEDULE only the products that are due."""
     conn = get_connection()
+    adaptive = get_schedule_mode() == "adaptive"
 
     with get_cursor(conn) as db_cursor:
-        db_cursor.execute(QUERY_TO_FIND_URLS)
+        if get_shard_mode() == "modulo":
+            db_cursor.execute(QUERY_TO_FIND_DUE_SHARD_URLS if adaptive
+                              else QUERY_TO_FIND_SHARD_URLS, get_shard())
+        else:
+            db_cursor.execute(QUERY_TO_FIND_DUE_URLS if adaptive else QUERY_TO_FIND_URLS)
         url_list = db_cursor.fetchall()
 
     return url_list
 
 
+def get_host_from_url(url: str) -> str:
+    """Gets the host name (e.g. www.debenhams.com) from a given URL."""
+    return urlparse(url).netloc
+
+
+def get_session(url: str) -> requests.Session:
+    """Returns the shared session for the URL's host, creating it on first use.
+    Sessions keep their connections (and cookies) alive for the whole run."""
+    host = get_host_from_url(url)
+    with SESSIONS_LOCK:
+        if host not in SESSIONS:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=int(ENV.get("MAX_REQUESTS_PER_HOST", "8")))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            SESSIONS[host] = session
+        return SESSIONS[host]
+
+
+def close_sessions() -> None:
+    """Closes every shared session, ready for the next run."""
+    with SESSIONS_LOCK:
+        for session in SESSIONS.values():
+            session.close()
+        SESSIONS.clear()
+
+
+def conditional_get(session: requests.Session, url: str, timeout: int) -> requests.Response:
+    """GETs a URL, sending the cached validators so an unchanged page comes back as a 304.
+    The request is throttled, retried and circuit broken per host by host_guard."""
+    return guarded_request(get_host_from_url(url), lambda: session.get(
+        url, headers=get_conditional_headers(url), timeout=timeout))
+
+
+def check_cache(url: str, response: requests.Response) -> bytes:
+    """Returns NOT_MODIFIED for a 304, otherwise records the download and returns its content."""
+    if response.status_code == 304:
+        increment("pages_not_modified")
+        record_not_modified(url)
+        return NOT_MODIFIED
+    increment("pages_fetched")
+    increment("bytes_downloaded", len(response.content))
+    record_response(url, response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"), len(response.content))
+    return response.content
+
+
 def get_html_with_age_gate_bypass(url: str) -> bytes:
-    """Handles Steam URLs with age-gates by simulating form submission."""
+    """Handles Steam URLs with age-gates by simulating form submission.
+    The age-check cookies stay on the shared Steam session, so the form is
+    only submitted the first time a run hits an age-gated page."""
     try:
-        session = requests.Session()
-        session.get(url, timeout=20)
+        session = get_session(url)
+        response = conditional_get(session, url, 20)
 
-        app_id = url.split('/app/')[1].split('/')[0]
+        if "/agecheck/" in response.url:
+            app_id = url.split('/app/')[1].split('/')[0]
 
-        age_gate_data = {
-            "ageDay": "1",
-            "ageMonth": "January",
-            "ageYear": "1990",
-        }
-        bypass_url = f"https://store.steampowered.com/agecheck/app/{app_id}/"
-        session.post(bypass_url, data=age_gate_data, timeout=20)
+            age_gate_data = {
+                "ageDay": "1",
+                "ageMonth": "January",
+                "ageYear": "1990",
+            }
+            bypass_url = f"https://store.steampowered.com/agecheck/app/{app_id}/"
+            session.post(bypass_url, data=age_gate_data, timeout=20)
+
+            response = conditional_get(session, url, 20)
 
-        response = session.get(url, timeout=20)
         response.raise_for_status()
 
-        return response.content
+        return check_cache(url, response)
     except requests.exceptions.RequestException as e:
         logging.error("Error fetching age-gated URL %s: %s", url, e)
         return None
 
 
 def get_html_from_url(web_page: str) -> bytes:
-    """ Gets the html content from a given URL"""
+    """ Gets the html content from a given URL.
+    Returns NOT_MODIFIED if the page is unchanged since it was last cached."""
     if "store.steampowered.com" in web_page:
         return get_html_with_age_gate_bypass(web_page)
 
     try:
-        html = requests.get(web_page, timeout=30)
+        html = conditional_get(get_session(web_page), web_page, 30)
     except requests.exceptions.MissingSchema:
         return "That URL does not exist."
     except requests.exceptions.ConnectionError:
         return "Cannot connect to that URL."
-    if html.status_code > 299 or html.status_code < 200:
+    if html.status_code != 304 and (html.status_code > 299 or html.status_code < 200):
         logging.error(
             "Issue with provided web_page: HTML Status Code - %s", html.status_code)
         return "Error: Something went wrong when trying to reach your webpage."
-    return html.content
-
-
-def get_website_from_url(url: str) -> str:
-    """ Gets a main website address from a given URL """
-    website_url = url
-    if ".com" in url:
-        website_url = url.split(".com")[0] + ".com"
-    elif ".co.uk" in url:
-        website_url = url.split(".co.uk")[0] + ".co.uk"
-    return website_url
+    return check_cache(web_page, html)
 
 
 def scrape_pricing_process(html_content: bytes, url: str, product_id: int) -> dict:
-    """Chooses which scraper to use based off of the URL."""
-
-    website_url = get_website_from_url(url)
-
-    if "https://store.steampowered.com" in website_url:
-        return scrape_from_steam_html(html_content, url, product_id)
-
-    if "https://www.debenhams.com" in website_url:
-        return scrape_from_debenhams_html(html_content, url, product_id)
-
-    logging.error(
-        "Cannot scrape that URL, since it's not a Debenhams or Steam webpage.")
-    return
-
-
-def scrape_from_debenhams_html(html_content: bytes, url: str, product_id: int) -> dict:
-    """Scrapes product, price and website information from Debenhams."""
-    s = BeautifulSoup(html_content, 'html.parser')
-
-    product_title_element = s.find("h1", class_="text-xl")
-    if not product_title_element:
-        logging.error("Cannot find product title on the page for URL: %s", url)
-        return None
-
-    current_price_element = s.find(
-        "span", {"data-test-id": "product-price-current"})
-    if not current_price_element:
-        logging.error("Cannot find current price element for URL: %s", url)
-        return None
-
-    original_price_element = s.find(
-        "span", {"data-test-id": "product-price-was"})
-    if not original_price_element:
-        logging.error("Cannot find original price element for URL: %s", url)
-        original_price_element = current_price_element
-
-    product_title = product_title_element.text.strip()
-    current_price = current_price_element.text.strip()
-    original_price = original_price_element.text.strip(
-    ) if original_price_element else current_price
-
-    product_information = {
-        "product_id": product_id,
-        "original_price": original_price,
-        "discount_price": current_price,
-        "product_title": product_title,
-        "website": get_website_from_url(url)}
-
-    print(product_information)
+    """Scrapes the price fields of a product page with the scraper registered
+    for its website, tagging the result with product_id."""
+    product_information = scrape_product(html_content, url, PRICE_FIELDS)
+    if product_information:
+        product_information["product_id"] = product_id
     return product_information
 
 
-def scrape_from_steam_html(html_content: bytes, url: str, product_id: int) -> dict:
-    """Scrapes product, price and website information from Steam."""
-    s = BeautifulSoup(html_content, 'html.parser')
+def parse_product_page(html_of_url: bytes, web_url: str, product_id: int) -> tuple[dict, float]:
+    """Scrapes a fetched page, returning the result and how long the parse took.
+    This is the function the parse workers run."""
+    start = time.perf_counter()
+    product_information = scrape_pricing_process(
+        html_of_url, web_url, product_id)
+    return product_information, time.perf_counter() - start
 
-    results = s.find(id="game_area_purchase")
-
-    if not results:
-        logging.error("Can't scrape that Steam URL.")
-        return None
 
-    original_price_element = results.find(
-        "div", class_="discount_original_price")
-    discount_price_element = results.find(
-        "div", class_="discount_final_price")
-    game_title_element = s.find(
-        id="appHubAppName", class_="apphub_AppName")
-    regular_price_element = s.find("div", class_="game_purchase_price price", attrs={
-        "data-price-final": True})
-
-    if not game_title_element:
-        logging.error("Cannot find product title on the page for URL: %s", url)
-        return None
-    game_title = game_title_element.text.strip()
-
-    if original_price_element and discount_price_element:
-        original_price = original_price_element.text.strip(
-        ) if original_price_element else "N/A"
-        discount_price = discount_price_element.text.strip(
-        ) if discount_price_element else "N/A"
-    elif regular_price_element:
-        original_price = regular_price_element.text.strip()
-        discount_price = original_price
-    else:
-        original_price = "N/A"
-        discount_price = "N/A"
-
-    product_information = {"product_id": product_id,
-                           "original_price": original_price,
-                           "discount_price": discount_price,
-                           "game_title": game_title,
-                           "website": get_website_from_url(url)}
-    print(product_information)
-    return product_information
-
-
-def main_extraction_process() -> list[dict]:
-    """ Carries out the whole extraction process into a list of dictionaries,
-    ready to be transformed/inserted into a Database.
-    Reminder: extract_urls_from_db() -> list of [id,url]"""
-    list_of_urls = extract_urls_from_db()
-    print(list_of_urls)
-
-    all_scraped_product_information = []
-
-    for url_info in list_of_urls:
-        web_url = url_info[1]
+def extract_product_information(product_id: int, web_url: str) -> dict:
+    """Fetches and scrapes a single product page, reusing the cached result
+    when the page has not changed."""
+    with timer("fetch_seconds"):
         html_of_url = get_html_from_url(web_url)
+    if html_of_url is NOT_MODIFIED:
+        return get_cached_result(web_url, product_id)
+
+    product_information, parse_seconds = parse_product_page(
+        html_of_url, web_url, product_id)
+    observe("parse_seconds", parse_seconds)
+    if not product_information:
+        increment("parse_failures")
+    store_result(web_url, product_information, parse_seconds)
+    return product_information
 
-        extracted_web_data = scrape_pricing_process(
-            html_of_url, web_url, url_info[0])
 
-        if extracted_web_data:
-            all_scraped_product_information.append(extracted_web_data)
-    return all_scraped_product_information
+async def fetch_into_queue(executor: ThreadPoolExecutor, global_limit: asyncio.Semaphore,
+                           host_limit: asyncio.Semaphore, queue: asyncio.Queue,
+                           index: int, url_info: list[int, str]) -> None:
+    """Fetch stage: downloads one page once both a host slot and a global slot
+    are free, then hands the raw bytes to the parse stage.
+    The host slot is taken first so a busy host cannot hold global slots while it waits,
+    and the slots are released before waiting on a full queue."""
+    loop = asyncio.get_running_loop()
+    try:
+        async with host_limit:
+            async with global_limit:
+                with timer("fetch_seconds"):
+                    html_of_url = await loop.run_in_executor(
+                        executor, get_html_from_url, url_info[1])
+    except Exception as e:  # pylint: disable=broad-except
+        increment("fetch_errors")
+        logging.error("Error fetching URL %s: %s", url_info[1], e)
+        return
+    await queue.put((index, url_info, html_of_url))
+
+
+async def parse_from_queue(executor: Executor, queue: asyncio.Queue,
+                           emit: Callable[[int, dict], Awaitable[None]]) -> None:
+    """Parse stage: scrapes pages from the queue on the parse executor until
+    it receives None, awaiting emit with each result and its index."""
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        index, (product_id, web_url), html_of_url = item
+
+        if html_of_url is NOT_MODIFIED:
+            await emit(index, get_cached_result(web_url, product_id))
+            continue
+
+        try:
+            product_information, parse_seconds = await loop.run_in_executor(
+                executor, parse_product_page, html_of_url, web_url, product_id)
+        except Exception as e:  # pylint: disable=broad-except
+            increment("parse_failures")
+            logging.error("Error scraping URL %s: %s", web_url, e)
+            continue
+        observe("parse_seconds", parse_seconds)
+        if not product_information:
+            increment("parse_failures")
+        store_result(web_url, product_information, parse_seconds)
+        await emit(index, product_information)
+
+
+def get_parse_executor(parse_workers: int, fetch_executor: ThreadPoolExecutor) -> Executor:
+    """Returns a process pool with parse_workers processes, or the fetch
+    thread pool when parse_workers is 0.
+    Workers are started with forkserver so they are not forked from a
+    process that already has fetch threads running."""
+    if not parse_workers:
+        return fetch_executor
+    return ProcessPoolExecutor(max_workers=parse_workers,
+                               mp_context=multiprocessing.get_context("forkserver"))
+
+
+async def async_extraction(list_of_urls: list[list[int, str]], max_concurrency: int,
+                           max_per_host: int, parse_workers: int = 0,
+                           queue_size: int = None,
+                           emit: Callable[[int, dict], Awaitable[None]] = None,
+                           shared_parse_executor: Executor = None) -> list[dict]:
+    """Scrapes products concurrently, with at most max_concurrency requests in flight
+    overall and at most max_per_host requests in flight to any single website.
+    Fetched pages wait in a queue of at most queue_size pages (max_concurrency by default)
+    for one of parse_workers processes to scrape them.
+    Results are returned in the same order as list_of_urls, or if emit is given,
+    handed to the coroutine emit(index, result) as soon as each one is parsed instead.
+    A parser waits for emit to return, so a slow emit holds back the parse stage.
+    shared_parse_executor, if given, is used instead of starting a parse pool and
+    is left running for the caller to reuse."""
+    global_limit = asyncio.Semaphore(max_concurrency)
+    host_limits = defaultdict(lambda: asyncio.Semaphore(max_per_host))
+    queue = asyncio.Queue(maxsize=queue_size or max_concurrency)
+    results = [None] * len(list_of_urls)
+
+    async def store(index: int, product_information: dict) -> None:
+        results[index] = product_information
+    emit = emit or store
+    parser_count = parse_workers or max_concurrency
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as fetch_executor:
+        parse_executor = shared_parse_executor or get_parse_executor(
+            parse_workers, fetch_executor)
+        try:
+            parsers = [asyncio.create_task(parse_from_queue(parse_executor, queue, emit))
+                       for _ in range(parser_count)]
+
+            await asyncio.gather(
+                *(fetch_into_queue(fetch_executor, global_limit,
+                                   host_limits[get_host_from_url(url_info[1])],
+                                   queue, index, url_info)
+                  for index, url_info in enumerate(list_of_urls)))
+
+            for _ in parsers:
+                await queue.put(None)
+            await asyncio.gather(*parsers)
+        finally:
+            if parse_executor not in (fetch_executor, shared_parse_executor):
+                parse_executor.shutdown()
+
+    return [product_information for product_information in results
+            if product_information]
+
+
+def stream_async_extraction(list_of_urls: list[list[int, str]], max_concurrency: int,
+                            max_per_host: int, parse_workers: int = 0,
+                            queue_size: int = None,
+                            shared_parse_executor: Executor = None) -> Iterator[dict]:
+    """Runs async_extraction on a background thread and yields each product's
+    information as soon as it has been parsed, in completion order.
+    At most queue_size results (max_concurrency by default) wait to be consumed;
+    beyond that the parsers wait for the consumer, without blocking the event loop,
+    so fetches in flight carry on and memory stays bounded.
+    Closing the generator, or an error in the consumer, cancels the extraction."""
+    results = Queue(maxsize=queue_size or max_concurrency)
+    stopped = threading.Event()
+    running = []
+    running_lock = threading.Lock()
+    failure = []
+    done = object()
+
+    def put(item) -> None:
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    async def emit(_index: int, product_information: dict) -> None:
+        if product_information:
+            await asyncio.get_running_loop().run_in_executor(None, put, product_information)
+
+    async def extract() -> None:
+        with running_lock:
+            running.append((asyncio.get_running_loop(), asyncio.current_task()))
+        try:
+            if not stopped.is_set():
+                await async_extraction(list_of_urls, max_concurrency, max_per_host,
+                                       parse_workers, queue_size, emit,
+                                       shared_parse_executor)
+        finally:
+            with running_lock:
+                running.clear()
+
+    def run() -> None:
+        try:
+            asyncio.run(extract())
+        except asyncio.CancelledError:
+            logging.info("Extraction cancelled after the consumer stopped.")
+        except Exception as e:  # pylint: disable=broad-except
+            failure.append(e)
+        finally:
+            put(done)
+
+    extraction = threading.Thread(target=run, name="stream-extraction", daemon=True)
+    extraction.start()
+    try:
+        while (product_information := results.get()) is not done:
+            yield product_information
+    finally:
+        stopped.set()
+        with running_lock:
+            for loop, task in running:
+                loop.call_soon_threadsafe(task.cancel)
+        extraction.join()
+    if failure:
+        raise failure[0]
+
+
+@contextmanager
+def extraction_run(mode: str = None) -> Iterator[Callable[[list], Iterator[dict]]]:
+    """Sets up what every extraction in a run shares once: the HTTP cache, the
+    per-host sessions (with their keep-alive connections and cookies) and the
+    parse pool. Yields extract(list_of_urls), which streams the products of a
+    list of [id, url] pairs with them; the cache is saved and everything closed
+    when the block ends.
+    mode is either "async" (the default) or "serial", falling back to EXTRACT_MODE."""
+    mode = mode or ENV.get("EXTRACT_MODE", "async")
+    if mode not in ("async", "serial"):
+        raise ValueError(f"Unknown extraction mode: {mode}")
+    parse_workers = int(ENV.get("PARSE_WORKERS", str(os.cpu_count())))
+
+    def extract(list_of_urls: list[list[int, str]]) -> Iterator[dict]:
+        increment("urls", len(list_of_urls))
+        if mode == "serial":
+            for product_id, web_url in list_of_urls:
+                product_information = extract_product_information(
+                    product_id, web_url)
+                if product_information:
+                    yield product_information
+        else:
+            yield from stream_async_extraction(
+                list_of_urls,
+                int(ENV.get("MAX_CONCURRENT_REQUESTS", "32")),
+                int(ENV.get("MAX_REQUESTS_PER_HOST", "8")),
+                parse_workers,
+                int(ENV.get("PARSE_QUEUE_SIZE", "0")),
+                parse_executor)
+
+    load_cache()
+    parse_executor = None
+    try:
+        if mode == "async" and parse_workers:
+            parse_executor = get_parse_executor(parse_workers, None)
+        yield extract
+    finally:
+        if parse_executor:
+            parse_executor.shutdown()
+        close_sessions()
+        save_cache()
+        log_cache_stats()
+
+
+def stream_extraction(mode: str = None,
+                      list_of_urls: list[list[int, str]] = None) -> Iterator[dict]:
+    """Yields each product's scraped information as soon as it is ready, so
+    later stages can start before the whole catalogue has been scraped.
+    mode is either "async" (the default) or "serial", falling back to EXTRACT_MODE.
+    Scrapes list_of_urls if given, otherwise every product from the database."""
+    with extraction_run(mode) as extract:
+        if list_of_urls is None:
+            list_of_urls = extract_urls_from_db()
+        yield from extract(list_of_urls)
 
 
 if __name__ == "__main__":
     load_dotenv()
-    main_extraction_process()
+    for scraped_product in stream_extraction():
+        print(scraped_product)
@@ -0,0 +1,149 @@
+"""Per-host throttling, retries and circuit breaking for retailer fetches.
+
+Every request to a host first takes a token from that host's bucket, so no host
+is sent more than HOST_RATE_LIMIT requests per second on average (with bursts of
+up to HOST_BURST; a limit of 0 turns throttling off). Connection errors,
+timeouts, 429s and 5xx answers are retried up to FETCH_MAX_ATTEMPTS times in
+all, after a jittered exponential backoff (or the Retry-After the host asked
+for). CIRCUIT_FAILURE_THRESHOLD failures in a row open the host's circuit: its
+remaining URLs fail straight away instead of each waiting out a timeout, until
+CIRCUIT_RESET_SECONDS later a single probe request is let through to see if the
+host has recovered."""
+from os import environ as ENV
+import logging
+import threading
+import time
+from typing import Callable
+
+import requests
+
+from metrics import increment
+from rate_limiter import CircuitBreaker, TokenBucket, get_backoff_delay
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+HOSTS = {}
+HOSTS_LOCK = threading.Lock()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request to a host whose circuit is open."""
+
+
+def get_host(host: str) -> dict:
+    """Returns the limiter, breaker and stats of a host, creating them on first use."""
+    with HOSTS_LOCK:
+        if host not in HOSTS:
+            rate = float(ENV.get("HOST_RATE_LIMIT", "10"))
+            HOSTS[host] = {
+                "limiter": TokenBucket(rate, float(ENV.get("HOST_BURST", "0")) or None)
+                if rate else None,
+                "breaker": CircuitBreaker(int(ENV.get("CIRCUIT_FAILURE_THRESHOLD", "5")),
+                                          float(ENV.get("CIRCUIT_RESET_SECONDS", "30"))),
+                "stats": {"requests": 0, "successes": 0, "failures": 0, "retries": 0,
+                          "rejected": 0, "latency_seconds": 0.0, "max_latency_seconds": 0.0}}
+        return HOSTS[host]
+
+
+def record(host: dict, **changes) -> None:
+    """Adds changes to a host's stats."""
+    with HOSTS_LOCK:
+        for stat, value in changes.items():
+            host["stats"][stat] += value
+
+
+def get_retry_delay(response: requests.Response, attempt: int) -> float:
+    """Returns how long to wait before retrying: the Retry-After seconds the host
+    asked for if any, otherwise a jittered exponential backoff."""
+    cap = float(ENV.get("FETCH_BACKOFF_CAP", "10"))
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), cap)
+    return get_backoff_delay(attempt, float(ENV.get("FETCH_BACKOFF_BASE", "0.5")), cap)
+
+
+def guarded_request(host_name: str,
+                    send: Callable[[], requests.Response]) -> requests.Response:
+    """Sends a request to host_name with send(), throttled, retried and behind the
+    host's circuit breaker. Returns the last response, which may still be an error
+    status once the attempts run out. Raises CircuitOpenError if the circuit is
+    open, or the last connection error or timeout. Other request errors, such as
+    a malformed URL, are raised straight away without counting against the host."""
+    host = get_host(host_name)
+    max_attempts = int(ENV.get("FETCH_MAX_ATTEMPTS", "3"))
+
+    for attempt in range(max_attempts):
+        if not host["breaker"].allow():
+            record(host, rejected=1)
+            increment("fetch_circuit_open")
+            raise CircuitOpenError(f"Circuit open for {host_name}")
+        if host["limiter"]:
+            host["limiter"].acquire()
+
+        start = time.perf_counter()
+        response = error = None
+        try:
+            response = send()
+            failed = response.status_code in RETRY_STATUS_CODES
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error = e
+            failed = True
+        except requests.exceptions.RequestException:
+            host["breaker"].release()
+            raise
+        latency = time.perf_counter() - start
+
+        with HOSTS_LOCK:
+            stats = host["stats"]
+            stats["requests"] += 1
+            stats["latency_seconds"] += latency
+            stats["max_latency_seconds"] = max(stats["max_latency_seconds"], latency)
+            stats["failures" if failed else "successes"] += 1
+        if not failed:
+            host["breaker"].record_success()
+            return response
+        host["breaker"].record_failure()
+        if attempt == max_attempts - 1:
+            if error:
+                raise error
+            return response
+
+        record(host, retries=1)
+        increment("fetch_retries")
+        logging.warning("Retrying %s after attempt %s failed.", host_name, attempt + 1)
+        time.sleep(get_retry_delay(response, attempt))
+    return response
+
+
+def reset_hosts() -> None:
+    """Forgets every host's limiter, breaker and stats, ready for the next run."""
+    with HOSTS_LOCK:
+        HOSTS.clear()
+
+
+def get_host_stats() -> dict:
+    """Returns a copy of each host's stats with its success rate, average latency
+    and circuit state."""
+    with HOSTS_LOCK:
+        hosts = {name: (dict(host["stats"]), host["breaker"]) for name, host in HOSTS.items()}
+    report = {}
+    for name, (stats, breaker) in hosts.items():
+        requests_sent = stats["requests"]
+        report[name] = {
+            **stats,
+            "success_rate": stats["successes"] / requests_sent if requests_sent else None,
+            "average_latency_seconds": stats["latency_seconds"] / requests_sent
+            if requests_sent else None,
+            "circuit": breaker.state}
+    return report
+
+
+def log_host_stats() -> None:
+    """Logs how each host answered this run."""
+    for name, stats in get_host_stats().items():
+        logging.info(
+            "Host %s: %s requests, %s succeeded, %s failed, %s retries, %s rejected "
+            "by an open circuit, %.3fs average and %.3fs max latency, circuit %s.",
+            name, stats["requests"], stats["successes"], stats["failures"],
+            stats["retries"], stats["rejected"], stats["average_latency_seconds"] or 0,
+            stats["max_latency_seconds"], stats["circuit"])
@@ -0,0 +1,210 @@
+"""Pluggable HTML backends that find the handful of elements a scraper needs.
+
+Each target is a dict with a "name", a "tag" (None for any tag), the "attrs"
+it must have (True means the attribute only has to be present), and optionally
+"within", the name of an earlier target it has to be found inside of, and
+"attr", the attribute to return instead of the element's text.
+Both backends return {name: text (or attribute) of the first matching element, or None}."""
+from os import environ as ENV
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+CHUNK_SIZE = 16384
+
+ASCII_SPACES = str.maketrans("", "", "\x20\x0a\x09\x0c\x0d")
+
+PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+
+# Text inside these tags is kept apart from the page's text, as BeautifulSoup's
+# Script, Stylesheet, TemplateString and ruby strings: .text leaves it out of
+# every other element, and only counts it for an element of the same kind.
+STRING_CONTAINER_TAGS = {"script", "style", "template", "rt", "rp"}
+
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+                 "keygen", "link", "menuitem", "meta", "param", "source", "track",
+                 "wbr", "basefont", "bgsound", "command", "frame", "image",
+                 "isindex", "nextid", "spacer"}
+
+
+def attribute_matches(name: str, expected, actual: str) -> bool:
+    """Matches one attribute the way BeautifulSoup's find does."""
+    if actual is None:
+        return False
+    if expected is True:
+        return True
+    if name == "class":
+        return actual == expected or expected in actual.split()
+    return actual == expected
+
+
+def tag_matches(target: dict, tag: str, attributes: dict) -> bool:
+    """Checks a start tag against a target."""
+    if target["tag"] and target["tag"] != tag:
+        return False
+    return all(attribute_matches(name, expected, attributes.get(name))
+               for name, expected in target["attrs"].items())
+
+
+class TargetedParser(HTMLParser):
+    """Streams through a page, only keeping the text of the target elements.
+    Tags are opened and closed the same way BeautifulSoup's html.parser tree
+    builder does it, so the text matches what .text would return."""
+
+    def __init__(self, targets: list[dict]):
+        super().__init__(convert_charrefs=True)
+        self.targets = targets
+        self.stack = []
+        self.open_targets = {}
+        self.target_kinds = {}
+        self.containers = []
+        self.text = {}
+        self.found = {}
+        self.resolved = set()
+        self.pending_data = []
+
+    def flush_data(self, cdata: bool = False) -> None:
+        """Adds the text since the last tag to the open targets that would count
+        it, collapsing whitespace-only runs the way BeautifulSoup does. CDATA
+        sections count as ordinary text, even inside a string container."""
+        if not self.pending_data:
+            return
+        data = "".join(self.pending_data)
+        self.pending_data = []
+        if not data.translate(ASCII_SPACES) \
+                and not PRESERVE_WHITESPACE_TAGS.intersection(self.stack):
+            data = "\n" if "\n" in data else " "
+        kind = None if cdata or not self.containers else self.containers[-1][1]
+        for name in self.open_targets:
+            if self.target_kinds[name] == kind:
+                self.text[name].append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self.flush_data()
+        attributes = {name: value or "" for name, value in attrs}
+        for target in self.targets:
+            name = target["name"]
+            if name in self.resolved or name in self.open_targets:
+                continue
+            if target.get("within") and target["within"] not in self.open_targets:
+                continue
+            if not tag_matches(target, tag, attributes):
+                continue
+            if target.get("attr"):
+                self.found[name] = attributes.get(target["attr"])
+                self.resolved.add(name)
+            else:
+                self.open_targets[name] = len(self.stack)
+                self.target_kinds[name] = tag if tag in STRING_CONTAINER_TAGS else None
+                self.text[name] = []
+
+        if tag in VOID_ELEMENTS:
+            self.close_to(len(self.stack))
+        else:
+            if tag in STRING_CONTAINER_TAGS:
+                self.containers.append((len(self.stack), tag))
+            self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        self.flush_data()
+        if tag in VOID_ELEMENTS or tag not in self.stack:
+            return
+        depth = len(self.stack) - 1 - self.stack[::-1].index(tag)
+        del self.stack[depth:]
+        while self.containers and self.containers[-1][0] >= depth:
+            self.containers.pop()
+        self.close_to(depth)
+
+    def handle_data(self, data):
+        if self.open_targets:
+            self.pending_data.append(data)
+
+    def handle_comment(self, data):
+        self.flush_data()
+
+    def handle_decl(self, decl):
+        self.flush_data()
+
+    def handle_pi(self, data):
+        self.flush_data()
+
+    def unknown_decl(self, data):
+        self.flush_data()
+        if data.upper().startswith("CDATA[") and self.open_targets:
+            self.pending_data.append(data[len("CDATA["):])
+            self.flush_data(cdata=True)
+
+    def close_to(self, depth: int) -> None:
+        """Closes every open target at or below depth in the tag stack."""
+        closed = [name for name, open_depth in self.open_targets.items()
+                  if open_depth >= depth]
+        for name in closed:
+            del self.open_targets[name]
+            del self.target_kinds[name]
+            self.found[name] = "".join(self.text.pop(name))
+            self.resolved.add(name)
+
+        for target in self.targets:
+            if target.get("within") in closed:
+                self.resolved.add(target["name"])
+
+    def finish(self) -> None:
+        """Closes everything still open at the end of the page."""
+        self.close()
+        self.flush_data()
+        self.close_to(0)
+        self.resolved.update(target["name"] for target in self.targets)
+
+
+def find_elements_streaming(html_content: bytes, targets: list[dict],
+                            is_complete=None) -> dict:
+    """Finds the targets with a single streaming pass over the page.
+    Stops reading as soon as is_complete(found, resolved) is true, or by
+    default once every target has been found or ruled out."""
+    if isinstance(html_content, bytes):
+        html_content = html_content.decode("utf-8", errors="replace")
+    html_content = html_content or ""
+
+    names = {target["name"] for target in targets}
+    if is_complete is None:
+        def is_complete(_found, resolved):
+            return resolved >= names
+
+    parser = TargetedParser(targets)
+    for start in range(0, len(html_content), CHUNK_SIZE):
+        parser.feed(html_content[start:start + CHUNK_SIZE])
+        if is_complete(parser.found, parser.resolved):
+            break
+    else:
+        parser.finish()
+
+    return {name: parser.found.get(name) for name in names}
+
+
+def find_elements_with_soup(html_content: bytes, targets: list[dict]) -> dict:
+    """Finds the targets by building a full BeautifulSoup tree."""
+    soup = BeautifulSoup(html_content, 'html.parser')
+
+    elements = {}
+    for target in targets:
+        scope = elements.get(target["within"]) if target.get("within") else soup
+        elements[target["name"]] = scope.find(
+            target["tag"], attrs=target["attrs"]) if scope is not None else None
+
+    return {target["name"]: get_value(target, elements[target["name"]]) for target in targets}
+
+
+def get_value(target: dict, element) -> str:
+    """Returns the text, or the target's attribute, of a BeautifulSoup element."""
+    if element is None:
+        return None
+    if target.get("attr"):
+        return element.get(target["attr"])
+    return element.text
+
+
+def find_elements(html_content: bytes, targets: list[dict], is_complete=None) -> dict:
+    """Finds the targets with the backend chosen by PARSER_BACKEND ("fast" or "bs4")."""
+    if ENV.get("PARSER_BACKEND", "fast") == "bs4":
+        return find_elements_with_soup(html_content, targets)
+    return find_elements_streaming(html_content, targets, is_complete)
@@ -0,0 +1,162 @@
+"""Persistent HTTP validator (ETag / Last-Modified) cache for product pages.
+Unchanged pages are answered with a 304, so neither the download nor the parse is repeated.
+HTTP_CACHE_PATH should point at storage that outlives a task, such as an EFS mount,
+which several tasks may share. Entries for URLs no run has fetched in
+HTTP_CACHE_MAX_AGE_DAYS are dropped when the cache is saved."""
+from os import environ as ENV
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+NOT_MODIFIED = object()
+
+CACHE = {}
+CACHE_LOCK = threading.Lock()
+CACHE_STATS = {"hits": 0, "misses": 0, "bytes_downloaded": 0,
+               "bytes_saved": 0, "parse_seconds_saved": 0.0}
+
+
+def get_cache_path() -> str:
+    """Returns where the cache is kept between runs."""
+    return ENV.get("HTTP_CACHE_PATH", "/tmp/priceslashers_http_cache.json")
+
+
+def get_max_age_seconds() -> float:
+    """Returns how long an entry is kept after its URL was last fetched."""
+    return float(ENV.get("HTTP_CACHE_MAX_AGE_DAYS", "7")) * 24 * 60 * 60
+
+
+def load_cache() -> None:
+    """Loads the cache from disk and resets the per-run counters."""
+    with CACHE_LOCK:
+        CACHE.clear()
+        for stat in CACHE_STATS:
+            CACHE_STATS[stat] = 0
+        try:
+            with open(get_cache_path(), encoding="utf-8") as cache_file:
+                CACHE.update(json.load(cache_file))
+        except FileNotFoundError:
+            logging.info("No HTTP cache found at %s.", get_cache_path())
+        except (OSError, ValueError) as e:
+            logging.error("Ignoring unreadable HTTP cache: %s", e)
+
+
+def remove_stale_entries(entries: dict, now: float) -> dict:
+    """Returns the entries whose URL was fetched within the maximum age.
+    Entries saved before fetches were timed count as fetched now."""
+    oldest = now - get_max_age_seconds()
+    fresh = {}
+    for url, entry in entries.items():
+        entry.setdefault("seen_at", now)
+        if entry["seen_at"] >= oldest:
+            fresh[url] = entry
+    if len(fresh) < len(entries):
+        logging.info("Dropped %s stale HTTP cache entries.", len(entries) - len(fresh))
+    return fresh
+
+
+def save_cache() -> None:
+    """Writes the entries that have a parsed result back to disk, merged over the
+    entries other tasks sharing the file saved, without the stale ones. The file
+    is locked while it is merged and replaced through a temporary file of this
+    process's own, so concurrent saves never interleave or overwrite each other's
+    entries."""
+    with CACHE_LOCK:
+        entries = {url: entry for url, entry in CACHE.items()
+                   if entry.get("result")}
+    path = get_cache_path()
+    temporary_path = None
+    try:
+        with open(path + ".lock", "a", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(path, encoding="utf-8") as cache_file:
+                    entries = {**json.load(cache_file), **entries}
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                logging.error("Replacing unreadable HTTP cache: %s", e)
+            entries = remove_stale_entries(entries, time.time())
+            descriptor, temporary_path = tempfile.mkstemp(
+                dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".")
+            with os.fdopen(descriptor, "w", encoding="utf-8") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(temporary_path, path)
+    except OSError as e:
+        logging.error("Could not save HTTP cache: %s", e)
+        if temporary_path and os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def get_conditional_headers(url: str) -> dict:
+    """Returns If-None-Match/If-Modified-Since headers for a URL with a cached result."""
+    with CACHE_LOCK:
+        entry = CACHE.get(url)
+        if not entry or not entry.get("result"):
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+
+def record_response(url: str, etag: str, last_modified: str, size: int) -> None:
+    """Counts a full download and remembers its validators until the page is parsed."""
+    with CACHE_LOCK:
+        CACHE_STATS["misses"] += 1
+        CACHE_STATS["bytes_downloaded"] += size
+        if etag or last_modified:
+            CACHE[url] = {"etag": etag, "last_modified": last_modified,
+                          "size": size, "seen_at": time.time()}
+        else:
+            CACHE.pop(url, None)
+
+
+def record_not_modified(url: str) -> None:
+    """Counts a 304 response."""
+    with CACHE_LOCK:
+        entry = CACHE.get(url, {})
+        if entry:
+            entry["seen_at"] = time.time()
+        CACHE_STATS["hits"] += 1
+        CACHE_STATS["bytes_saved"] += entry.get("size", 0)
+        CACHE_STATS["parse_seconds_saved"] += entry.get("parse_seconds", 0.0)
+
+
+def store_result(url: str, result: dict, parse_seconds: float) -> None:
+    """Stores the parsed result of a freshly downloaded page."""
+    with CACHE_LOCK:
+        if url not in CACHE:
+            return
+        if result:
+            CACHE[url]["result"] = result
+            CACHE[url]["parse_seconds"] = parse_seconds
+        else:
+            del CACHE[url]
+
+
+def get_cached_result(url: str, product_id: int) -> dict:
+    """Returns a copy of the last parsed result for a URL."""
+    with CACHE_LOCK:
+        result = CACHE.get(url, {}).get("result")
+    if not result:
+        logging.error("No cached result for unmodified URL: %s", url)
+        return None
+    return {**result, "product_id": product_id}
+
+
+def log_cache_stats() -> None:
+    """Logs this run's hit/miss counters and what the hits saved."""
+    with CACHE_LOCK:
+        logging.info(
+            "HTTP cache: %s hits, %s misses, %s bytes downloaded, "
+            "%s bytes and %.2fs of parsing saved.",
+            CACHE_STATS["hits"], CACHE_STATS["misses"],
+            CACHE_STATS["bytes_downloaded"], CACHE_STATS["bytes_saved"],
+            CACHE_STATS["parse_seconds_saved"])
@@ -1,77 +1,192 @@
 """Uploads current price data to the RDS database triggered every 3 minutes"""
+from os import environ as ENV
 import logging
+import time
+from contextlib import closing
+from typing import Iterable
+import psycopg2
 from psycopg2.extensions import connection
-from dotenv import load_dotenv
-from connect_to_database import configure_logging, get_connection
+from psycopg2.extras import execute_values
+from connect_to_database import get_connection
+from metrics import increment, observe, timer
+from scheduler import get_schedule_mode, reschedule_products
 
+UPSERT_LATEST_PRICES_QUERY = """INSERT INTO product_latest_price (product_id, price, timestamp)
+            VALUES %s
+            ON CONFLICT (product_id) DO UPDATE
+            SET price = EXCLUDED.price, timestamp = EXCLUDED.timestamp
+            WHERE EXCLUDED.timestamp >= product_latest_price.timestamp;"""
 
-def insert_price_change(conn: connection, product_id: int, price: float, timestamp: str) -> None:
-    """Inserts values into price_changes schema"""
 
+def insert_price_changes_batch(conn: connection, batch: list[dict]) -> None:
+    """Inserts a whole batch of values into price_changes in one statement"""
     with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO price_changes (price, product_id, timestamp)
-            VALUES (%s, %s, %s);
-            """,
-            (price, product_id, timestamp)
-        )
-    logging.info("Inserted price for product_id %s", product_id)
+        execute_values(
+            cur,
+            "INSERT INTO price_changes (price, product_id, timestamp) VALUES %s;",
+            [(product["price"], product["product_id"], product["timestamp"])
+             for product in batch],
+            page_size=len(batch))
+
+
+def insert_rows_individually(conn: connection, batch: list[dict]) -> list[dict]:
+    """Inserts a batch row by row, each behind its own savepoint so a bad row
+    is skipped without aborting the transaction. Returns the rows inserted."""
+    inserted = []
+    for product in batch:
+        with conn.cursor() as cur:
+            cur.execute("SAVEPOINT price_row;")
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO price_changes (price, product_id, timestamp) VALUES (%s, %s, %s);",
+                    (product["price"], product["product_id"], product["timestamp"]))
+            inserted.append(product)
+        except psycopg2.Error:
+            with conn.cursor() as cur:
+                cur.execute("ROLLBACK TO SAVEPOINT price_row;")
+            logging.error("Failed to insert product data: %s", product)
+    return inserted
 
 
-def product_id_exists(conn: connection, product_id: int) -> bool:
-    """Checks products table to see if product_id exists."""
-    with conn.cursor() as db_cursor:
-        db_cursor.execute(
-            "SELECT * FROM product WHERE product_id = %s", (product_id,))
-        if db_cursor.fetchone():
-            return True
-        return False
+def load_batch(conn: connection, batch: list[dict]) -> list[dict]:
+    """Inserts a batch in one statement, falling back to row-by-row inserts
+    if the batch fails. Returns the rows inserted."""
+    with conn.cursor() as cur:
+        cur.execute("SAVEPOINT price_batch;")
+    try:
+        insert_price_changes_batch(conn, batch)
+        return batch
+    except psycopg2.Error as e:
+        with conn.cursor() as cur:
+            cur.execute("ROLLBACK TO SAVEPOINT price_batch;")
+        logging.error(
+            "Batch insert failed, loading %s rows one at a time: %s", len(batch), e)
+        return insert_rows_individually(conn, batch)
+
+
+def upsert_latest_prices(conn: connection, products_data: list[dict]) -> None:
+    """Updates product_latest_price with the newest of the given prices for each product"""
+    latest = {}
+    for product in products_data:
+        current = latest.get(product["product_id"])
+        if not current or product["timestamp"] >= current["timestamp"]:
+            latest[product["product_id"]] = product
 
+    with conn.cursor() as cur:
+        execute_values(
+            cur, UPSERT_LATEST_PRICES_QUERY,
+            [(product["product_id"], product["price"], product["timestamp"])
+             for product in latest.values()])
 
-def load_price_changes(products_data: list[dict], conn: connection) -> None:
-    """Loads cleaned price data into database."""
-    successfully_inserted = 0
 
+def bulk_load_price_changes(products_data: list[dict], conn: connection,
+                            batch_size: int = 1000) -> None:
+    """Loads cleaned price data into database in batches of batch_size rows."""
+    valid_products = []
     for product in products_data:
         if not all(key in product for key in ["product_id", "price", "timestamp"]):
             logging.error("Invalid product values: %s", product)
             continue
+        valid_products.append(product)
 
-        try:
-            insert_price_change(
-                conn,
-                product["product_id"],
-                product["price"],
-                product["timestamp"]
-            )
-            successfully_inserted += 1
-        except Exception as e:
-            logging.error("Failed to insert product data: %s", product)
-            continue
+    inserted_products = []
+    for start in range(0, len(valid_products), batch_size):
+        inserted_products.extend(load_batch(
+            conn, valid_products[start:start + batch_size]))
 
     try:
-        if successfully_inserted > 0:
+        if inserted_products:
+            upsert_latest_prices(conn, inserted_products)
             conn.commit()
+            increment("rows_inserted", len(inserted_products))
             logging.info(
-                "Data loaded successfully. %s rows committed.", successfully_inserted)
+                "Data loaded successfully. %s rows committed.", len(inserted_products))
         else:
             raise ValueError("No valid rows to commit.")
-    except ValueError as commit_error:
+    except (ValueError, psycopg2.Error) as commit_error:
         conn.rollback()
         logging.error("Load error during commit: %s", commit_error)
 
 
-def main_load(cleaned_data: list[dict]) -> None:
-    """Main function for loading price_changes values"""
-
-    with get_connection() as connection:
-        load_price_changes(cleaned_data, connection)
+def get_latest_prices(conn: connection, product_ids: list[int]) -> dict[int, float]:
+    """Returns the last stored price of each product as {product_id: price}"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT product_id, price
+            FROM product_latest_price
+            WHERE product_id = ANY(%s);
+            """,
+            (product_ids,)
+        )
+        return dict(cur.fetchall())
 
-    logging.info("Connection to database successfully closed.")
 
+def remove_unchanged_prices(products_data: list[dict], conn: connection) -> list[dict]:
+    """Drops products whose price is the same as their last stored price,
+    so price_changes only grows when a price actually moves."""
+    latest_prices = get_latest_prices(
+        conn, [product.get("product_id") for product in products_data])
 
-if __name__ == "__main__":
-    load_dotenv()
-    configure_logging()
-    main_load()
+    changed_products = []
+    for product in products_data:
+        product_id = product.get("product_id")
+        if product_id in latest_prices and latest_prices[product_id] == product.get("price"):
+            continue
+        latest_prices[product_id] = product.get("price")
+        changed_products.append(product)
+
+    increment("rows_unchanged", len(products_data) - len(changed_products))
+    logging.info("%s of %s prices have changed.",
+                 len(changed_products), len(products_data))
+    return changed_products
+
+
+def load_stream_batch(conn: connection, batch: list[dict], changes_only: bool,
+                      reschedule: bool = False) -> None:
+    """Loads one batch of a stream and commits it.
+    With reschedule, each product's next due time is set from its new price first."""
+    with timer("load_batch_seconds"):
+        if reschedule:
+            reschedule_products(conn, batch)
+        if changes_only:
+            batch = remove_unchanged_prices(batch, conn)
+        if batch:
+            bulk_load_price_changes(batch, conn, len(batch))
+
+
+def stream_load(cleaned_rows: Iterable[dict]) -> int:
+    """Loads rows as they arrive, committing every LOAD_BATCH_SIZE rows or once a
+    batch has waited LOAD_FLUSH_SECONDS, so only one batch is held in memory and
+    the first prices land before the scrape has finished. With the adaptive
+    SCRAPE_SCHEDULE each product is rescheduled as its batch is loaded.
+    Returns the number of rows received."""
+    batch_size = int(ENV.get("LOAD_BATCH_SIZE", "1000"))
+    flush_seconds = float(ENV.get("LOAD_FLUSH_SECONDS", "5"))
+    changes_only = ENV.get("LOAD_MODE", "changes") == "changes"
+    reschedule = get_schedule_mode() == "adaptive"
+    start = time.perf_counter()
+    received = 0
+    batch = []
+    batch_started = None
+
+    with closing(get_connection()) as conn:
+        for row in cleaned_rows:
+            received += 1
+            batch.append(row)
+            batch_started = batch_started or time.perf_counter()
+            if (len(batch) >= batch_size
+                    or time.perf_counter() - batch_started >= flush_seconds):
+                load_stream_batch(conn, batch, changes_only, reschedule)
+                if received == len(batch):
+                    observe("time_to_first_row_seconds", time.perf_counter() - start)
+                batch = []
+                batch_started = None
+        if batch:
+            load_stream_batch(conn, batch, changes_only, reschedule)
+            if received == len(batch):
+                observe("time_to_first_row_seconds", time.perf_counter() - start)
+
+    logging.info("Streamed %s rows into the database.", received)
+    return received
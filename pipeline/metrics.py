@@ -0,0 +1,143 @@
+"""Lightweight counters, timers and latency histograms for the pipeline.
+Recording a value is a dict update under a lock, so the overhead is a few
+microseconds per page against fetches that take tens of milliseconds.
+
+At the end of a run export_metrics writes everything out in the METRICS_FORMAT
+chosen: "json" (one structured log line), "emf" (CloudWatch embedded metric
+format, turned into metrics by CloudWatch Logs), "prometheus" (a textfile for
+node_exporter's textfile collector at METRICS_TEXTFILE_PATH) or "none"."""
+from os import environ as ENV
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+NAMESPACE = "PriceSlashers"
+
+COUNTERS = {}
+HISTOGRAMS = {}
+METRICS_LOCK = threading.Lock()
+
+
+def increment(name: str, value: float = 1) -> None:
+    """Adds value to a counter."""
+    with METRICS_LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+def observe(name: str, seconds: float) -> None:
+    """Records one duration in a histogram."""
+    with METRICS_LOCK:
+        histogram = HISTOGRAMS.get(name)
+        if histogram is None:
+            histogram = HISTOGRAMS[name] = {"count": 0, "sum": 0.0, "max": 0.0,
+                                            "buckets": [0] * len(BUCKETS)}
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["max"] = max(histogram["max"], seconds)
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][index] += 1
+                break
+
+
+@contextmanager
+def timer(name: str):
+    """Records how long the with block took in the name histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def reset_metrics() -> None:
+    """Clears every counter and histogram, ready for the next run."""
+    with METRICS_LOCK:
+        COUNTERS.clear()
+        HISTOGRAMS.clear()
+
+
+def get_snapshot() -> dict:
+    """Returns a copy of the counters and histograms."""
+    with METRICS_LOCK:
+        return {"counters": dict(COUNTERS),
+                "histograms": {name: {**histogram, "buckets": list(histogram["buckets"])}
+                               for name, histogram in HISTOGRAMS.items()}}
+
+
+def to_json_line(snapshot: dict) -> str:
+    """Formats a snapshot as one JSON log line."""
+    return json.dumps({"message": "pipeline metrics", **snapshot})
+
+
+def to_emf(snapshot: dict) -> str:
+    """Formats a snapshot in CloudWatch embedded metric format. Each histogram
+    becomes its count, average and maximum."""
+    values = {}
+    definitions = []
+    for name, value in snapshot["counters"].items():
+        values[name] = value
+        definitions.append({"Name": name, "Unit": "Count"})
+    for name, histogram in snapshot["histograms"].items():
+        values[f"{name}_count"] = histogram["count"]
+        values[f"{name}_avg"] = histogram["sum"] / histogram["count"]
+        values[f"{name}_max"] = histogram["max"]
+        definitions.extend([{"Name": f"{name}_count", "Unit": "Count"},
+                            {"Name": f"{name}_avg", "Unit": "Seconds"},
+                            {"Name": f"{name}_max", "Unit": "Seconds"}])
+    return json.dumps({
+        "_aws": {"Timestamp": int(time.time() * 1000),
+                 "CloudWatchMetrics": [{"Namespace": NAMESPACE,
+                                        "Dimensions": [["Pipeline"]],
+                                        "Metrics": definitions}]},
+        "Pipeline": ENV.get("METRICS_PIPELINE_NAME", "etl"),
+        **values})
+
+
+def to_prometheus(snapshot: dict) -> str:
+    """Formats a snapshot in the Prometheus text exposition format."""
+    lines = []
+    for name, value in sorted(snapshot["counters"].items()):
+        metric = f"priceslashers_{name}_total"
+        lines.extend([f"# TYPE {metric} counter", f"{metric} {value}"])
+    for name, histogram in sorted(snapshot["histograms"].items()):
+        metric = f"priceslashers_{name}"
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines.extend([f'{metric}_bucket{{le="+Inf"}} {histogram["count"]}',
+                      f"{metric}_sum {histogram['sum']}",
+                      f"{metric}_count {histogram['count']}"])
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(text: str, path: str) -> None:
+    """Replaces the textfile in one step so it is never read half written."""
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as textfile:
+        textfile.write(text)
+    os.replace(temporary_path, path)
+
+
+def export_metrics() -> None:
+    """Writes this run's metrics out in the METRICS_FORMAT chosen (json by default)."""
+    metrics_format = ENV.get("METRICS_FORMAT", "json")
+    snapshot = get_snapshot()
+    try:
+        if metrics_format == "json":
+            print(to_json_line(snapshot), flush=True)
+        elif metrics_format == "emf":
+            print(to_emf(snapshot), flush=True)
+        elif metrics_format == "prometheus":
+            write_textfile(to_prometheus(snapshot),
+                           ENV.get("METRICS_TEXTFILE_PATH", "/tmp/priceslashers.prom"))
+        elif metrics_format != "none":
+            logging.error("Unknown metrics format: %s", metrics_format)
+    except OSError as e:
+        logging.error("Could not export metrics: %s", e)
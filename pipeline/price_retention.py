@@ -0,0 +1,151 @@
+"""Keeps the partitioned price_changes table in shape in the RDS database.
+Raw prices older than RAW_RETENTION_MONTHS are rolled up into hourly and daily
+min/max/last prices before their monthly partition is dropped, hourly rollups
+older than HOURLY_RETENTION_MONTHS are deleted, and partitions are created
+ahead of time for the months to come. Rows that landed in the default partition
+because their month had no partition yet are moved into a new one for it."""
+from os import environ as ENV
+import logging
+import re
+from datetime import date, datetime, timezone
+
+from psycopg2 import sql
+from psycopg2.extensions import connection
+from dotenv import load_dotenv
+
+from connect_to_database import configure_logging, get_connection
+
+PARTITION_NAME = re.compile(r"^price_changes_(\d{4})_(\d{2})$")
+
+ROLLUP_QUERY = """INSERT INTO {rollup} (product_id, bucket, min_price, max_price, last_price)
+    SELECT product_id, date_trunc(%s, timestamp) AS bucket, MIN(price), MAX(price),
+    (ARRAY_AGG(price ORDER BY timestamp DESC))[1]
+    FROM {partition}
+    GROUP BY product_id, bucket
+    ON CONFLICT (product_id, bucket) DO UPDATE
+    SET min_price = LEAST({rollup}.min_price, EXCLUDED.min_price),
+    max_price = GREATEST({rollup}.max_price, EXCLUDED.max_price),
+    last_price = EXCLUDED.last_price;"""
+
+
+def add_months(month: date, months: int) -> date:
+    """Returns the first day of the month the given number of months away."""
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def get_partitions(conn: connection) -> dict:
+    """Returns {first day of month: partition name} for every monthly partition."""
+    with conn.cursor() as cur:
+        cur.execute("""SELECT c.relname FROM pg_inherits AS i
+            JOIN pg_class AS c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'price_changes'::regclass;""")
+        partitions = {}
+        for (name,) in cur.fetchall():
+            match = PARTITION_NAME.match(name)
+            if match:
+                partitions[date(int(match[1]), int(match[2]), 1)] = name
+        return partitions
+
+
+def get_expired_partitions(partitions: dict, today: date, retention_months: int) -> list:
+    """Returns the names of the partitions that only hold rows past retention, oldest first."""
+    cutoff = add_months(today.replace(day=1), -retention_months)
+    return [name for month, name in sorted(partitions.items())
+            if add_months(month, 1) <= cutoff]
+
+
+def roll_up_and_drop_partition(conn: connection, partition: str) -> None:
+    """Rolls a partition's rows into the hourly and daily tables, then drops it.
+    Both happen in one transaction, so a failure leaves the raw rows in place."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL TIME ZONE 'UTC';")
+            for rollup, unit in (("price_changes_hourly", "hour"),
+                                 ("price_changes_daily", "day")):
+                cur.execute(sql.SQL(ROLLUP_QUERY).format(
+                    rollup=sql.Identifier(rollup),
+                    partition=sql.Identifier(partition)), (unit,))
+            cur.execute(sql.SQL("DROP TABLE {};").format(
+                sql.Identifier(partition)))
+        conn.commit()
+        logging.info("Rolled up and dropped partition %s.", partition)
+    except Exception as e:
+        conn.rollback()
+        logging.error("Error rolling up partition %s: %s", partition, e)
+        raise
+
+
+def delete_old_hourly_rollups(conn: connection, today: date, retention_months: int) -> None:
+    """Deletes hourly rollups older than retention; the daily rollups are kept."""
+    cutoff = add_months(today.replace(day=1), -retention_months)
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM price_changes_hourly WHERE bucket < %s;",
+                    (datetime(cutoff.year, cutoff.month, 1, tzinfo=timezone.utc),))
+        logging.info("Removed %s hourly rollups before %s.", cur.rowcount, cutoff)
+    conn.commit()
+
+
+def create_future_partitions(conn: connection, today: date, months_ahead: int) -> None:
+    """Makes sure partitions exist for this month and the next months_ahead months."""
+    with conn.cursor() as cur:
+        for months in range(months_ahead + 1):
+            cur.execute("SELECT create_price_changes_partition(%s);",
+                        (add_months(today.replace(day=1), months),))
+    conn.commit()
+
+
+def move_default_partition_rows(conn: connection) -> None:
+    """Creates a partition for each month with rows in the default partition,
+    which moves those rows into it so they are rolled up and dropped in turn."""
+    with conn.cursor() as cur:
+        cur.execute("""SELECT DISTINCT date_trunc('month', timestamp AT TIME ZONE 'UTC')::DATE
+            FROM price_changes_default;""")
+        months = [month for (month,) in cur.fetchall()]
+        for month in months:
+            cur.execute("SELECT create_price_changes_partition(%s);", (month,))
+    conn.commit()
+    if months:
+        logging.warning("Moved rows for %s out of the default partition.",
+                        ", ".join(month.strftime("%Y-%m") for month in months))
+
+
+def main_retention(today: date = None) -> None:
+    """Main function that applies the retention policy to price_changes."""
+    today = today or datetime.now(timezone.utc).date()
+    raw_months = int(ENV.get("RAW_RETENTION_MONTHS", 3))
+    hourly_months = int(ENV.get("HOURLY_RETENTION_MONTHS", 12))
+    months_ahead = int(ENV.get("PARTITIONS_AHEAD", 3))
+
+    with get_connection() as conn:
+        create_future_partitions(conn, today, months_ahead)
+        move_default_partition_rows(conn)
+
+        expired = get_expired_partitions(get_partitions(conn), today, raw_months)
+        if not expired:
+            logging.info("No price_changes partitions past retention.")
+        for partition in expired:
+            roll_up_and_drop_partition(conn, partition)
+
+        delete_old_hourly_rollups(conn, today, hourly_months)
+
+
+def lambda_handler(event, context):
+    """Lambda handler function """
+    load_dotenv()
+    logging.info(f"Applying price retention at: {datetime.now()}.")
+    if event or context:
+        print("Event Triggered.")
+    try:
+        main_retention()
+        return {"status_code": 200, "message": "Successfully applied price retention."}
+    except Exception:
+        return {"status_code": 500,
+                "message": "Execution of price retention process was not successful."}
+
+
+if __name__ == "__main__":
+
+    load_dotenv()
+    configure_logging()
+    main_retention()
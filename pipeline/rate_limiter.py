@@ -0,0 +1,104 @@
+"""Rate limiting and retry backoff helpers shared by the outbound clients."""
+import random
+import threading
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing rate requests per second on average,
+    with bursts of up to capacity requests."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError(f"A token bucket needs a positive rate, not {rate}")
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self) -> None:
+        """Adds the tokens earned since the last refill."""
+        now = monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> float:
+        """Takes a token if one is free. Returns 0 if it did, otherwise
+        how many seconds until the next token is due."""
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> None:
+        """Blocks until a token is free, then takes it."""
+        wait = self.try_acquire()
+        while wait:
+            sleep(wait)
+            wait = self.try_acquire()
+
+
+class CircuitBreaker:
+    """Thread-safe circuit breaker. After failure_threshold failures in a row it
+    opens and turns calls away for reset_seconds, then lets a single probe through:
+    a success closes it again and a failure opens it for another reset_seconds."""
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Checks whether a call may go ahead. Every call allowed must be
+        followed by record_success, record_failure or release."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self) -> None:
+        """Closes the breaker."""
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release(self) -> None:
+        """Ends a call that says nothing about the service, such as one that was
+        never sent, letting another probe through if it was the probe."""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self) -> None:
+        """Counts a failure, opening the breaker once there are failure_threshold
+        in a row or when the probe fails."""
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+                self.probing = False
+
+    @property
+    def state(self) -> str:
+        """Returns "closed", "open" or "half-open"."""
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if self.probing or monotonic() - self.opened_at >= self.reset_seconds:
+                return "half-open"
+            return "open"
+
+
+def get_backoff_delay(attempt: int, base: float = 0.1, cap: float = 10.0) -> float:
+    """Returns a "full jitter" exponential backoff delay for a retry attempt (0-based)."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
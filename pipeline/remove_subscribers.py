@@ -1,72 +1,181 @@
-"""Removing products data that no longer have active subscriptions in the RDS database."""
+"""Removing products data that no longer have active subscriptions in the RDS database.
+
+Rows are deleted in chunks of PURGE_CHUNK_SIZE with a commit after each, so no
+lock is held for long. Every step only touches products that are still
+unsubscribed, and products are deleted last, so a run that stops part way
+(e.g. a Lambda running out of time) is simply picked up by the next run.
+The products are locked when they are deleted, together with any rows a
+concurrent ETL run added for them since their tables were purged."""
+from os import environ as ENV
 import logging
 from datetime import datetime
+from time import perf_counter
+from typing import Callable
 
+import psycopg2
 from psycopg2.extensions import connection
 from psycopg2.extras import DictCursor
 from dotenv import load_dotenv
 
 from connect_to_database import configure_logging, get_connection
 
-
-def get_product_ids_from_table(conn: connection, table_name: str, distinct: bool = False) -> set:
-    """Returns a set of product IDs based on specified schema."""
+# Tables referencing product, with the columns that identify one of their rows
+PURGE_TABLES = {
+    "price_changes": "price_id, timestamp",
+    "price_changes_hourly": "product_id, bucket",
+    "price_changes_daily": "product_id, bucket",
+    "notifications_sent": "notification_id",
+    "product_latest_price": "product_id",
+    "product_lease": "product_id",
+    "onboarding_job": "job_id",
+}
+
+UNSUBSCRIBED = """NOT EXISTS (
+        SELECT 1 FROM subscription AS s
+        WHERE s.product_id = {alias}.product_id)"""
+
+UNSUBSCRIBED_PRODUCTS_QUERY = f"""SELECT p.product_id FROM product AS p
+            WHERE {UNSUBSCRIBED.format(alias="p")}
+            ORDER BY p.product_id
+            LIMIT %s;"""
+
+LOCK_PRODUCTS_QUERY = f"""SELECT p.product_id FROM product AS p
+                WHERE p.product_id = ANY(%s)
+                AND {UNSUBSCRIBED.format(alias="p")}
+                FOR UPDATE;"""
+
+
+def get_delete_chunk_query(table_name: str) -> str:
+    """Returns the statement deleting one chunk of a table's unsubscribed rows."""
+    key = PURGE_TABLES[table_name]
+    return f"""DELETE FROM {table_name} WHERE ({key}) IN (
+            SELECT {key} FROM {table_name} AS t
+            WHERE t.product_id = ANY(%s)
+            AND {UNSUBSCRIBED.format(alias="t")}
+            LIMIT %s);"""
+
+
+def get_unsubscribed_product_ids(conn: connection, limit: int) -> list:
+    """Returns up to limit product IDs that no subscription refers to."""
+    with conn.cursor() as cur:
+        cur.execute(UNSUBSCRIBED_PRODUCTS_QUERY, (limit,))
+        return [row[0] for row in cur.fetchall()]
+
+
+def delete_chunk(conn: connection, table_name: str, product_ids: list, chunk_size: int) -> int:
+    """Deletes up to chunk_size rows of unsubscribed products from a table and commits.
+    Returns the number of rows deleted."""
+    with conn.cursor() as cur:
+        cur.execute(get_delete_chunk_query(table_name), (product_ids, chunk_size))
+        deleted = cur.rowcount
+    conn.commit()
+    return deleted
+
+
+def purge_table(conn: connection, table_name: str, product_ids: list,
+                chunk_size: int, out_of_time) -> tuple[int, bool]:
+    """Deletes a table's rows for the products chunk by chunk until none are left
+    or out_of_time() is true. Returns (rows deleted, whether the table is done)."""
+    deleted = 0
+    while not out_of_time():
+        chunk = delete_chunk(conn, table_name, product_ids, chunk_size)
+        deleted += chunk
+        if chunk < chunk_size:
+            return deleted, True
+    return deleted, False
+
+
+def delete_products(conn: connection, product_ids: list) -> int:
+    """Deletes the products that are still unsubscribed in one transaction.
+    Their rows are locked first, so a concurrent ETL run cannot add a price for
+    them, then any rows added since their tables were purged are deleted with
+    them. Returns the number of products deleted, or None if they could not be
+    deleted yet and were left for the next run."""
     try:
         with conn.cursor() as cur:
-            add_distinct = "DISTINCT" if distinct else ""
-            query = f"""SELECT {add_distinct} product_id FROM {table_name};"""
-            cur.execute(query)
-            return {row[0] for row in cur.fetchall()}
-    except Exception as e:
-        logging.error(f"Error fetching from {table_name}: %s", e)
-        return set()
-
-
-def delete_from_table(cur: DictCursor, table_name: str, product_ids: list) -> None:
-    """Deletes records from the RDS based on given schema name and product IDs."""
-    query = f"""DELETE FROM {table_name} WHERE product_id = ANY(%s);"""
-    cur.execute(query, (product_ids,))
-    logging.info(f"Removed records from {table_name}: %s", product_ids)
+            cur.execute(LOCK_PRODUCTS_QUERY, (product_ids,))
+            locked_ids = [row[0] for row in cur.fetchall()]
+            leftover = 0
+            for table_name in PURGE_TABLES:
+                cur.execute(f"DELETE FROM {table_name} WHERE product_id = ANY(%s);",
+                            (locked_ids,))
+                leftover += cur.rowcount
+            cur.execute("DELETE FROM product WHERE product_id = ANY(%s);", (locked_ids,))
+            deleted = cur.rowcount
+            clean_websites(cur)
+        conn.commit()
+    except psycopg2.errors.ForeignKeyViolation as e:
+        conn.rollback()
+        logging.warning("Leaving products %s for the next run: %s", product_ids, e)
+        return None
+    if leftover:
+        logging.info("Removed %s rows added while the products were being purged.", leftover)
+    return deleted
 
 
 def clean_websites(cur: DictCursor) -> None:
     """Removes websites not referenced in product table."""
-    query = """DELETE FROM website
-    WHERE website_id NOT IN (
-        SELECT DISTINCT website_id
-        FROM product);"""
+    query = """DELETE FROM website AS w
+    WHERE NOT EXISTS (
+        SELECT 1 FROM product AS p
+        WHERE p.website_id = w.website_id);"""
     cur.execute(query)
     logging.info("Unused websites have been removed.")
 
 
-def delete_unsubscribed_data(conn: connection, unsubscribed_product_ids: list) -> None:
-    """Deletes data for unsubscribed products from price changes and product tables."""
-    try:
-        with conn.cursor() as cur:
-            delete_from_table(cur, "price_changes", unsubscribed_product_ids)
-            delete_from_table(cur, "product", unsubscribed_product_ids)
-            clean_websites(cur)
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        logging.error("Error deleting unsubscribed data: %s", e)
+def main_remove_subscriptions(time_left=None) -> dict:
+    """Main function that removes unsubscribed products data. time_left, if given,
+    returns the seconds left to run; the purge stops PURGE_TIME_MARGIN seconds
+    before it runs out. Returns the rows deleted per table and whether it finished."""
+    chunk_size = int(ENV.get("PURGE_CHUNK_SIZE", 5000))
+    products_per_pass = int(ENV.get("PURGE_PRODUCTS_PER_PASS", 100))
+    margin = float(ENV.get("PURGE_TIME_MARGIN", 30))
 
+    def out_of_time() -> bool:
+        return time_left is not None and time_left() < margin
 
-def main_remove_subscriptions() -> None:
-    """Main function that removes unsubscribed products data."""
+    deleted = {table_name: 0 for table_name in [*PURGE_TABLES, "product"]}
+    start = perf_counter()
+    finished = True
     with get_connection() as conn:
-        active_subscriptions = get_product_ids_from_table(
-            conn, "subscription", distinct=True)
-        all_products = get_product_ids_from_table(
-            conn, "product")
-        unsubscribed_product_ids = list(all_products - active_subscriptions)
+        while True:
+            if out_of_time():
+                finished = False
+                break
+            product_ids = get_unsubscribed_product_ids(conn, products_per_pass)
+            if not product_ids:
+                break
+            for table_name in PURGE_TABLES:
+                rows, done = purge_table(
+                    conn, table_name, product_ids, chunk_size, out_of_time)
+                deleted[table_name] += rows
+                if not done:
+                    finished = False
+                    break
+            if not finished:
+                break
+            products = delete_products(conn, product_ids)
+            if products is None:
+                finished = False
+                break
+            deleted["product"] += products
+
+    elapsed = perf_counter() - start
+    total = sum(deleted.values())
+    logging.info("Removed %s rows in %.1fs (%.0f rows/s): %s", total, elapsed,
+                 total / elapsed if elapsed else 0, deleted)
+    if not finished:
+        logging.info("Ran out of time; the next run will carry on from here.")
+    logging.info("Connection to database successfully closed.")
+    return {"deleted": deleted, "finished": finished}
 
-        if unsubscribed_product_ids:
-            delete_unsubscribed_data(conn, unsubscribed_product_ids)
-        else:
-            logging.info("No unsubscribed products to remove.")
 
-    logging.info("Connection to database successfully closed.")
+def get_time_left(context) -> Callable[[], float]:
+    """Returns a function giving the seconds the Lambda has left, or None
+    outside of Lambda."""
+    if not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return lambda: context.get_remaining_time_in_millis() / 1000
 
 
 def lambda_handler(event, context):
@@ -76,8 +185,10 @@ def lambda_handler(event, context):
     if event or context:
         print("Event Triggered.")
     try:
-        main_remove_subscriptions()
-        return {"status_code": 200, "message": "Successfully removed subscribers."}
+        result = main_remove_subscriptions(get_time_left(context))
+        message = "Successfully removed subscribers." if result["finished"] \
+            else "Partially removed subscribers, the next run will continue."
+        return {"status_code": 200, "message": message, "deleted": result["deleted"]}
     except:
         return {"status_code": 500,
                 "message": "Execution of subscription removal process was not successful."}
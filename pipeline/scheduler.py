@@ -0,0 +1,92 @@
+"""Decides when each product is next due to be scraped, so a run only fetches
+the products that are due instead of the whole catalogue.
+
+Each product's interval_seconds in product_lease adapts to how its price behaves:
+- when the price moved since the last scrape, the interval shrinks SCRAPE_SPEEDUP times,
+- when it did not, the interval grows SCRAPE_BACKOFF times,
+- when the price is within SCRAPE_NEAR_FRACTION of a subscriber's notification
+  price, the product is scraped every SCRAPE_INTERVAL_SECONDS so the alert goes
+  out as soon as the price crosses it.
+Intervals stay between SCRAPE_INTERVAL_SECONDS and SCRAPE_MAX_INTERVAL_SECONDS.
+SCRAPE_SCHEDULE=fixed scrapes every product on every run instead."""
+from os import environ as ENV
+import logging
+
+from psycopg2.extensions import connection
+from psycopg2.extras import execute_values
+
+from metrics import increment
+
+SCHEDULE_STATE_QUERY = """SELECT s.product_id, l.interval_seconds, lp.price,
+        (SELECT MAX(sub.notification_price) FROM subscription AS sub
+         WHERE sub.product_id = s.product_id AND sub.notification_price <= s.price)
+    FROM (VALUES %s) AS s (product_id, price)
+    LEFT JOIN product_lease AS l ON l.product_id = s.product_id
+    LEFT JOIN product_latest_price AS lp ON lp.product_id = s.product_id;"""
+
+SAVE_SCHEDULE_QUERY = """INSERT INTO product_lease (product_id, interval_seconds, due_at) VALUES %s
+    ON CONFLICT (product_id) DO UPDATE
+    SET interval_seconds = EXCLUDED.interval_seconds, due_at = EXCLUDED.due_at;"""
+
+SAVE_SCHEDULE_TEMPLATE = "(%s, %s, NOW() + make_interval(secs => %s))"
+
+
+def get_schedule_mode() -> str:
+    """Returns the SCRAPE_SCHEDULE chosen, rejecting unknown schedules."""
+    mode = ENV.get("SCRAPE_SCHEDULE", "adaptive")
+    if mode not in ("adaptive", "fixed"):
+        raise ValueError(f"Unknown scrape schedule: {mode}")
+    return mode
+
+
+def get_schedule_settings() -> dict:
+    """Reads the adaptive schedule's limits and rates."""
+    settings = {"min_seconds": float(ENV.get("SCRAPE_INTERVAL_SECONDS", "150")),
+                "max_seconds": float(ENV.get("SCRAPE_MAX_INTERVAL_SECONDS", "21600")),
+                "backoff": float(ENV.get("SCRAPE_BACKOFF", "1.5")),
+                "speedup": float(ENV.get("SCRAPE_SPEEDUP", "4")),
+                "near_fraction": float(ENV.get("SCRAPE_NEAR_FRACTION", "0.1"))}
+    if not 0 < settings["min_seconds"] <= settings["max_seconds"]:
+        raise ValueError("SCRAPE_INTERVAL_SECONDS must be positive and at most "
+                         "SCRAPE_MAX_INTERVAL_SECONDS")
+    return settings
+
+
+def next_interval(interval: float, old_price: float, new_price: float,
+                  notification_price: float, settings: dict) -> float:
+    """Returns how many seconds until a product that was just scraped at new_price
+    is due again. interval and old_price are from the previous scrape (None before
+    the first one) and notification_price is the highest one it has not fallen below."""
+    if notification_price is not None \
+            and new_price - notification_price <= settings["near_fraction"] * new_price:
+        return settings["min_seconds"]
+    if interval is None or old_price is None:
+        return settings["min_seconds"]
+
+    if new_price != old_price:
+        interval /= settings["speedup"]
+    else:
+        interval *= settings["backoff"]
+    return min(max(interval, settings["min_seconds"]), settings["max_seconds"])
+
+
+def reschedule_products(conn: connection, rows: list[dict]) -> None:
+    """Sets each scraped product's next due time from its new price and commits.
+    Must run before the new prices are written to product_latest_price."""
+    if not rows:
+        return
+    settings = get_schedule_settings()
+    scraped = {row["product_id"]: row["price"] for row in rows}
+
+    with conn.cursor() as cur:
+        state = execute_values(cur, SCHEDULE_STATE_QUERY, list(scraped.items()), fetch=True)
+        schedule = []
+        for product_id, interval, old_price, notification_price in state:
+            seconds = next_interval(interval, old_price, scraped[product_id],
+                                    notification_price, settings)
+            schedule.append((product_id, seconds, seconds))
+        execute_values(cur, SAVE_SCHEDULE_QUERY, schedule, template=SAVE_SCHEDULE_TEMPLATE)
+    conn.commit()
+
+    increment("products_rescheduled", len(schedule))
+    logging.info("Rescheduled %s products.", len(schedule))
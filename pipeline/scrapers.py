@@ -0,0 +1,189 @@
+"""The retailer scrapers, shared by the ETL pipeline and the dashboard.
+
+Each scraper is registered for the hosts it understands, together with the
+fields it can extract. Callers ask scrape_product for either PRICE_FIELDS, the
+fast path the ETL takes on every run, or METADATA_FIELDS, which also finds the
+image and description the dashboard stores when a product is first tracked.
+Picking a scraper is a single dict lookup on the URL's host."""
+import logging
+from typing import Callable
+from urllib.parse import urlparse
+
+from html_parsers import find_elements
+
+PRICE_FIELDS = frozenset({"product_name", "original_price", "discount_price"})
+METADATA_FIELDS = PRICE_FIELDS | {"image_url", "product_description"}
+
+DEBENHAMS_TARGETS = [
+    {"name": "product_title", "tag": "h1", "attrs": {"class": "text-xl"}},
+    {"name": "current_price", "tag": "span",
+     "attrs": {"data-test-id": "product-price-current"}},
+    {"name": "original_price", "tag": "span",
+     "attrs": {"data-test-id": "product-price-was"}},
+]
+
+DEBENHAMS_METADATA_TARGETS = [
+    {"name": "product_description", "tag": "div", "attrs": {"class": "prose"}},
+    {"name": "image_url", "tag": "img",
+     "attrs": {"class": "h-auto w-auto object-cover undefined undefined"}, "attr": "src"},
+]
+
+STEAM_TARGETS = [
+    {"name": "purchase_area", "tag": None,
+     "attrs": {"id": "game_area_purchase"}},
+    {"name": "original_price", "tag": "div",
+     "attrs": {"class": "discount_original_price"}, "within": "purchase_area"},
+    {"name": "discount_price", "tag": "div",
+     "attrs": {"class": "discount_final_price"}, "within": "purchase_area"},
+    {"name": "game_title", "tag": None,
+     "attrs": {"id": "appHubAppName", "class": "apphub_AppName"}},
+    {"name": "regular_price", "tag": "div",
+     "attrs": {"class": "game_purchase_price price", "data-price-final": True}},
+]
+
+STEAM_METADATA_TARGETS = [
+    {"name": "product_description", "tag": "div",
+     "attrs": {"class": "game_description_snippet"}},
+    {"name": "image_url", "tag": "img",
+     "attrs": {"class": "game_header_image_full"}, "attr": "src"},
+]
+
+SCRAPERS = {}
+
+
+def register_scraper(hosts: tuple[str], fields: frozenset) -> Callable:
+    """Registers the decorated scraper for every host in hosts, declaring the
+    fields it can extract. Scrapers are called as scraper(html_content, url, fields)."""
+    def register(scraper: Callable) -> Callable:
+        for host in hosts:
+            SCRAPERS[host] = {"scrape": scraper, "fields": fields}
+        return scraper
+    return register
+
+
+def get_scraper(url: str) -> dict:
+    """Returns the scraper registered for the URL's host, or None."""
+    return SCRAPERS.get(urlparse(url).netloc.lower())
+
+
+def get_website_from_url(url: str) -> str:
+    """ Gets a main website address from a given URL """
+    website_url = url
+    if ".com" in url:
+        website_url = url.split(".com")[0] + ".com"
+    elif ".co.uk" in url:
+        website_url = url.split(".co.uk")[0] + ".co.uk"
+    return website_url
+
+
+def scrape_product(html_content: bytes, url: str, fields: frozenset = PRICE_FIELDS) -> dict:
+    """Scrapes fields from a product page with the scraper registered for its host.
+    Returns None if the page cannot be scraped."""
+    scraper = get_scraper(url)
+    if scraper is None:
+        logging.error("Cannot scrape %s, since no scraper is registered for its website.", url)
+        return None
+    if not fields <= scraper["fields"]:
+        raise ValueError(
+            f"The scraper for {url} cannot extract {sorted(fields - scraper['fields'])}")
+    return scraper["scrape"](html_content, url, fields)
+
+
+def wants_metadata(fields: frozenset) -> bool:
+    """Checks whether fields asks for more than the price fields."""
+    return not fields <= PRICE_FIELDS
+
+
+def add_metadata(product_information: dict, elements: dict, url: str,
+                 missing_description: str = None) -> dict:
+    """Adds the image and description found on a full metadata scrape, using
+    missing_description when the page has no description."""
+    for field in ("image_url", "product_description"):
+        if elements[field] is None:
+            logging.error("Cannot find %s element for URL: %s", field, url)
+        product_information[field] = elements[field].strip() if elements[field] else None
+    if product_information["product_description"] is None:
+        product_information["product_description"] = missing_description
+    return product_information
+
+
+@register_scraper(("www.debenhams.com",), METADATA_FIELDS)
+def scrape_from_debenhams_html(html_content: bytes, url: str,
+                               fields: frozenset = PRICE_FIELDS) -> dict:
+    """Scrapes product, price and website information from Debenhams."""
+    targets = DEBENHAMS_TARGETS
+    if wants_metadata(fields):
+        targets = DEBENHAMS_TARGETS + DEBENHAMS_METADATA_TARGETS
+    elements = find_elements(html_content, targets)
+
+    if elements["product_title"] is None:
+        logging.error("Cannot find product title on the page for URL: %s", url)
+        return None
+
+    if elements["current_price"] is None:
+        logging.error("Cannot find current price element for URL: %s", url)
+        return None
+
+    if elements["original_price"] is None:
+        logging.error("Cannot find original price element for URL: %s", url)
+        elements["original_price"] = elements["current_price"]
+
+    product_information = {
+        "original_price": elements["original_price"].strip(),
+        "discount_price": elements["current_price"].strip(),
+        "product_name": elements["product_title"].strip(),
+        "website": get_website_from_url(url)}
+
+    if wants_metadata(fields):
+        if elements["product_description"] is None:
+            logging.error("Cannot find product_description element for URL: %s", url)
+            return None
+        add_metadata(product_information, elements, url)
+    return product_information
+
+
+def steam_elements_complete(found: dict, resolved: set) -> bool:
+    """Lets the streaming parser stop once the Steam title and prices are settled.
+    The page-wide regular price is only needed when there is no discount."""
+    if not {"purchase_area", "original_price", "discount_price", "game_title"} <= resolved:
+        return False
+    return ("original_price" in found and "discount_price" in found) \
+        or "regular_price" in resolved
+
+
+@register_scraper(("store.steampowered.com",), METADATA_FIELDS)
+def scrape_from_steam_html(html_content: bytes, url: str,
+                           fields: frozenset = PRICE_FIELDS) -> dict:
+    """Scrapes product, price and website information from Steam.
+    The price only path stops reading the page as soon as the prices are settled."""
+    if wants_metadata(fields):
+        elements = find_elements(html_content, STEAM_TARGETS + STEAM_METADATA_TARGETS)
+    else:
+        elements = find_elements(html_content, STEAM_TARGETS, steam_elements_complete)
+
+    if elements["purchase_area"] is None:
+        logging.error("Can't scrape that Steam URL.")
+        return None
+
+    if elements["game_title"] is None:
+        logging.error("Cannot find product title on the page for URL: %s", url)
+        return None
+
+    if elements["original_price"] is not None and elements["discount_price"] is not None:
+        original_price = elements["original_price"].strip()
+        discount_price = elements["discount_price"].strip()
+    elif elements["regular_price"] is not None:
+        original_price = elements["regular_price"].strip()
+        discount_price = original_price
+    else:
+        original_price = "N/A"
+        discount_price = "N/A"
+
+    product_information = {"original_price": original_price,
+                           "discount_price": discount_price,
+                           "product_name": elements["game_title"].strip(),
+                           "website": get_website_from_url(url)}
+
+    if wants_metadata(fields):
+        add_metadata(product_information, elements, url, "No description found.")
+    return product_information
@@ -0,0 +1,133 @@
+"""Lets several ETL workers share the product catalogue.
+
+ETL_SHARD_MODE picks how the catalogue is split:
+- "none" (the default): one worker scrapes every product.
+- "modulo": worker ETL_SHARD_INDEX of ETL_SHARD_COUNT scrapes the products whose
+  product_id % ETL_SHARD_COUNT is its index. Shards never overlap and need no
+  coordination, but a crashed worker's shard waits for that worker's next run.
+- "lease": workers claim batches of due products from product_lease with
+  FOR UPDATE SKIP LOCKED, so any number of workers can run without configuration.
+  A claim lasts LEASE_SECONDS; if a worker crashes its products are reclaimed by
+  another worker once the lease runs out."""
+from os import environ as ENV
+from contextlib import contextmanager
+import logging
+import os
+import socket
+from typing import Iterator
+
+from psycopg2.extensions import connection
+
+from connect_to_database import get_connection
+
+NOTIFY_LOCK_KEY = 8_120_001
+
+SYNC_LEASES_QUERY = """INSERT INTO product_lease (product_id)
+    SELECT product_id FROM product
+    ON CONFLICT (product_id) DO NOTHING;"""
+
+CLAIM_QUERY = """UPDATE product_lease AS l
+    SET leased_by = %s, leased_until = NOW() + make_interval(secs => %s)
+    FROM product AS p
+    WHERE p.product_id = l.product_id
+    AND l.product_id IN (
+        SELECT product_id FROM product_lease
+        WHERE due_at <= NOW() AND (leased_until IS NULL OR leased_until < NOW())
+        ORDER BY due_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED)
+    RETURNING l.product_id, p.url;"""
+
+COMPLETE_QUERY = """UPDATE product_lease
+    SET due_at = GREATEST(due_at, NOW() + make_interval(secs => %s)),
+        leased_until = NULL, leased_by = NULL
+    WHERE product_id = ANY(%s) AND leased_by = %s;"""
+
+
+def get_shard_mode() -> str:
+    """Returns the ETL_SHARD_MODE chosen, rejecting unknown modes."""
+    mode = ENV.get("ETL_SHARD_MODE", "none")
+    if mode not in ("none", "modulo", "lease"):
+        raise ValueError(f"Unknown shard mode: {mode}")
+    return mode
+
+
+def get_shard() -> tuple[int, int]:
+    """Returns (shard count, shard index) for the modulo mode."""
+    shard_count = int(ENV.get("ETL_SHARD_COUNT", "1"))
+    shard_index = int(ENV.get("ETL_SHARD_INDEX", "0"))
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f"Invalid shard {shard_index} of {shard_count}")
+    return shard_count, shard_index
+
+
+def get_worker_id() -> str:
+    """Names this worker in the leases it holds."""
+    return ENV.get("ETL_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def sync_leases(conn: connection) -> None:
+    """Gives products added since the last run a lease row, due straight away."""
+    with conn.cursor() as cur:
+        cur.execute(SYNC_LEASES_QUERY)
+    conn.commit()
+
+
+def claim_products(conn: connection, worker_id: str, limit: int,
+                   lease_seconds: float) -> list[list[int, str]]:
+    """Leases up to limit due products that no other worker holds.
+    Returns them as [id, url] pairs."""
+    with conn.cursor() as cur:
+        cur.execute(CLAIM_QUERY, (worker_id, lease_seconds, limit))
+        claimed = [list(row) for row in cur.fetchall()]
+    conn.commit()
+    return claimed
+
+
+def complete_products(conn: connection, worker_id: str, product_ids: list[int],
+                      interval_seconds: float) -> int:
+    """Releases this worker's leases and makes the products due again in
+    interval_seconds, unless the scheduler has already set a later due time.
+    Leases that expired and were taken over are left alone.
+    Returns the number of leases released."""
+    with conn.cursor() as cur:
+        cur.execute(COMPLETE_QUERY, (interval_seconds, product_ids, worker_id))
+        completed = cur.rowcount
+    conn.commit()
+    return completed
+
+
+def leased_url_batches(worker_id: str = None) -> Iterator[list[list[int, str]]]:
+    """Yields batches of LEASE_BATCH_SIZE claimed [id, url] pairs until nothing is due.
+    Each batch is completed when the next one is asked for, so a batch whose
+    processing raises keeps its lease until it expires and another worker retries it."""
+    worker_id = worker_id or get_worker_id()
+    batch_size = int(ENV.get("LEASE_BATCH_SIZE", "100"))
+    lease_seconds = float(ENV.get("LEASE_SECONDS", "120"))
+    interval_seconds = float(ENV.get("SCRAPE_INTERVAL_SECONDS", "150"))
+
+    conn = get_connection()
+    try:
+        sync_leases(conn)
+        while batch := claim_products(conn, worker_id, batch_size, lease_seconds):
+            logging.info("Worker %s claimed %s products.", worker_id, len(batch))
+            yield batch
+            complete_products(conn, worker_id, [product_id for product_id, _ in batch],
+                              interval_seconds)
+    finally:
+        conn.close()
+
+
+@contextmanager
+def advisory_lock(key: int) -> Iterator[bool]:
+    """Tries to take a session-level Postgres advisory lock without waiting.
+    Yields whether it was taken; it is released when the block ends."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s);", (key,))
+            acquired = cur.fetchone()[0]
+        yield acquired
+    finally:
+        conn.close()
@@ -5,15 +5,66 @@ from unittest import mock
 from unittest.mock import MagicMock, patch
 import pytest
 from boto3.exceptions import Boto3Error
+import threading
+import time
+from botocore.exceptions import ClientError
 from email_notifier import (
     get_ses_client,
-    get_subscriptions_and_products,
+    get_pending_notifications,
     send_email,
     check_and_notify,
-    has_notification_been_sent,
-    log_notification_sent
+    log_notifications_sent,
+    send_notifications,
+    get_notification_batches
 )
 
+SES_ENV = {
+    "FROM_EMAIL": "test@example.com",
+    "AWS_ACCESS_KEY_ID": "fake_key_id",
+    "AWS_SECRET_ACCESS_KEY": "fake_secret_key",
+    "SES_MAX_SEND_RATE": "1000000"
+}
+
+
+class FakeSESClient:
+    """Thread-safe stand-in for the SES client that records what it was asked to send."""
+
+    def __init__(self, throttle_first: int = 0):
+        self.lock = threading.Lock()
+        self.sent_to = []
+        self.bulk_calls = 0
+        self.throttle_first = throttle_first
+
+    def maybe_throttle(self):
+        with self.lock:
+            if self.throttle_first:
+                self.throttle_first -= 1
+                raise ClientError({"Error": {"Code": "Throttling",
+                                             "Message": "Maximum sending rate exceeded."}},
+                                  "SendEmail")
+
+    def send_email(self, Source, Destination, Message):
+        self.maybe_throttle()
+        with self.lock:
+            self.sent_to.extend(Destination["ToAddresses"])
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def send_bulk_templated_email(self, Source, Template, DefaultTemplateData, Destinations):
+        self.maybe_throttle()
+        with self.lock:
+            self.bulk_calls += 1
+            for destination in Destinations:
+                self.sent_to.extend(destination["Destination"]["ToAddresses"])
+        return {"Status": [{"Status": "Success"} for _ in Destinations]}
+
+
+def make_notifications(count: int, products: int = 1) -> list[dict]:
+    """Returns count pending notifications spread over products."""
+    return [{"user_id": i, "product_id": i % products, "notification_price": 10.0,
+             "original_price": 20.0, "product_name": f"Product {i % products}",
+             "email_address": f"user{i}@example.com", "first_name": "John",
+             "last_name": "Doe", "current_price": 5.0} for i in range(count)]
+
 
 def test_get_ses_client_missing_env_variables():
     """Test if an exception is raised when required environment variables are missing."""
@@ -41,21 +92,25 @@ def test_get_ses_client_success():
         )
 
 
-def test_get_subscriptions_and_products():
-    """Test the subscription retrieval logic."""
+def test_get_pending_notifications():
+    """Test pending notifications come from a single query."""
 
     mock_cursor = MagicMock()
     mock_connection = MagicMock()
     mock_cursor.fetchall.return_value = [
-        (1, 10.0, "Product A", "user@example.com")]
+        (1, 2, 10.0, 20.0, "Product A", "user@example.com", "John", "Doe", 5.0)]
 
     with patch("email_notifier.get_cursor") as mock_get_cursor:
         mock_get_cursor.return_value.__enter__.return_value = mock_cursor
 
-        subscriptions = get_subscriptions_and_products(mock_connection)
+        pending = get_pending_notifications(mock_connection)
 
-    assert len(subscriptions) == 1
-    assert subscriptions[0] == (1, 10.0, "Product A", "user@example.com")
+    mock_cursor.execute.assert_called_once()
+    query = mock_cursor.execute.call_args[0][0]
+    assert "product_latest_price" in query
+    assert "NOT EXISTS" in query
+    assert pending == [
+        (1, 2, 10.0, 20.0, "Product A", "user@example.com", "John", "Doe", 5.0)]
 
 
 def test_send_email_success():
@@ -99,7 +154,8 @@ def test_send_email_failure():
     mock_error.assert_called_once()
 
 
-def test_check_and_notify_price_drop():
+@patch("email_notifier.execute_values")
+def test_check_and_notify_price_drop(mock_execute_values):
     """Test that a user is notified when the price drops below their threshold."""
     mock_cursor = MagicMock()
     mock_cursor.__enter__.return_value = mock_cursor
@@ -110,12 +166,8 @@ def test_check_and_notify_price_drop():
     mock_connection.cursor.return_value = mock_cursor
 
     mock_cursor.fetchall.return_value = [
-        (1, 10.0, 20.0, "Product A", "user@example.com",
-         "John", "Doe")
-    ]
-    mock_cursor.fetchone.side_effect = [
-        {"price": 5.0},
-        {"user_id": 1}
+        (1, 1, 10.0, 20.0, "Product A", "user@example.com",
+         "John", "Doe", 5.0)
     ]
 
     mock_ses_client = MagicMock()
@@ -125,8 +177,7 @@ def test_check_and_notify_price_drop():
         "AWS_ACCESS_KEY_ID": "fake_key_id",
         "AWS_SECRET_ACCESS_KEY": "fake_secret_key"
     }), mock.patch("email_notifier.get_connection", return_value=mock_connection), \
-            mock.patch("email_notifier.get_ses_client", return_value=mock_ses_client), \
-            mock.patch("email_notifier.has_notification_been_sent", return_value=False):
+            mock.patch("email_notifier.get_ses_client", return_value=mock_ses_client):
 
         check_and_notify()
 
@@ -152,79 +203,141 @@ def test_check_and_notify_price_drop():
             "Body": {"Text": {"Data": expected_body}}
         }
     )
+    assert mock_execute_values.call_args[0][2] == [(1, 1, 5.0)]
 
 
-def test_check_and_notify_no_price_drop():
-    """Test that no email is sent if the price doesn't drop below the threshold."""
+@patch("email_notifier.execute_values")
+def test_check_and_notify_no_pending_notifications(mock_execute_values):
+    """Test that nothing is sent or logged when no subscription needs an alert."""
     mock_cursor = MagicMock()
     mock_connection = MagicMock()
+    mock_connection.__enter__.return_value = mock_connection
     mock_connection.cursor.return_value = mock_cursor
+    mock_cursor.__enter__.return_value = mock_cursor
 
-    mock_cursor.fetchall.return_value = [
-        (1, 10.0, "Product A", "user@example.com")]
-    mock_cursor.fetchone.return_value = {
-        "price": 15.0}
+    mock_cursor.fetchall.return_value = []
 
     mock_ses_client = MagicMock()
 
-    with mock.patch.dict("os.environ", {
-        "FROM_EMAIL": "test@example.com",
-        "AWS_ACCESS_KEY_ID": "fake_key_id",
-        "AWS_SECRET_ACCESS_KEY": "fake_secret_key"
-    }), mock.patch("email_notifier.get_connection", return_value=mock_connection), \
-            mock.patch("email_notifier.get_ses_client", return_value=mock_ses_client), \
-            mock.patch("email_notifier.logging.info") as mock_info:
+    with mock.patch("email_notifier.get_connection", return_value=mock_connection), \
+            mock.patch("email_notifier.get_ses_client", return_value=mock_ses_client):
         check_and_notify()
 
     mock_ses_client.send_email.assert_not_called()
+    mock_execute_values.assert_not_called()
 
 
-def test_has_notification_been_sent_true():
-    """Test when a notification has been sent previously."""
-    mock_connection = MagicMock()
+@patch("email_notifier.execute_values")
+def test_check_and_notify_failed_email_not_logged(mock_execute_values):
+    """Test a notification that failed to send is not logged, so it is retried next run."""
     mock_cursor = MagicMock()
+    mock_connection = MagicMock()
+    mock_connection.__enter__.return_value = mock_connection
+    mock_connection.cursor.return_value = mock_cursor
+    mock_cursor.__enter__.return_value = mock_cursor
 
-    mock_cursor.fetchone.return_value = {"exists": 1}
-
-    with patch("email_notifier.get_cursor") as mock_get_cursor:
-        mock_get_cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [
+        (1, 1, 10.0, 20.0, "Product A", "a@example.com", "John", "Doe", 5.0),
+        (2, 1, 10.0, 20.0, "Product A", "b@example.com", "Jane", "Doe", 5.0)
+    ]
 
-        result = has_notification_been_sent(mock_connection, 1, 2, 9.99)
+    with mock.patch("email_notifier.get_connection", return_value=mock_connection), \
+            mock.patch("email_notifier.get_ses_client"), \
+            mock.patch("email_notifier.send_email",
+                       side_effect=lambda address, *args: address == "b@example.com"):
+        check_and_notify()
 
-    assert result is True
-    mock_cursor.execute.assert_called_once()
+    assert mock_execute_values.call_args[0][2] == [(2, 1, 5.0)]
 
 
-def test_has_notification_been_sent_false():
-    """Test when no previous notification has been sent."""
+def test_log_notifications_sent():
+    """Test logging a batch of sent notifications in one statement."""
     mock_connection = MagicMock()
     mock_cursor = MagicMock()
-    mock_cursor.fetchone.return_value = None
 
-    with patch("email_notifier.get_cursor") as mock_get_cursor:
+    with patch("email_notifier.get_cursor") as mock_get_cursor, \
+            patch("email_notifier.execute_values") as mock_execute_values:
         mock_get_cursor.return_value.__enter__.return_value = mock_cursor
 
-        result = has_notification_been_sent(mock_connection, 1, 2, 9.99)
+        log_notifications_sent(mock_connection, [(1, 2, 9.99), (3, 2, 9.99)])
 
-    assert result is False
-    mock_cursor.execute.assert_called_once()
+    mock_execute_values.assert_called_once()
+    assert mock_execute_values.call_args[0][0] is mock_cursor
+    assert mock_execute_values.call_args[0][2] == [(1, 2, 9.99), (3, 2, 9.99)]
+    assert mock_execute_values.call_args[1]["template"] == "(%s, %s, %s, NOW())"
 
 
-def test_log_notification_sent():
-    """Test logging a sent notification."""
-    mock_connection = MagicMock()
-    mock_cursor = MagicMock()
+def test_send_notifications_thousands_with_fake_client():
+    """Test thousands of alerts go out through one shared client within a run."""
+    ses_client = FakeSESClient()
+    notifications = make_notifications(2000)
 
-    with patch("email_notifier.get_cursor") as mock_get_cursor:
-        mock_get_cursor.return_value.__enter__.return_value = mock_cursor
+    with mock.patch.dict("os.environ", SES_ENV), \
+            mock.patch("email_notifier.logging.info"):
+        start = time.perf_counter()
+        sent = send_notifications(notifications, ses_client)
+        elapsed = time.perf_counter() - start
 
-        log_notification_sent(mock_connection, 1, 2, 9.99)
+    assert len(sent) == 2000
+    assert sorted(ses_client.sent_to) == sorted(
+        n["email_address"] for n in notifications)
+    assert elapsed < 10
 
-    mock_cursor.execute.assert_called_once()
-    mock_cursor.execute.assert_called_with(
-        """
-            INSERT INTO notifications_sent (user_id, product_id, price, timestamp)
-            VALUES (%s, %s, %s, NOW())
-        """,
-        (1, 2, 9.99)
-    )
+
+def test_send_notifications_respects_rate_limit():
+    """Test sends are spread out to stay under SES_MAX_SEND_RATE."""
+    ses_client = FakeSESClient()
+
+    with mock.patch.dict("os.environ", {**SES_ENV, "SES_MAX_SEND_RATE": "20"}):
+        start = time.perf_counter()
+        send_notifications(make_notifications(40), ses_client)
+        elapsed = time.perf_counter() - start
+
+    assert elapsed >= 0.9
+
+
+def test_send_notifications_retries_throttling():
+    """Test throttled sends are retried with backoff."""
+    ses_client = FakeSESClient(throttle_first=2)
+
+    with mock.patch.dict("os.environ", SES_ENV), \
+            mock.patch("email_notifier.sleep") as mock_sleep:
+        sent = send_notifications(make_notifications(1), ses_client)
+
+    assert len(sent) == 1
+    assert mock_sleep.call_count == 2
+
+
+def test_send_email_gives_up_on_other_client_errors():
+    """Test errors other than throttling are not retried."""
+    ses_client = MagicMock()
+    ses_client.send_email.side_effect = ClientError(
+        {"Error": {"Code": "MessageRejected", "Message": "Email address is not verified."}},
+        "SendEmail")
+
+    with mock.patch.dict("os.environ", SES_ENV):
+        assert send_email("user@example.com", "Subject", "Body", ses_client) is False
+
+    ses_client.send_email.assert_called_once()
+
+
+def test_get_notification_batches_groups_by_product():
+    """Test bulk templated sends group recipients of the same product, 50 at a time."""
+    notifications = make_notifications(120, products=2)
+
+    with mock.patch.dict("os.environ", {**SES_ENV, "SES_TEMPLATE_NAME": "PriceDrop"}):
+        batches = get_notification_batches(notifications)
+
+    assert [len(batch) for batch in batches] == [50, 10, 50, 10]
+    assert all(len({n["product_id"] for n in batch}) == 1 for batch in batches)
+
+
+def test_send_notifications_bulk_templated():
+    """Test templated sending uses one bulk call per batch."""
+    ses_client = FakeSESClient()
+
+    with mock.patch.dict("os.environ", {**SES_ENV, "SES_TEMPLATE_NAME": "PriceDrop"}):
+        sent = send_notifications(make_notifications(120, products=2), ses_client)
+
+    assert len(sent) == 120
+    assert ses_client.bulk_calls == 4
@@ -1,39 +1,59 @@
 # pylint: skip-file
+import asyncio
+from contextlib import closing
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import pytest
 from unittest.mock import patch, MagicMock
-from extract import (scrape_from_steam_html, get_html_from_url,
-                     get_website_from_url, scrape_pricing_process,
+from extract import (get_html_from_url, scrape_pricing_process,
                      extract_urls_from_db, get_html_with_age_gate_bypass,
-                     scrape_from_debenhams_html)
+                     get_host_from_url,
+                     async_extraction,
+                     stream_async_extraction, stream_extraction, extraction_run,
+                     get_parse_executor,
+                     get_session, close_sessions, extract_product_information)
+from host_guard import CircuitOpenError
+from http_cache import load_cache, CACHE_STATS
 
+STUB_DELAY = 0.2
 
-def test_scrape_pricing_process_only_accepts_debenhams_and_steam():
-    """Tests that scrape pricing process only accepts debenhams and steam."""
-    assert scrape_pricing_process(
-        "html_data", "https://unknown.co.uk/something-random", 1) == None
 
+class SlowHandler(BaseHTTPRequestHandler):
+    """Stub retailer that takes STUB_DELAY seconds to answer every request."""
 
-def test_get_website_from_url_com_websites():
-    """Tests if .com websites gets replaced correctly."""
-    result = get_website_from_url("https://store.steampowered.com/app/12345")
-    assert result == "https://store.steampowered.com"
+    def do_GET(self):
+        time.sleep(STUB_DELAY)
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-    result = get_website_from_url("https://www.debenhams.com/product")
-    assert result == "https://www.debenhams.com"
+    def log_message(self, *args):
+        pass
 
 
-def test_get_website_from_url_co_uk_websites():
-    """Tests if website name is extracted correctly."""
-    assert get_website_from_url(
-        "something.co.uk/something-else") == "something.co.uk"
+@pytest.fixture
+def stub_server():
+    """Runs the stub retailer on a free local port."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
 
 
-def test_get_website_from_url_edge_cases():
-    """Test get_website_from_url with unusual input."""
-    assert get_website_from_url(
-        "https://example.com/") == "https://example.com"
-    assert get_website_from_url("http://example.com") == "http://example.com"
-    assert get_website_from_url("ftp://example.com") == "ftp://example.com"
+def fake_scrape(html_content, url, product_id):
+    """Stands in for the retailer scrapers, which do not recognise the stub URLs."""
+    return {"product_id": product_id, "html": html_content}
+
+
+def test_scrape_pricing_process_only_accepts_debenhams_and_steam():
+    """Tests that scrape pricing process only accepts debenhams and steam."""
+    assert scrape_pricing_process(
+        "html_data", "https://unknown.co.uk/something-random", 1) == None
 
 
 def test_get_website_from_url_invalid():
@@ -50,113 +70,6 @@ def test_get_website_from_url_empty():
     assert get_html_from_url("") == "That URL does not exist."
 
 
-def test_scrape_from_steam_html_valid():
-    """Test scraping product info from Steam sample HTML."""
-    steam_html = """
-    <html>
-      <div id="game_area_purchase">
-        <div class="discount_original_price">£19.99</div>
-        <div class="discount_final_price">£9.99</div>
-        <div class="game_header_image_full">https://testing.com/storage/image/test.jpg</div>
-        <div class="game_description_snippet">Testing Description</div>
-      </div>
-      <div id="appHubAppName" class="apphub_AppName">Test Game</div>
-    </html>
-    """
-    html_content = steam_html.encode()
-    url = "https://store.steampowered.com/app/12345/"
-    product_id = 1
-    result = scrape_from_steam_html(html_content, url, product_id=1)
-    assert result == {
-        "product_id": 1,
-        "original_price": "£19.99",
-        "discount_price": "£9.99",
-        "game_title": "Test Game",
-        "website": "https://store.steampowered.com"
-    }
-
-
-def test_scrape_from_steam_html_invalid():
-    """Test scraping product info from Steam sample HTML with missing price elements."""
-    steam_html = """
-    <html>
-      <div id="game_area_purchase"></div>
-      <div id="appHubAppName" class="apphub_AppName">Test Game</div>
-    </html>
-    """
-    html_content = steam_html.encode()
-    url = "https://store.steampowered.com/app/12345/"
-    product_id = 1
-    result = scrape_from_steam_html(html_content, url, product_id=1)
-    assert result == {
-        "product_id": 1,
-        "original_price": "N/A",
-        "discount_price": "N/A",
-        "game_title": "Test Game",
-        "website": "https://store.steampowered.com"
-    }
-
-
-def test_scrape_from_steam_html_no_game_title():
-    """Test scrape_from_steam_html when game title is missing."""
-    steam_html = """
-    <html>
-      <div id="game_area_purchase">
-        <div class="discount_original_price">£19.99</div>
-        <div class="discount_final_price">£9.99</div>
-      </div>
-    </html>
-    """
-    result = scrape_from_steam_html(
-        steam_html.encode(), "https://store.steampowered.com/app/12345", 1)
-    assert result == None
-
-
-def test_scrape_from_debenhams_html_valid():
-    """Tests product information is scraped successfully for debenhams."""
-    debenhams_html = """
-    <html>
-      <h1 class='text-xl'>Test Product</h1>
-        <span data-test-id='product-price-current'>£320.00</span>
-        <span data-test-id='product-price-was'>£330.00</span>
-    </html>
-    """
-
-    result = scrape_from_debenhams_html(
-        debenhams_html, "https://www.debenhams.com/product", 2)
-    assert result == {
-        "product_id": 2,
-        "original_price": "£330.00",
-        "discount_price": "£320.00",
-        "product_title": "Test Product",
-        "website": "https://www.debenhams.com"
-    }
-
-
-def test_scrape_from_debenhams_html_invalid():
-    """Tests product information is scraped unsuccessfully for debenhams."""
-    debenhams_html = """
-    <html>
-      <h1 class="text-xl">Test Product</h1>
-    </html>
-    """
-    result = scrape_from_debenhams_html(
-        debenhams_html, "https://www.debenhams.com/product", 2)
-    assert result == None
-
-
-def test_scrape_from_debenhams_html_no_prices():
-    """Test scrape_from_debenhams_html when prices are missing."""
-    debenhams_html = """
-    <html>
-      <h1 class="text-xl">Test Product</h1>
-    </html>
-    """
-    result = scrape_from_debenhams_html(
-        debenhams_html.encode(), "https://www.debenhams.com/product", 2)
-    assert result is None
-
-
 def test_scrape_pricing_process_empty_html():
     """Test scrape_pricing_process fails with empty HTML content."""
     result = scrape_pricing_process(
@@ -164,6 +77,17 @@ def test_scrape_pricing_process_empty_html():
     assert result is None
 
 
+def test_scrape_pricing_process_tags_product_id():
+    """The ETL takes the price only path and tags the result with its product."""
+    page = """<h1 class='text-xl'>Test Product</h1>
+    <span data-test-id='product-price-current'>£320.00</span>
+    <div class='prose'>Description</div>"""
+    result = scrape_pricing_process(page, "https://www.debenhams.com/product", 2)
+    assert result["product_id"] == 2
+    assert result["discount_price"] == "£320.00"
+    assert "product_description" not in result
+
+
 def test_scrape_pricing_process_unsupported_url():
     """Test scrape_pricing_process fails with an unsupported URL."""
     result = scrape_pricing_process(
@@ -184,6 +108,33 @@ def test_extract_urls_from_db_valid():
         assert result == mock_url_list
 
 
+def test_extract_urls_from_db_modulo_shard(monkeypatch):
+    """Tests the modulo shard mode only asks for this worker's products."""
+    monkeypatch.setenv("ETL_SHARD_MODE", "modulo")
+    monkeypatch.setenv("ETL_SHARD_COUNT", "4")
+    monkeypatch.setenv("ETL_SHARD_INDEX", "1")
+    with patch("extract.get_connection"), patch("extract.get_cursor") as mock_get_cursor:
+        mock_cursor = MagicMock()
+        mock_get_cursor.return_value.__enter__.return_value = mock_cursor
+
+        extract_urls_from_db()
+        assert "product_id %% %s = %s" in mock_cursor.execute.call_args[0][0]
+        assert mock_cursor.execute.call_args[0][1] == (4, 1)
+
+
+def test_extract_urls_from_db_only_due_products(monkeypatch):
+    """The adaptive schedule only asks for due products, the fixed one for every product."""
+    with patch("extract.get_connection"), patch("extract.get_cursor") as mock_get_cursor:
+        mock_cursor = mock_get_cursor.return_value.__enter__.return_value
+
+        extract_urls_from_db()
+        assert "l.due_at <= NOW()" in mock_cursor.execute.call_args[0][0]
+
+        monkeypatch.setenv("SCRAPE_SCHEDULE", "fixed")
+        extract_urls_from_db()
+        assert "due_at" not in mock_cursor.execute.call_args[0][0]
+
+
 def test_extract_urls_from_db_empty():
     """Tests urls are extracted from the RDS database."""
     mock_url_list = []
@@ -220,3 +171,235 @@ def test_get_html_with_age_gate_bypass_valid():
         result = get_html_with_age_gate_bypass(
             "https://store.steampowered.com/app/12345")
         assert result == mock_steam_html
+
+
+def test_get_host_from_url():
+    """Tests the host is taken from the URL."""
+    assert get_host_from_url(
+        "https://store.steampowered.com/app/12345") == "store.steampowered.com"
+    assert get_host_from_url("random_url") == ""
+
+
+@patch("extract.scrape_pricing_process", side_effect=fake_scrape)
+def test_async_extraction_matches_serial(mock_scrape, stub_server):
+    """Tests async mode returns the same list, in the same order, as serial mode."""
+    urls = [[i, f"{stub_server}/product/{i}"] for i in range(5)]
+
+    serial_result = [extract_product_information(*url_info) for url_info in urls]
+    async_result = asyncio.run(async_extraction(urls, 5, 5))
+
+    assert async_result == serial_result
+    assert [product["product_id"] for product in async_result] == list(range(5))
+
+
+@patch("extract.scrape_pricing_process", side_effect=fake_scrape)
+def test_async_extraction_speedup(mock_scrape, stub_server):
+    """Tests fetches overlap up to the concurrency limit."""
+    urls = [[i, f"{stub_server}/product/{i}"] for i in range(8)]
+
+    start = time.perf_counter()
+    for url_info in urls:
+        extract_product_information(*url_info)
+    serial_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    asyncio.run(async_extraction(urls, 8, 8))
+    async_time = time.perf_counter() - start
+
+    assert serial_time >= 8 * STUB_DELAY
+    assert async_time < serial_time / 4
+
+
+@patch("extract.scrape_pricing_process", side_effect=fake_scrape)
+def test_async_extraction_per_host_limit(mock_scrape, stub_server):
+    """Tests no more than max_per_host requests go to one host at a time."""
+    urls = [[i, f"{stub_server}/product/{i}"] for i in range(4)]
+
+    start = time.perf_counter()
+    asyncio.run(async_extraction(urls, 8, 2))
+    elapsed = time.perf_counter() - start
+
+    assert elapsed >= 2 * STUB_DELAY
+
+
+@patch("extract.scrape_pricing_process", side_effect=fake_scrape)
+@patch("extract.get_html_from_url", side_effect=[Exception("boom"), b"<html></html>"])
+def test_async_extraction_skips_failures(mock_get_html, mock_scrape):
+    """Tests one failing product does not sink the rest of the run."""
+    urls = [[1, "https://www.debenhams.com/a"],
+            [2, "https://www.debenhams.com/b"]]
+
+    assert asyncio.run(async_extraction(urls, 1, 1)) == [
+        {"product_id": 2, "html": b"<html></html>"}]
+
+
+@patch("extract.get_html_from_url")
+def test_async_extraction_parses_in_worker_processes(mock_get_html):
+    """Tests pages fetched in this process are scraped by the process pool."""
+    mock_get_html.side_effect = lambda url: f"""
+    <html><h1 class='text-xl'>{url[-1]}</h1>
+    <span data-test-id='product-price-current'>£1.00</span></html>""".encode()
+    urls = [[i, f"https://www.debenhams.com/product/{i}"] for i in range(4)]
+
+    result = asyncio.run(async_extraction(
+        urls, 4, 4, parse_workers=2, queue_size=1))
+
+    assert [product["product_name"] for product in result] == [
+        "0", "1", "2", "3"]
+    assert result[0]["discount_price"] == "£1.00"
+
+
+@patch("extract.extract_urls_from_db", return_value=[[1, "https://www.debenhams.com/a"]])
+@patch("extract.get_html_from_url", return_value=b"<html></html>")
+@patch("extract.scrape_pricing_process", return_value={"product_id": 1})
+def test_stream_extraction_modes(mock_scrape, mock_get_html, mock_urls, tmp_path, monkeypatch):
+    """Tests both modes stream the scraped products and unknown modes are rejected."""
+    monkeypatch.setenv("HTTP_CACHE_PATH", str(tmp_path / "cache.json"))
+    monkeypatch.setenv("PARSE_WORKERS", "0")
+    assert list(stream_extraction("serial")) == [{"product_id": 1}]
+    assert list(stream_extraction("async")) == [{"product_id": 1}]
+    with pytest.raises(ValueError):
+        list(stream_extraction("parallel"))
+
+
+@patch("extract.get_html_from_url")
+def test_extraction_run_shares_one_parse_pool(mock_get_html, tmp_path, monkeypatch):
+    """Every extraction in a run is parsed by the same worker processes."""
+    monkeypatch.setenv("HTTP_CACHE_PATH", str(tmp_path / "cache.json"))
+    monkeypatch.setenv("PARSE_WORKERS", "2")
+    mock_get_html.side_effect = lambda url: f"""
+    <html><h1 class='text-xl'>{url[-1]}</h1>
+    <span data-test-id='product-price-current'>£1.00</span></html>""".encode()
+
+    with patch("extract.get_parse_executor", wraps=get_parse_executor) as mock_pool:
+        with extraction_run("async") as extract:
+            first = list(extract([[1, "https://www.debenhams.com/product/1"]]))
+            second = list(extract([[2, "https://www.debenhams.com/product/2"]]))
+
+    assert [product["product_name"] for product in first + second] == ["1", "2"]
+    mock_pool.assert_called_once()
+
+
+@patch("extract.scrape_pricing_process", side_effect=fake_scrape)
+def test_stream_async_extraction_yields_before_scrape_finishes(mock_scrape, stub_server):
+    """Tests the first product arrives after one fetch rather than after the whole scrape."""
+    urls = [[i, f"{stub_server}/product/{i}"] for i in range(8)]
+
+    start = time.perf_counter()
+    stream = stream_async_extraction(urls, 2, 2)
+    first = next(stream)
+    time_to_first = time.perf_counter() - start
+    rest = list(stream)
+    total_time = time.perf_counter() - start
+
+    assert time_to_first < 2 * STUB_DELAY
+    assert total_time >= 4 * STUB_DELAY
+    assert sorted(product["product_id"] for product in [first, *rest]) == list(range(8))
+
+
+@patch("extract.scrape_pricing_process", side_effect=fake_scrape)
+def test_stream_async_extraction_bounded_and_closable(mock_scrape, stub_server):
+    """Tests a consumer that stops early does not leave the extraction blocked."""
+    urls = [[i, f"{stub_server}/product/{i}"] for i in range(4)]
+
+    stream = stream_async_extraction(urls, 4, 4, queue_size=1)
+    assert next(stream)["product_id"] in range(4)
+    stream.close()
+
+    assert "stream-extraction" not in [thread.name for thread in threading.enumerate()]
+
+
+@patch("extract.scrape_pricing_process", side_effect=fake_scrape)
+def test_stream_async_extraction_cancelled_when_consumer_fails(mock_scrape, stub_server):
+    """Tests an error in the consumer stops the scrape instead of waiting for it to finish."""
+    urls = [[i, f"{stub_server}/product/{i}"] for i in range(40)]
+
+    start = time.perf_counter()
+    with pytest.raises(ValueError):
+        with closing(stream_async_extraction(urls, 2, 2, queue_size=1)) as stream:
+            for received, _ in enumerate(stream):
+                if received == 2:
+                    raise ValueError("Load failed")
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < 10 * STUB_DELAY
+    assert mock_scrape.call_count < len(urls) // 2
+    assert "stream-extraction" not in [thread.name for thread in threading.enumerate()]
+
+
+@patch("extract.get_html_from_url", side_effect=RuntimeError("boom"))
+@patch("extract.extract_urls_from_db", return_value=[[1, "https://www.debenhams.com/a"]])
+def test_stream_extraction_skips_failed_products(mock_urls, mock_get_html, tmp_path, monkeypatch):
+    """Tests failed products are left out of the stream and the cache is still saved."""
+    monkeypatch.setenv("HTTP_CACHE_PATH", str(tmp_path / "cache.json"))
+    monkeypatch.setenv("PARSE_WORKERS", "0")
+
+    assert list(stream_extraction("async")) == []
+    assert (tmp_path / "cache.json").exists()
+
+
+def test_get_session_reused_per_host():
+    """Tests one session is shared per host and dropped by close_sessions."""
+    close_sessions()
+    first = get_session("https://www.debenhams.com/product/a")
+    assert get_session("https://www.debenhams.com/product/b") is first
+    assert get_session("https://store.steampowered.com/app/1") is not first
+
+    close_sessions()
+    assert get_session("https://www.debenhams.com/product/a") is not first
+    close_sessions()
+
+
+@patch("extract.guarded_request", side_effect=CircuitOpenError("Circuit open for shop.com"))
+def test_get_html_from_url_fails_fast_when_circuit_open(mock_guarded_request):
+    """A host whose circuit is open is reported like one that cannot be reached."""
+    assert get_html_from_url("https://shop.com/product") == "Cannot connect to that URL."
+    assert mock_guarded_request.call_args[0][0] == "shop.com"
+
+
+def test_get_html_with_age_gate_bypass_submits_form_once():
+    """Tests the age-gate form is only posted while the session has no age-check cookies."""
+    close_sessions()
+    gated = MagicMock(url="https://store.steampowered.com/agecheck/app/1/")
+    page = MagicMock(url="https://store.steampowered.com/app/1/",
+                     content=b"<html></html>")
+
+    with patch("extract.requests.Session") as mock_session:
+        mock_session_instance = mock_session.return_value
+        mock_session_instance.get.side_effect = [gated, page, page]
+
+        assert get_html_with_age_gate_bypass(
+            "https://store.steampowered.com/app/1/") == b"<html></html>"
+        assert get_html_with_age_gate_bypass(
+            "https://store.steampowered.com/app/1/") == b"<html></html>"
+
+    assert mock_session.call_count == 1
+    assert mock_session_instance.get.call_count == 3
+    mock_session_instance.post.assert_called_once()
+    close_sessions()
+
+
+@patch("extract.scrape_pricing_process", return_value={"product_id": 1, "discount_price": "£5.00"})
+def test_extract_product_information_skips_parse_on_304(mock_scrape, tmp_path, monkeypatch):
+    """Tests an unchanged page is neither downloaded again nor re-parsed."""
+    monkeypatch.setenv("HTTP_CACHE_PATH", str(tmp_path / "cache.json"))
+    load_cache()
+    close_sessions()
+    url = "https://www.debenhams.com/product/a"
+    changed = MagicMock(status_code=200, content=b"<html></html>",
+                        headers={"ETag": '"v1"'})
+    unchanged = MagicMock(status_code=304, content=b"", headers={})
+
+    with patch("extract.requests.Session") as mock_session:
+        mock_session.return_value.get.side_effect = [changed, unchanged]
+
+        assert extract_product_information(1, url)["discount_price"] == "£5.00"
+        assert extract_product_information(7, url) == {
+            "product_id": 7, "discount_price": "£5.00"}
+
+    second_call = mock_session.return_value.get.call_args_list[1]
+    assert second_call.kwargs["headers"] == {"If-None-Match": '"v1"'}
+    mock_scrape.assert_called_once()
+    assert CACHE_STATS["hits"] == 1
+    assert CACHE_STATS["misses"] == 1
+    close_sessions()
@@ -0,0 +1,98 @@
+# pylint: skip-file
+from unittest.mock import MagicMock, patch
+import pytest
+import requests
+from host_guard import (CircuitOpenError, guarded_request, get_host_stats, get_retry_delay,
+                        reset_hosts)
+
+
+@pytest.fixture(autouse=True)
+def fresh_hosts(monkeypatch):
+    """Every test starts with no host state and without real sleeps."""
+    monkeypatch.setenv("HOST_RATE_LIMIT", "1000")
+    reset_hosts()
+    with patch("host_guard.time.sleep") as mock_sleep:
+        yield mock_sleep
+    reset_hosts()
+
+
+def response(status_code, headers=None):
+    return MagicMock(status_code=status_code, headers=headers or {})
+
+
+def test_guarded_request_retries_server_errors(fresh_hosts):
+    """5xx answers are retried with backoff until one succeeds."""
+    send = MagicMock(side_effect=[response(503), response(200)])
+
+    assert guarded_request("shop.com", send).status_code == 200
+    assert send.call_count == 2
+    fresh_hosts.assert_called_once()
+
+    stats = get_host_stats()["shop.com"]
+    assert (stats["requests"], stats["successes"], stats["failures"], stats["retries"]) == \
+        (2, 1, 1, 1)
+    assert stats["success_rate"] == 0.5
+
+
+def test_guarded_request_gives_up_after_max_attempts(monkeypatch):
+    """The last error response is returned, and the last connection error raised."""
+    monkeypatch.setenv("FETCH_MAX_ATTEMPTS", "2")
+    send = MagicMock(return_value=response(429))
+    assert guarded_request("shop.com", send).status_code == 429
+    assert send.call_count == 2
+
+    send = MagicMock(side_effect=requests.exceptions.ConnectionError)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        guarded_request("other.com", send)
+    assert send.call_count == 2
+
+
+def test_guarded_request_does_not_retry_client_errors():
+    """A 404 is the page's answer, not the host failing."""
+    send = MagicMock(return_value=response(404))
+    assert guarded_request("shop.com", send).status_code == 404
+    assert send.call_count == 1
+
+
+def test_circuit_opens_and_fails_fast(monkeypatch):
+    """Once a host has failed CIRCUIT_FAILURE_THRESHOLD times in a row its
+    remaining URLs fail without being sent."""
+    monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "3")
+    send = MagicMock(side_effect=requests.exceptions.Timeout)
+    with pytest.raises(requests.exceptions.Timeout):
+        guarded_request("shop.com", send)
+
+    with pytest.raises(CircuitOpenError):
+        guarded_request("shop.com", send)
+    assert send.call_count == 3
+    assert get_host_stats()["shop.com"]["rejected"] == 1
+    assert get_host_stats()["shop.com"]["circuit"] == "open"
+
+    assert guarded_request("other.com", MagicMock(return_value=response(200))).status_code == 200
+
+
+def test_get_retry_delay_honours_retry_after(monkeypatch):
+    """A numeric Retry-After is waited out, up to FETCH_BACKOFF_CAP."""
+    monkeypatch.setenv("FETCH_BACKOFF_CAP", "10")
+    assert get_retry_delay(response(429, {"Retry-After": "3"}), 0) == 3
+    assert get_retry_delay(response(429, {"Retry-After": "120"}), 0) == 10
+    assert 0 <= get_retry_delay(None, 1) <= 1
+
+
+def test_malformed_urls_do_not_count_against_the_host(monkeypatch):
+    """MissingSchema and InvalidURL say nothing about the host, so they never open its circuit."""
+    monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "1")
+    for error in (requests.exceptions.MissingSchema, requests.exceptions.InvalidURL):
+        send = MagicMock(side_effect=error)
+        with pytest.raises(error):
+            guarded_request("shop.com", send)
+        assert send.call_count == 1
+
+    stats = get_host_stats()["shop.com"]
+    assert (stats["failures"], stats["circuit"]) == (0, "closed")
+
+
+def test_zero_rate_limit_turns_throttling_off(monkeypatch):
+    """HOST_RATE_LIMIT=0 sends requests without a token bucket."""
+    monkeypatch.setenv("HOST_RATE_LIMIT", "0")
+    assert guarded_request("shop.com", MagicMock(return_value=response(200))).status_code == 200
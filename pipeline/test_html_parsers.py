@@ -0,0 +1,112 @@
+"""Unit Tests for the pluggable HTML parser backends."""
+# pylint: skip-file
+import pytest
+from html_parsers import (find_elements, find_elements_streaming,
+                          find_elements_with_soup, TargetedParser)
+from scrapers import (DEBENHAMS_TARGETS, DEBENHAMS_METADATA_TARGETS, STEAM_TARGETS,
+                      STEAM_METADATA_TARGETS, steam_elements_complete)
+
+PAGES = [
+    """<html><h1 class='text-xl font-bold'>Test <b>Product</b> &amp; Co</h1>
+    <span data-test-id='product-price-current'>£320.00</span>
+    <span data-test-id='product-price-was'> £330.00 </span></html>""",
+    """<html><h1 class="text-xl">Only a title<br>with a break</h1></html>""",
+    """<html><span data-test-id='product-price-current'><span>£1</span>0.00</span>
+    <h1 class="text-xl">Late title</h1></html>""",
+    """<html><div id="game_area_purchase">
+        <div class="discount_original_price">£19.99</div>
+        <div class="discount_final_price">£9.99</div>
+      </div>
+      <div id="appHubAppName" class="apphub_AppName">Test Game</div></html>""",
+    """<html><img class="game_header_image_full" src="header.jpg"><img class="game_header_image_full">
+      <div class="game_description_snippet">A <i>game</i></div>
+      <div class='prose'><p>Soft</p> cotton</div>
+      <img class='h-auto w-auto object-cover undefined undefined' src=''></html>""",
+    """<html><div id="appHubAppName" class="apphub_AppName">Regular Game</div>
+      <div id="game_area_purchase"><img src="x.jpg">
+        <div class="game_purchase_price price" data-price-final="1099">£10.99</div>
+      </div></html>""",
+    """<html><div class="discount_final_price">£1.00</div>
+      <div id="game_area_purchase"></div>
+      <div class="discount_original_price">£2.00</div>
+      <div id="appHubAppName" class="apphub_AppName">Outside Game</div></html>""",
+    """<html><div id="game_area_purchase"><div class="discount_original_price">£5
+      </div></html>""",
+    """<html><h1 class="text-xl">Scripted<script>var title = "<b>Not this</b>";</script>
+      <style>h1 { color: red; }</style> Title</h1>
+      <span data-test-id='product-price-current'>£1<![CDATA[ and data ]]><template>£9</template></span>
+      <div class="game_description_snippet">Ruby <ruby>漢<rp>(</rp><rt>kan</rt><rp>)</rp></ruby>
+      <?pi?> <!DOCTYPE html> end</div></html>""",
+    "",
+]
+
+
+@pytest.mark.parametrize("page", PAGES)
+@pytest.mark.parametrize("targets", [DEBENHAMS_TARGETS, STEAM_TARGETS,
+                                     DEBENHAMS_TARGETS + DEBENHAMS_METADATA_TARGETS,
+                                     STEAM_TARGETS + STEAM_METADATA_TARGETS])
+def test_backends_find_identical_text(page, targets):
+    """The streaming backend returns the same text (or attribute) BeautifulSoup does."""
+    assert find_elements_streaming(page, targets) == find_elements_with_soup(page, targets)
+    assert find_elements_streaming(page.encode(), targets) == \
+        find_elements_with_soup(page.encode(), targets)
+
+
+def test_backends_agree_on_script_style_and_template_targets():
+    """Script, style and template elements only count their own kind of text."""
+    page = """<div id="outer"><script class="a">var price = "£1";</script>
+      <style class="a">p {}</style><template class="a">T<b>U</b><![CDATA[V]]></template></div>"""
+    targets = [{"name": "outer", "tag": "div", "attrs": {"id": "outer"}},
+               {"name": "script", "tag": "script", "attrs": {"class": "a"}},
+               {"name": "style", "tag": "style", "attrs": {"class": "a"}},
+               {"name": "template", "tag": "template", "attrs": {"class": "a"}},
+               {"name": "any", "tag": None, "attrs": {"class": "a"}}]
+
+    result = find_elements_streaming(page, targets)
+
+    assert result == find_elements_with_soup(page, targets)
+    assert result["script"] == 'var price = "£1";'
+    assert "price" not in result["outer"]
+
+
+def test_streaming_stops_once_complete():
+    """The streaming backend stops reading once every target is settled."""
+    page = ("<h1 class='text-xl'>T</h1>"
+            "<span data-test-id='product-price-current'>£1</span>"
+            "<span data-test-id='product-price-was'>£2</span>"
+            + "<p>padding</p>" * 10000 + "<h1 class='text-xl'>Never reached")
+
+    fed = []
+    original_feed = TargetedParser.feed
+
+    def counting_feed(self, data):
+        fed.append(len(data))
+        original_feed(self, data)
+
+    TargetedParser.feed = counting_feed
+    try:
+        result = find_elements_streaming(page, DEBENHAMS_TARGETS)
+    finally:
+        TargetedParser.feed = original_feed
+
+    assert result["product_title"] == "T"
+    assert sum(fed) < len(page)
+
+
+def test_steam_stops_without_regular_price_when_discounted():
+    """A discounted Steam page does not need the page-wide regular price."""
+    found = {"purchase_area": "", "original_price": "£2",
+             "discount_price": "£1", "game_title": "G"}
+    assert steam_elements_complete(found, set(found))
+    assert not steam_elements_complete({"purchase_area": "", "game_title": "G"},
+                                       {"purchase_area", "original_price",
+                                        "discount_price", "game_title"})
+
+
+def test_find_elements_backend_switch(monkeypatch):
+    """PARSER_BACKEND picks the backend."""
+    page = "<h1 class='text-xl'>T</h1>"
+    monkeypatch.setenv("PARSER_BACKEND", "bs4")
+    assert find_elements(page, DEBENHAMS_TARGETS)["product_title"] == "T"
+    monkeypatch.setenv("PARSER_BACKEND", "fast")
+    assert find_elements(page, DEBENHAMS_TARGETS)["product_title"] == "T"
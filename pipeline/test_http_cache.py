@@ -0,0 +1,132 @@
+"""Unit Tests for the HTTP validator cache."""
+# pylint: skip-file
+import json
+import time
+import pytest
+from http_cache import (CACHE, CACHE_STATS, load_cache, save_cache, get_conditional_headers,
+                        record_response, record_not_modified, store_result, get_cached_result)
+
+URL = "https://www.debenhams.com/product"
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path, monkeypatch):
+    """Points the cache at a temporary file and starts each test empty."""
+    monkeypatch.setenv("HTTP_CACHE_PATH", str(tmp_path / "cache.json"))
+    load_cache()
+
+
+def test_no_conditional_headers_without_result():
+    """Validators are only sent once the page has a parsed result to fall back on."""
+    record_response(URL, '"v1"', "Wed, 04 Dec 2024 16:31:40 GMT", 100)
+    assert get_conditional_headers(URL) == {}
+
+    store_result(URL, {"discount_price": "£5.00"}, 0.5)
+    assert get_conditional_headers(URL) == {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "Wed, 04 Dec 2024 16:31:40 GMT"}
+
+
+def test_response_without_validators_not_cached():
+    """Pages without ETag or Last-Modified are not cached."""
+    record_response(URL, None, None, 100)
+    store_result(URL, {"discount_price": "£5.00"}, 0.5)
+
+    assert URL not in CACHE
+    assert CACHE_STATS["misses"] == 1
+    assert CACHE_STATS["bytes_downloaded"] == 100
+
+
+def test_failed_parse_drops_entry():
+    """A page that could not be scraped is not kept."""
+    record_response(URL, '"v1"', None, 100)
+    store_result(URL, None, 0.5)
+
+    assert URL not in CACHE
+
+
+def test_record_not_modified_counts_savings():
+    """A 304 counts as a hit and adds the page size and parse time saved."""
+    record_response(URL, '"v1"', None, 100)
+    store_result(URL, {"discount_price": "£5.00"}, 0.5)
+
+    record_not_modified(URL)
+
+    assert CACHE_STATS["hits"] == 1
+    assert CACHE_STATS["bytes_saved"] == 100
+    assert CACHE_STATS["parse_seconds_saved"] == 0.5
+
+
+def test_get_cached_result_uses_given_product_id():
+    """The cached result is copied with the current product_id."""
+    record_response(URL, '"v1"', None, 100)
+    store_result(URL, {"product_id": 1, "discount_price": "£5.00"}, 0.5)
+
+    result = get_cached_result(URL, 2)
+    result["discount_price"] = "£1.00"
+
+    assert get_cached_result(URL, 2) == {
+        "product_id": 2, "discount_price": "£5.00"}
+
+
+def test_get_cached_result_missing():
+    """Returns None when nothing is cached for a URL."""
+    assert get_cached_result(URL, 1) is None
+
+
+def test_save_and_load_round_trip():
+    """Entries with results survive a save and reload, counters are reset."""
+    record_response(URL, '"v1"', None, 100)
+    store_result(URL, {"discount_price": "£5.00"}, 0.5)
+    record_response("https://www.debenhams.com/other", '"v2"', None, 100)
+    save_cache()
+
+    load_cache()
+
+    assert list(CACHE) == [URL]
+    assert CACHE_STATS["misses"] == 0
+    assert get_conditional_headers(URL) == {"If-None-Match": '"v1"'}
+
+
+def test_load_cache_ignores_corrupt_file(tmp_path):
+    """An unreadable cache file starts the run with an empty cache."""
+    (tmp_path / "cache.json").write_text("not json")
+
+    load_cache()
+
+    assert CACHE == {}
+
+
+def test_save_cache_merges_entries_saved_by_other_tasks(tmp_path):
+    """A task sharing the file keeps the entries another task saved, and no temporary files are left."""
+    other = "https://www.debenhams.com/other"
+    (tmp_path / "cache.json").write_text(
+        '{"%s": {"etag": "\\"v9\\"", "result": {"discount_price": "£1.00"}}}' % other)
+    record_response(URL, '"v1"', None, 100)
+    store_result(URL, {"discount_price": "£5.00"}, 0.5)
+    save_cache()
+
+    load_cache()
+
+    assert sorted(CACHE) == sorted([URL, other])
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["cache.json", "cache.json.lock"]
+
+
+def test_save_cache_drops_stale_entries(tmp_path, monkeypatch):
+    """Entries not fetched within HTTP_CACHE_MAX_AGE_DAYS are dropped on save,
+    while a 304 keeps an entry fresh and untimed entries get a fresh start."""
+    monkeypatch.setenv("HTTP_CACHE_MAX_AGE_DAYS", "1")
+    old = time.time() - 2 * 24 * 60 * 60
+    result = {"discount_price": "£1.00"}
+    (tmp_path / "cache.json").write_text(json.dumps({
+        "https://www.debenhams.com/gone": {"etag": '"v1"', "result": result, "seen_at": old},
+        "https://www.debenhams.com/untimed": {"etag": '"v2"', "result": result},
+        URL: {"etag": '"v3"', "result": result, "seen_at": old}}))
+    load_cache()
+    record_not_modified(URL)
+    save_cache()
+
+    load_cache()
+
+    assert sorted(CACHE) == sorted([URL, "https://www.debenhams.com/untimed"])
+    assert all(entry["seen_at"] > old for entry in CACHE.values())
@@ -1,146 +1,225 @@
 """Unit Tests for the loading process of the pipeline."""
 # pylint: skip-file
 from unittest.mock import Mock, patch, MagicMock
-from load import insert_price_change, load_price_changes, product_id_exists
+import psycopg2
+from load import (insert_price_changes_batch, bulk_load_price_changes,
+                  remove_unchanged_prices, upsert_latest_prices, stream_load)
+from metrics import get_snapshot, reset_metrics
 
 
-def test_insert_price_change_valid():
-    """Insert query for inserting valid data successfully."""
+@patch("load.execute_values")
+def test_insert_price_changes_batch(mock_execute_values):
+    """Whole batch is sent in a single execute_values call."""
     mock_conn = MagicMock()
+    test_data = [
+        {'price': 22.49, 'product_id': 8, 'timestamp': '2024-12-04 16:31:40'},
+        {'price': 7.69, 'product_id': 9, 'timestamp': '2024-12-04 16:31:40'}
+    ]
 
-    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
-    insert_price_change(mock_conn, 1, 22.49, "2024-12-04 16:31:40")
+    insert_price_changes_batch(mock_conn, test_data)
 
-    mock_cursor.execute.assert_called_once()
-    assert mock_cursor.execute.call_args[0][1] == (
-        22.49, 1, "2024-12-04 16:31:40")
+    mock_execute_values.assert_called_once()
+    assert mock_execute_values.call_args[0][2] == [
+        (22.49, 8, '2024-12-04 16:31:40'), (7.69, 9, '2024-12-04 16:31:40')]
+    assert mock_execute_values.call_args[1]["page_size"] == 2
 
 
-def test_insert_price_change_invalid():
-    """Test that exception is raised for invalid querying."""
+@patch("load.upsert_latest_prices")
+@patch("load.insert_price_changes_batch")
+def test_bulk_load_price_changes_batches(mock_insert_batch, mock_upsert):
+    """Valid rows are split into batches and committed once."""
     mock_conn = MagicMock()
-    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
-    mock_cursor.execute.side_effect = Exception("Database error")
+    test_data = [{'price': 1.0, 'product_id': i, 'timestamp': '2024-12-04 16:31:40'}
+                 for i in range(5)] + [{'product_id': 9}]
 
-    try:
-        insert_price_change(mock_conn, 1, 22.49, "2024-12-04 16:31:40")
-        assert False, "Expected exception not raised"
-    except Exception:
-        assert "Database error"
+    bulk_load_price_changes(test_data, mock_conn, batch_size=2)
+
+    assert [len(call[0][1]) for call in mock_insert_batch.call_args_list] == [2, 2, 1]
+    assert len(mock_upsert.call_args[0][1]) == 5
+    mock_conn.commit.assert_called_once()
+    mock_conn.rollback.assert_not_called()
 
 
-@patch("load.product_id_exists")
-def test_product_id_exists_valid(mock_product_id_exists):
-    """Test product_id_exists returns True when product_id exists."""
+@patch("load.upsert_latest_prices")
+@patch("load.insert_price_changes_batch", side_effect=psycopg2.Error("bad row"))
+def test_bulk_load_price_changes_falls_back_to_rows(mock_insert_batch, mock_upsert):
+    """A failed batch is rolled back to its savepoint and retried row by row."""
     mock_conn = MagicMock()
-    mock_cursor = MagicMock()
-    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
 
-    result = product_id_exists(mock_conn, 1)
-    assert result == True
-    mock_cursor.execute.assert_called_once_with(
-        "SELECT * FROM product WHERE product_id = %s", (1,))
+    def execute(query, params=None):
+        if params and params[1] == 1:
+            raise psycopg2.Error("bad row")
+    mock_cursor.execute.side_effect = execute
+    test_data = [{'price': 1.0, 'product_id': i, 'timestamp': '2024-12-04 16:31:40'}
+                 for i in range(3)]
+
+    with patch("load.logging.info") as mock_info:
+        bulk_load_price_changes(test_data, mock_conn, batch_size=3)
+
+    executed = [call[0][0] for call in mock_cursor.execute.call_args_list]
+    assert sum(query.startswith("INSERT INTO price_changes") for query in executed) == 3
+    assert executed.count("ROLLBACK TO SAVEPOINT price_batch;") == 1
+    assert executed.count("ROLLBACK TO SAVEPOINT price_row;") == 1
+    mock_info.assert_called_with(
+        "Data loaded successfully. %s rows committed.", 2)
+    assert [product["product_id"]
+            for product in mock_upsert.call_args[0][1]] == [0, 2]
+    mock_conn.commit.assert_called_once()
 
 
-@patch("load.product_id_exists")
-def test_product_id_exists_invalid(mock_product_id_exists):
-    """Test product_id_exists returns False when product_id doesn't exist."""
+def test_bulk_load_price_changes_empty():
+    """Nothing to load results in a rollback."""
     mock_conn = MagicMock()
-    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
-    mock_cursor.fetchone.return_value = None
 
-    result = product_id_exists(mock_conn, 1)
-    assert result == False
-    mock_cursor.execute.assert_called_once_with(
-        "SELECT * FROM product WHERE product_id = %s", (1,)
-    )
+    bulk_load_price_changes([], mock_conn)
+
+    mock_conn.commit.assert_not_called()
+    mock_conn.rollback.assert_called_once()
 
 
-@patch("load.product_id_exists")
-def test_load_price_changes_valid(mock_product_id_exists):
-    """Loading valid data into the price_changes table successfully."""
+def test_remove_unchanged_prices():
+    """Only new products and products whose price moved are kept."""
     mock_conn = MagicMock()
-    mock_cursor = MagicMock()
-    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchall.return_value = [(8, 22.49), (9, 7.69)]
     test_data = [
         {'price': 22.49, 'product_id': 8, 'timestamp': '2024-12-04 16:31:40'},
-        {'price': 7.69, 'product_id': 9, 'timestamp': '2024-12-04 16:31:40'}
+        {'price': 6.99, 'product_id': 9, 'timestamp': '2024-12-04 16:31:40'},
+        {'price': 1.99, 'product_id': 10, 'timestamp': '2024-12-04 16:31:40'},
+        {'price': 1.99, 'product_id': 10, 'timestamp': '2024-12-04 16:31:40'}
     ]
 
-    load_price_changes(test_data, mock_conn)
+    result = remove_unchanged_prices(test_data, mock_conn)
 
-    assert mock_cursor.execute.call_count == len(test_data)
-    assert mock_conn.commit.called
-    assert not mock_conn.rollback.called
+    assert [product["product_id"] for product in result] == [9, 10]
+    assert mock_cursor.execute.call_args[0][1] == ([8, 9, 10, 10],)
 
 
-def test_load_price_changes_one_valid_one_invalid():
-    """Loading valid data into the price_changes table successfully even if there is one invalid data."""
-    mock_conn = MagicMock()
-    mock_cursor = MagicMock()
-    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
-
-    test_data = [
-        {'product_id': 8, 'timestamp': '2024-12-04 16:31:40'},
-        {'price': 7.69, 'product_id': 9, 'timestamp': '2024-12-04 16:31:40'}
-    ]
+@patch("load.bulk_load_price_changes")
+@patch("load.remove_unchanged_prices")
+@patch("load.reschedule_products")
+@patch("load.get_connection")
+def test_stream_load_all_mode(mock_get_connection, mock_reschedule, mock_remove, mock_bulk_load, monkeypatch):
+    """LOAD_MODE=all writes every price."""
+    monkeypatch.setenv("LOAD_MODE", "all")
+    test_data = [{'price': 22.49, 'product_id': 8,
+                  'timestamp': '2024-12-04 16:31:40'}]
 
-    load_price_changes(test_data, mock_conn)
+    stream_load(iter(test_data))
 
-    assert mock_cursor.execute.call_count == 1
-    assert mock_conn.commit.called
-    assert not mock_conn.rollback.called
+    mock_remove.assert_not_called()
+    assert mock_bulk_load.call_args[0][0] == test_data
 
 
-@patch("load.product_id_exists")
-@patch("load.insert_price_change")
-def test_load_price_changes_invalid(mock_insert_price_change, mock_product_id_exists):
-    """Loading invalid data result in a rollback rather than commit being called."""
+@patch("load.execute_values")
+def test_upsert_latest_prices_keeps_newest_per_product(mock_execute_values):
+    """Only the newest price of each product is upserted."""
     mock_conn = MagicMock()
-    mock_product_id_exists.return_value = False
-    mock_insert_price_change.return_value = Exception("Database error")
-
-    test_data = [{'product_id': 8,
-                  'timestamp': '2024-12-04 16:31:40'}]
+    test_data = [
+        {'price': 22.49, 'product_id': 8, 'timestamp': '2024-12-04 16:31:40'},
+        {'price': 20.00, 'product_id': 8, 'timestamp': '2024-12-04 16:34:40'},
+        {'price': 7.69, 'product_id': 9, 'timestamp': '2024-12-04 16:31:40'}
+    ]
 
-    load_price_changes(test_data, mock_conn)
+    upsert_latest_prices(mock_conn, test_data)
 
-    mock_conn.rollback.assert_called_once()
-    mock_conn.commit.assert_not_called()
+    assert mock_execute_values.call_args[0][2] == [
+        (8, 20.00, '2024-12-04 16:34:40'), (9, 7.69, '2024-12-04 16:31:40')]
 
 
-def test_load_price_changes_empty():
-    """Ensure no database operations occur when given an empty list."""
-    mock_conn = Mock()
-    test_data = []
+@patch("load.upsert_latest_prices", side_effect=psycopg2.Error("upsert failed"))
+@patch("load.insert_price_changes_batch")
+def test_bulk_load_price_changes_upsert_failure_rolls_back(mock_insert_batch, mock_upsert):
+    """The inserts are not committed without their latest-price upsert."""
+    mock_conn = MagicMock()
 
-    load_price_changes(test_data, mock_conn)
+    bulk_load_price_changes([{'price': 1.0, 'product_id': 1,
+                              'timestamp': '2024-12-04 16:31:40'}], mock_conn)
 
     mock_conn.commit.assert_not_called()
     mock_conn.rollback.assert_called_once()
 
 
-def multiple_insertion_side_effect(test_dict: dict):
-    """ specifically for the test below:  """
-    if test_dict['product_id'] == 8:
-        return None
-    else:
-        return Exception("Database Error")
+@patch("load.bulk_load_price_changes")
+@patch("load.remove_unchanged_prices", side_effect=lambda batch, conn: batch)
+@patch("load.reschedule_products")
+@patch("load.get_connection")
+def test_stream_load_commits_each_batch(mock_get_connection, mock_reschedule, mock_remove, mock_bulk_load, monkeypatch):
+    """Rows are loaded LOAD_BATCH_SIZE at a time, with a final partial batch."""
+    monkeypatch.setenv("LOAD_BATCH_SIZE", "2")
+    rows = ({'price': float(i), 'product_id': i, 'timestamp': '2024-12-04 16:31:40'}
+            for i in range(5))
 
+    assert stream_load(rows) == 5
 
-@patch("load.product_id_exists")
-@patch("load.insert_price_change")
-def test_load_price_changes_partial_failure(mock_insert_price_change, mock_product_id_exists):
-    """Combination of valid and invalid data insertion """
-    mock_conn = MagicMock()
-    mock_insert_price_change = Mock(side_effect=multiple_insertion_side_effect)
-    mock_product_id_exists.return_value = True
+    assert [len(call[0][0]) for call in mock_bulk_load.call_args_list] == [2, 2, 1]
+    mock_get_connection.return_value.close.assert_called_once()
 
-    test_data = [
-        {'product_id': 8, 'timestamp': '2024-12-04 16:31:40'},
-        {'price': 7.69, 'product_id': 9, 'timestamp': '2024-12-04 16:31:40'}
-    ]
 
-    load_price_changes(test_data, mock_conn)
-    mock_conn.rollback.assert_not_called()
-    mock_conn.commit.assert_called_once()
+@patch("load.bulk_load_price_changes", side_effect=psycopg2.Error("lost connection"))
+@patch("load.reschedule_products")
+@patch("load.get_connection")
+def test_stream_load_closes_connection_on_error(mock_get_connection, mock_reschedule,
+                                                mock_bulk_load, monkeypatch):
+    """The connection is closed even when a batch fails."""
+    monkeypatch.setenv("LOAD_MODE", "all")
+
+    try:
+        stream_load(iter([{'price': 1.0, 'product_id': 1,
+                           'timestamp': '2024-12-04 16:31:40'}]))
+        assert False, "Expected exception not raised"
+    except psycopg2.Error:
+        pass
+
+    mock_get_connection.return_value.close.assert_called_once()
+
+
+@patch("load.bulk_load_price_changes")
+@patch("load.remove_unchanged_prices", return_value=[])
+@patch("load.reschedule_products")
+@patch("load.get_connection")
+def test_stream_load_skips_unchanged_batches(mock_get_connection, mock_reschedule, mock_remove, mock_bulk_load):
+    """Batches with no price changes are not written."""
+    stream_load(iter([{'price': 1.0, 'product_id': 1,
+                       'timestamp': '2024-12-04 16:31:40'}]))
+
+    mock_bulk_load.assert_not_called()
+
+
+@patch("load.bulk_load_price_changes")
+@patch("load.reschedule_products")
+@patch("load.get_connection")
+def test_stream_load_flushes_slow_streams(mock_get_connection, mock_reschedule, mock_bulk_load, monkeypatch):
+    """A part-filled batch is written once it has waited LOAD_FLUSH_SECONDS,
+    and the time to the first written row is recorded."""
+    monkeypatch.setenv("LOAD_MODE", "all")
+    monkeypatch.setenv("LOAD_FLUSH_SECONDS", "0")
+    reset_metrics()
+
+    def rows():
+        yield {'price': 1.0, 'product_id': 1, 'timestamp': '2024-12-04 16:31:40'}
+        assert mock_bulk_load.call_count == 1
+        yield {'price': 2.0, 'product_id': 2, 'timestamp': '2024-12-04 16:31:40'}
+
+    stream_load(rows())
+
+    assert mock_bulk_load.call_count == 2
+    assert get_snapshot()["histograms"]["time_to_first_row_seconds"]["count"] == 1
+
+
+@patch("load.bulk_load_price_changes")
+@patch("load.remove_unchanged_prices", return_value=[])
+@patch("load.reschedule_products")
+@patch("load.get_connection")
+def test_stream_load_reschedules_every_scraped_product(mock_get_connection, mock_reschedule,
+                                                       mock_remove, mock_bulk_load, monkeypatch):
+    """Unchanged prices are rescheduled too, before the latest prices are updated,
+    unless the schedule is fixed."""
+    row = {'price': 1.0, 'product_id': 1, 'timestamp': '2024-12-04 16:31:40'}
+    stream_load(iter([row]))
+    assert mock_reschedule.call_args[0][1] == [row]
+
+    monkeypatch.setenv("SCRAPE_SCHEDULE", "fixed")
+    stream_load(iter([row]))
+    assert mock_reschedule.call_count == 1
@@ -0,0 +1,127 @@
+"""Unit Tests for the pipeline metrics."""
+# pylint: skip-file
+import json
+import time
+import pytest
+from unittest.mock import patch
+from metrics import (increment, observe, timer, reset_metrics, get_snapshot,
+                     to_json_line, to_emf, to_prometheus, export_metrics, BUCKETS)
+
+
+@pytest.fixture(autouse=True)
+def empty_metrics():
+    reset_metrics()
+    yield
+    reset_metrics()
+
+
+def test_increment_counters():
+    """Counters start at zero and add up."""
+    increment("pages_fetched")
+    increment("pages_fetched")
+    increment("bytes_downloaded", 2048)
+
+    assert get_snapshot()["counters"] == {"pages_fetched": 2, "bytes_downloaded": 2048}
+
+
+def test_observe_fills_buckets():
+    """Each duration lands in the first bucket it fits, with count, sum and max kept."""
+    observe("fetch_seconds", 0.003)
+    observe("fetch_seconds", 0.2)
+    observe("fetch_seconds", 500)
+
+    histogram = get_snapshot()["histograms"]["fetch_seconds"]
+    assert histogram["count"] == 3
+    assert histogram["sum"] == pytest.approx(500.203)
+    assert histogram["max"] == 500
+    assert histogram["buckets"][0] == 1
+    assert histogram["buckets"][BUCKETS.index(0.25)] == 1
+    assert sum(histogram["buckets"]) == 2
+
+
+def test_timer_records_duration():
+    """The timer observes how long its block took, even when it raises."""
+    with pytest.raises(ValueError):
+        with timer("load_seconds"):
+            time.sleep(0.01)
+            raise ValueError("Load failed")
+
+    histogram = get_snapshot()["histograms"]["load_seconds"]
+    assert histogram["count"] == 1
+    assert histogram["sum"] >= 0.01
+
+
+def test_to_json_line():
+    """JSON export is one parseable line."""
+    increment("rows_inserted", 5)
+    line = to_json_line(get_snapshot())
+
+    assert "\n" not in line
+    assert json.loads(line)["counters"] == {"rows_inserted": 5}
+
+
+def test_to_emf():
+    """EMF export declares every metric under the namespace and dimension."""
+    increment("emails_sent", 3)
+    observe("fetch_seconds", 0.5)
+    observe("fetch_seconds", 1.5)
+
+    document = json.loads(to_emf(get_snapshot()))
+
+    directive = document["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Dimensions"] == [["Pipeline"]]
+    assert {metric["Name"] for metric in directive["Metrics"]} == {
+        "emails_sent", "fetch_seconds_count", "fetch_seconds_avg", "fetch_seconds_max"}
+    assert document["emails_sent"] == 3
+    assert document["fetch_seconds_avg"] == 1.0
+    assert document["Pipeline"] == "etl"
+
+
+def test_to_prometheus():
+    """Prometheus export has counters and cumulative histogram buckets."""
+    increment("parse_failures")
+    observe("parse_seconds", 0.004)
+    observe("parse_seconds", 0.04)
+
+    text = to_prometheus(get_snapshot())
+
+    assert "priceslashers_parse_failures_total 1" in text
+    assert 'priceslashers_parse_seconds_bucket{le="0.005"} 1' in text
+    assert 'priceslashers_parse_seconds_bucket{le="0.05"} 2' in text
+    assert 'priceslashers_parse_seconds_bucket{le="+Inf"} 2' in text
+    assert "priceslashers_parse_seconds_count 2" in text
+
+
+def test_export_metrics_prometheus_textfile(tmp_path):
+    """Prometheus export writes the textfile."""
+    path = tmp_path / "priceslashers.prom"
+    increment("urls", 10)
+
+    with patch.dict("os.environ", {"METRICS_FORMAT": "prometheus",
+                                   "METRICS_TEXTFILE_PATH": str(path)}):
+        export_metrics()
+
+    assert "priceslashers_urls_total 10" in path.read_text()
+
+
+def test_export_metrics_json(capsys):
+    """JSON export prints one line to stdout."""
+    increment("urls", 10)
+
+    with patch.dict("os.environ", {"METRICS_FORMAT": "json"}):
+        export_metrics()
+
+    assert json.loads(capsys.readouterr().out)["counters"]["urls"] == 10
+
+
+def test_timer_overhead_is_negligible():
+    """A timed page costs microseconds, well under 1% of a 10ms fetch."""
+    runs = 20000
+    start = time.perf_counter()
+    for _ in range(runs):
+        with timer("fetch_seconds"):
+            pass
+        increment("pages_fetched")
+    per_page = (time.perf_counter() - start) / runs
+
+    assert per_page < 0.0001
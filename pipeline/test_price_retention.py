@@ -0,0 +1,126 @@
+"""Unit Tests for the price_changes retention script."""
+# pylint: skip-file
+import pytest
+from datetime import date
+from unittest.mock import Mock, patch
+from price_retention import (add_months, get_partitions, get_expired_partitions,
+                             roll_up_and_drop_partition, create_future_partitions,
+                             delete_old_hourly_rollups, move_default_partition_rows,
+                             main_retention, lambda_handler)
+
+
+@pytest.fixture
+def mock_cursor():
+    """Mocks cursor."""
+    cursor = Mock()
+    cursor.__enter__ = Mock(return_value=cursor)
+    cursor.__exit__ = Mock(return_value=None)
+    return cursor
+
+
+@pytest.fixture
+def mock_conn(mock_cursor):
+    """Mocks connection."""
+    conn = Mock()
+    conn.cursor.return_value = mock_cursor
+    return conn
+
+
+def test_add_months_across_years():
+    """Returns the first of the month, wrapping around years."""
+    assert add_months(date(2024, 11, 1), 3) == date(2025, 2, 1)
+    assert add_months(date(2025, 2, 1), -3) == date(2024, 11, 1)
+
+
+def test_get_partitions_parses_names(mock_conn, mock_cursor):
+    """Only monthly partitions are returned, keyed by month."""
+    mock_cursor.fetchall.return_value = [("price_changes_2024_12",),
+                                         ("price_changes_2025_01",),
+                                         ("price_changes_other",)]
+
+    assert get_partitions(mock_conn) == {date(2024, 12, 1): "price_changes_2024_12",
+                                         date(2025, 1, 1): "price_changes_2025_01"}
+
+
+def test_get_expired_partitions():
+    """Partitions are expired once their whole month is past retention."""
+    partitions = {date(2025, 3, 1): "price_changes_2025_03",
+                  date(2024, 12, 1): "price_changes_2024_12",
+                  date(2025, 1, 1): "price_changes_2025_01",
+                  date(2025, 2, 1): "price_changes_2025_02"}
+
+    assert get_expired_partitions(partitions, date(2025, 4, 15), 2) == [
+        "price_changes_2024_12", "price_changes_2025_01"]
+
+
+def test_roll_up_and_drop_partition(mock_conn, mock_cursor):
+    """Rolls up hourly and daily, drops the partition and commits once."""
+    roll_up_and_drop_partition(mock_conn, "price_changes_2024_12")
+
+    assert mock_cursor.execute.call_count == 4
+    assert [call.args[1] for call in mock_cursor.execute.call_args_list[1:3]] == [
+        ("hour",), ("day",)]
+    mock_conn.commit.assert_called_once()
+
+
+def test_roll_up_and_drop_partition_error_keeps_rows(mock_conn, mock_cursor):
+    """A failed rollup rolls back so the partition is not dropped."""
+    mock_cursor.execute.side_effect = [None, Exception("Rollup failed")]
+
+    with pytest.raises(Exception):
+        roll_up_and_drop_partition(mock_conn, "price_changes_2024_12")
+
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
+
+
+def test_create_future_partitions(mock_conn, mock_cursor):
+    """Creates this month's partition and the ones ahead."""
+    create_future_partitions(mock_conn, date(2024, 12, 20), 2)
+
+    assert [call.args[1] for call in mock_cursor.execute.call_args_list] == [
+        (date(2024, 12, 1),), (date(2025, 1, 1),), (date(2025, 2, 1),)]
+
+
+def test_move_default_partition_rows(mock_conn, mock_cursor):
+    """Creates a partition for every month found in the default partition."""
+    mock_cursor.fetchall.return_value = [(date(2024, 11, 1),), (date(2025, 1, 1),)]
+
+    move_default_partition_rows(mock_conn)
+
+    assert [call.args[1] for call in mock_cursor.execute.call_args_list[1:]] == [
+        (date(2024, 11, 1),), (date(2025, 1, 1),)]
+    mock_conn.commit.assert_called_once()
+
+
+def test_delete_old_hourly_rollups(mock_conn, mock_cursor):
+    """Deletes hourly rollups before the first of the retention month."""
+    delete_old_hourly_rollups(mock_conn, date(2025, 6, 10), 12)
+
+    assert mock_cursor.execute.call_args.args[1][0].date() == date(2024, 6, 1)
+    mock_conn.commit.assert_called_once()
+
+
+@patch("price_retention.get_connection")
+@patch("price_retention.roll_up_and_drop_partition")
+@patch("price_retention.get_partitions")
+def test_main_retention(mock_get_partitions, mock_roll_up, mock_get_conn, mock_conn, mock_cursor):
+    """Drops every expired partition, oldest first."""
+    mock_cursor.fetchall.return_value = []
+    mock_get_conn.return_value.__enter__ = Mock(return_value=mock_conn)
+    mock_get_conn.return_value.__exit__ = Mock(return_value=None)
+    mock_get_partitions.return_value = {date(2024, 12, 1): "price_changes_2024_12",
+                                        date(2024, 11, 1): "price_changes_2024_11",
+                                        date(2025, 3, 1): "price_changes_2025_03"}
+
+    with patch.dict("os.environ", {"RAW_RETENTION_MONTHS": "2"}):
+        main_retention(date(2025, 3, 10))
+
+    assert [call.args[1] for call in mock_roll_up.call_args_list] == [
+        "price_changes_2024_11", "price_changes_2024_12"]
+
+
+@patch("price_retention.main_retention", side_effect=Exception("Database error"))
+def test_lambda_handler_failure(mock_main):
+    """Returns a 500 when the retention fails."""
+    assert lambda_handler({}, None)["status_code"] == 500
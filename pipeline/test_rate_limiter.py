@@ -0,0 +1,93 @@
+"""Unit Tests for the rate limiting helpers."""
+# pylint: skip-file
+from unittest.mock import patch
+import pytest
+from rate_limiter import CircuitBreaker, TokenBucket, get_backoff_delay
+
+
+def test_token_bucket_allows_burst_then_waits():
+    """A full bucket serves capacity requests at once, then asks to wait."""
+    bucket = TokenBucket(rate=10, capacity=3)
+
+    assert [bucket.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert 0 < bucket.try_acquire() <= 0.1
+
+
+def test_token_bucket_refills_over_time():
+    """Tokens come back at rate per second, up to capacity."""
+    with patch("rate_limiter.monotonic", side_effect=[0, 0.5, 100]):
+        bucket = TokenBucket(rate=2, capacity=4)
+        bucket.tokens = 0
+        assert bucket.try_acquire() == 0
+        assert bucket.tokens == 0
+
+        assert bucket.try_acquire() == 0
+        assert bucket.tokens == 3
+
+
+def test_token_bucket_acquire_sleeps_until_token_due():
+    """acquire blocks for as long as try_acquire says."""
+    bucket = TokenBucket(rate=1)
+    with patch.object(bucket, "try_acquire", side_effect=[0.5, 0]), \
+            patch("rate_limiter.sleep") as mock_sleep:
+        bucket.acquire()
+
+    mock_sleep.assert_called_once_with(0.5)
+
+
+def test_get_backoff_delay_is_capped():
+    """Delays grow exponentially up to the cap."""
+    with patch("rate_limiter.random.uniform", side_effect=lambda low, high: high):
+        assert get_backoff_delay(0) == 0.1
+        assert get_backoff_delay(3) == 0.8
+        assert get_backoff_delay(20) == 10.0
+
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    """Failures in a row open the breaker; a success in between resets the count."""
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_circuit_breaker_probes_once_after_reset():
+    """After reset_seconds one probe goes through; its result closes or reopens the breaker."""
+    with patch("rate_limiter.monotonic", return_value=0):
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+        breaker.record_failure()
+
+    with patch("rate_limiter.monotonic", return_value=31):
+        assert breaker.allow()
+        assert not breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == "open"
+
+    with patch("rate_limiter.monotonic", return_value=62):
+        assert breaker.allow()
+        breaker.record_success()
+        assert breaker.state == "closed"
+        assert breaker.allow()
+
+
+def test_token_bucket_rejects_non_positive_rates():
+    """A bucket that never refills would make acquire wait forever."""
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+def test_circuit_breaker_release_frees_the_probe():
+    """A probe that was never sent lets the next call probe instead."""
+    with patch("rate_limiter.monotonic", return_value=0):
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+        breaker.record_failure()
+
+    with patch("rate_limiter.monotonic", return_value=31):
+        assert breaker.allow()
+        breaker.release()
+        assert breaker.allow()
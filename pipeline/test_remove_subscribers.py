@@ -2,8 +2,10 @@
 # pylint: skip-file
 import pytest
 from unittest.mock import Mock, patch
-from remove_subscribers import (get_product_ids_from_table, delete_from_table,
-                                delete_unsubscribed_data, main_remove_subscriptions, clean_websites, lambda_handler)
+import psycopg2
+from remove_subscribers import (get_unsubscribed_product_ids, delete_chunk, purge_table,
+                                delete_products, main_remove_subscriptions, clean_websites,
+                                lambda_handler, get_time_left, PURGE_TABLES)
 
 
 @pytest.fixture
@@ -21,125 +23,181 @@ def mock_cursor():
     return cursor
 
 
-def test_get_product_ids_from_table_success(mock_conn, mock_cursor):
-    """Returns product ids from a table using distinct query is successfully ran."""
+def test_get_unsubscribed_product_ids(mock_conn, mock_cursor):
+    """Returns the product ids found by the anti-join."""
     mock_conn.cursor.return_value = mock_cursor
-    mock_cursor.fetchall.return_value = [(1,), (2,), (3,)]
+    mock_cursor.fetchall.return_value = [(1,), (4,)]
 
-    result = get_product_ids_from_table(
-        mock_conn, "subscription", distinct=True)
+    result = get_unsubscribed_product_ids(mock_conn, 100)
 
-    assert result == {1, 2, 3}
-    mock_cursor.execute.assert_called_once_with(
-        "SELECT DISTINCT product_id FROM subscription;"
-    )
+    assert result == [1, 4]
+    query, params = mock_cursor.execute.call_args[0]
+    assert "NOT EXISTS" in query
+    assert params == (100,)
 
 
-def test_get_product_ids_from_table_no_distinct(mock_conn, mock_cursor):
-    """Returns product ids without using distinction query."""
+def test_delete_chunk_commits(mock_conn, mock_cursor):
+    """Deletes one bounded chunk and commits it."""
     mock_conn.cursor.return_value = mock_cursor
-    mock_cursor.fetchall.return_value = [(1,), (2,), (2,), (3,)]
+    mock_cursor.rowcount = 500
 
-    result = get_product_ids_from_table(mock_conn, "product")
+    assert delete_chunk(mock_conn, "price_changes", [1, 2], 500) == 500
+
+    query, params = mock_cursor.execute.call_args[0]
+    assert "DELETE FROM price_changes WHERE (price_id, timestamp) IN" in query
+    assert "LIMIT %s" in query
+    assert params == ([1, 2], 500)
+    mock_conn.commit.assert_called_once()
+
+
+@patch("remove_subscribers.delete_chunk", side_effect=[100, 100, 30])
+def test_purge_table_until_short_chunk(mock_delete_chunk, mock_conn):
+    """Keeps deleting chunks until one comes back short."""
+    assert purge_table(mock_conn, "price_changes", [1], 100, lambda: False) == (230, True)
+    assert mock_delete_chunk.call_count == 3
 
-    assert result == {1, 2, 3}
-    mock_cursor.execute.assert_called_once_with(
-        "SELECT  product_id FROM product;"
-    )
 
+@patch("remove_subscribers.delete_chunk", return_value=100)
+def test_purge_table_stops_when_out_of_time(mock_delete_chunk, mock_conn):
+    """Stops between chunks when time runs out."""
+    out_of_time = Mock(side_effect=[False, False, True])
 
-def test_get_product_ids_from_table_error(mock_conn, mock_cursor):
-    """Returns an error and returns empty set if invalid."""
+    assert purge_table(mock_conn, "price_changes", [1], 100, out_of_time) == (200, False)
+
+
+def test_delete_products_cleans_websites(mock_conn, mock_cursor):
+    """Locks the products, then deletes them and unused websites in one commit."""
     mock_conn.cursor.return_value = mock_cursor
-    mock_cursor.execute.side_effect = Exception("Database error")
+    mock_cursor.fetchall.return_value = [(1,), (2,)]
+    mock_cursor.rowcount = 2
 
-    result = get_product_ids_from_table(mock_conn, "subscription")
+    assert delete_products(mock_conn, [1, 2]) == 2
 
-    assert result == set()
+    queries = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    assert "FOR UPDATE" in queries[0]
+    assert len(queries) == len(PURGE_TABLES) + 3
+    mock_conn.commit.assert_called_once()
 
 
-def test_delete_unsubscribed_data(mock_conn, mock_cursor):
-    """Tests deletion of data with unsubscribed product ids."""
+def test_delete_products_removes_rows_added_by_a_concurrent_run(mock_conn, mock_cursor):
+    """Rows the ETL inserted after the purge are deleted in the same transaction
+    as their product, after the product row is locked."""
     mock_conn.cursor.return_value = mock_cursor
-    unsubscribed_ids = [1, 2, 3]
+    mock_cursor.fetchall.return_value = [(1,)]
+    mock_cursor.rowcount = 1
 
-    delete_unsubscribed_data(mock_conn, unsubscribed_ids)
+    delete_products(mock_conn, [1, 2])
 
-    assert mock_cursor.execute.call_count == 3
+    queries = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    child_deletes = queries[1:1 + len(PURGE_TABLES)]
+    assert [query.split()[2] for query in child_deletes] == list(PURGE_TABLES)
+    assert all(call.args[1] == ([1],) for call in mock_cursor.execute.call_args_list[1:-1])
+    assert queries.index(child_deletes[-1]) < queries.index(
+        "DELETE FROM product WHERE product_id = ANY(%s);")
     mock_conn.commit.assert_called_once()
 
 
-def test_delete_unsubscribed_data_error(mock_conn, mock_cursor):
-    """Rollback called if an error is raised during deletion of unsubscribed products."""
+def test_delete_products_skips_foreign_key_violations(mock_conn, mock_cursor):
+    """Products that still have rows referring to them are left for the next run."""
     mock_conn.cursor.return_value = mock_cursor
-    mock_cursor.execute.side_effect = Exception("Database error")
+    mock_cursor.fetchall.return_value = [(1,)]
+    mock_cursor.rowcount = 0
+    mock_cursor.execute.side_effect = [None] * (len(PURGE_TABLES) + 1) + [
+        psycopg2.errors.ForeignKeyViolation("still referenced")]
 
-    delete_unsubscribed_data(mock_conn, [1, 2, 3])
+    assert delete_products(mock_conn, [1]) is None
 
     mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
 
 
-@patch('remove_subscribers.get_connection')
-def test_main_remove_subscriptions_valid(mock_get_connection, mock_conn, mock_cursor):
-    """Tests main function for cleaning the product, price changes and websites schema successfully."""
-    mock_conn.cursor.return_value = mock_cursor
-    mock_get_connection.return_value.__enter__.return_value = mock_conn
+@patch("remove_subscribers.delete_products", return_value=None)
+@patch("remove_subscribers.purge_table", return_value=(0, True))
+@patch("remove_subscribers.get_unsubscribed_product_ids", return_value=[1])
+@patch("remove_subscribers.get_connection")
+def test_main_remove_subscriptions_stops_on_skipped_products(mock_get_connection, mock_get_ids,
+                                                             mock_purge, mock_delete_products):
+    """Skipped products end the run instead of being retried forever."""
+    result = main_remove_subscriptions()
 
-    mock_cursor.fetchall.side_effect = [
-        [(1,), (2,)],
-        [(2,), (3,)],
-        [(1,), (2,), (3,), (4,)]]
+    mock_delete_products.assert_called_once()
+    assert result["finished"] is False
 
-    main_remove_subscriptions()
-    mock_cursor.execute.assert_called()
 
+def test_clean_websites(mock_cursor):
+    """Uses an anti-join rather than NOT IN."""
+    clean_websites(mock_cursor)
+
+    query = mock_cursor.execute.call_args[0][0]
+    assert "NOT EXISTS" in query
+    assert "NOT IN" not in query
 
-@patch('remove_subscribers.get_connection')
-def test_main_remove_subscriptions_no_unsubscribed(mock_get_connection, mock_conn, mock_cursor):
-    """Tests main_remove_subscriptions when there are no unsubscribed products."""
-    mock_conn.cursor.return_value = mock_cursor
-    mock_get_connection.return_value.__enter__.return_value = mock_conn
 
-    mock_cursor.fetchall.side_effect = [
-        [(1,), (2,)],
-        [(1,), (2,)]]
+@patch("remove_subscribers.delete_products", return_value=2)
+@patch("remove_subscribers.purge_table", return_value=(10, True))
+@patch("remove_subscribers.get_unsubscribed_product_ids", side_effect=[[1, 2], []])
+@patch("remove_subscribers.get_connection")
+def test_main_remove_subscriptions_valid(mock_get_connection, mock_get_ids,
+                                         mock_purge, mock_delete_products):
+    """Purges every referencing table, then the products."""
+    result = main_remove_subscriptions()
 
-    main_remove_subscriptions()
+    assert [call.args[1] for call in mock_purge.call_args_list] == list(PURGE_TABLES)
+    mock_delete_products.assert_called_once()
+    assert result["finished"] is True
+    assert result["deleted"]["price_changes"] == 10
+    assert result["deleted"]["product"] == 2
 
-    mock_cursor.execute.assert_any_call(
-        "SELECT DISTINCT product_id FROM subscription;")
-    mock_cursor.execute.assert_any_call("SELECT  product_id FROM product;")
 
-    assert mock_cursor.execute.call_count == 2
+@patch("remove_subscribers.delete_products")
+@patch("remove_subscribers.get_unsubscribed_product_ids", return_value=[])
+@patch("remove_subscribers.get_connection")
+def test_main_remove_subscriptions_no_unsubscribed(mock_get_connection, mock_get_ids,
+                                                   mock_delete_products):
+    """Nothing is deleted when every product has a subscriber."""
+    result = main_remove_subscriptions()
 
+    mock_delete_products.assert_not_called()
+    assert result["finished"] is True
 
-def test_delete_from_table_valid(mock_cursor):
-    """Tests delete_from_table constructs and executes correct query with parameters."""
-    table_name = "price_changes"
-    product_ids = [1, 2, 3]
 
-    expected_query = "DELETE FROM price_changes WHERE product_id = ANY(%s);"
-    expected_params = (product_ids,)
+@patch("remove_subscribers.delete_products")
+@patch("remove_subscribers.purge_table", return_value=(5000, False))
+@patch("remove_subscribers.get_unsubscribed_product_ids", return_value=[1])
+@patch("remove_subscribers.get_connection")
+def test_main_remove_subscriptions_out_of_time(mock_get_connection, mock_get_ids,
+                                               mock_purge, mock_delete_products):
+    """Products are left in place when their rows could not all be removed in time."""
+    result = main_remove_subscriptions(time_left=lambda: 60)
 
-    delete_from_table(mock_cursor, table_name, product_ids)
+    mock_delete_products.assert_not_called()
+    assert result["finished"] is False
 
-    mock_cursor.execute.assert_called_once_with(
-        expected_query, expected_params)
 
+@patch("remove_subscribers.get_unsubscribed_product_ids")
+@patch("remove_subscribers.get_connection")
+def test_main_remove_subscriptions_no_time_left(mock_get_connection, mock_get_ids):
+    """Nothing is started inside the safety margin."""
+    with patch.dict("os.environ", {"PURGE_TIME_MARGIN": "30"}):
+        result = main_remove_subscriptions(time_left=lambda: 10)
 
-def test_delete_from_price_changes_empty_product_ids(mock_cursor):
-    """Tests delete_from_table with an empty list of product_ids."""
-    table_name = "price_changes"
-    product_ids = []
+    mock_get_ids.assert_not_called()
+    assert result["finished"] is False
 
-    expected_query = "DELETE FROM price_changes WHERE product_id = ANY(%s);"
-    expected_params = (product_ids,)
 
-    delete_from_table(mock_cursor, table_name, product_ids)
+@patch("remove_subscribers.main_remove_subscriptions",
+       return_value={"deleted": {}, "finished": False})
+def test_lambda_handler_passes_remaining_time(mock_main_remove_subscriptions):
+    """The Lambda's remaining time is handed to the purge in seconds."""
+    context = Mock()
+    context.get_remaining_time_in_millis.return_value = 90000
 
-    mock_cursor.execute.assert_called_once_with(
-        expected_query, expected_params
-    )
+    result = lambda_handler(event={}, context=context)
+
+    time_left = mock_main_remove_subscriptions.call_args[0][0]
+    assert time_left() == 90
+    assert result["status_code"] == 200
+    assert "next run" in result["message"]
 
 
 @patch('remove_subscribers.main_remove_subscriptions', side_effect=Exception("Error"))
@@ -152,3 +210,8 @@ def test_lambda_handler_exception(mock_main_remove_subscriptions):
         "status_code": 500,
         "message": "Execution of subscription removal process was not successful."
     }
+
+
+def test_get_time_left_outside_lambda():
+    """Without a Lambda context there is no time limit."""
+    assert get_time_left({}) is None
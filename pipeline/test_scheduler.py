@@ -0,0 +1,61 @@
+# pylint: skip-file
+from unittest.mock import MagicMock, patch
+import pytest
+from scheduler import (get_schedule_mode, get_schedule_settings, next_interval,
+                       reschedule_products)
+
+SETTINGS = {"min_seconds": 150, "max_seconds": 3600, "backoff": 2,
+            "speedup": 4, "near_fraction": 0.1}
+
+
+def test_get_schedule_mode(monkeypatch):
+    """The adaptive schedule is the default and unknown schedules are rejected."""
+    monkeypatch.delenv("SCRAPE_SCHEDULE", raising=False)
+    assert get_schedule_mode() == "adaptive"
+
+    monkeypatch.setenv("SCRAPE_SCHEDULE", "sometimes")
+    with pytest.raises(ValueError):
+        get_schedule_mode()
+
+
+def test_get_schedule_settings_rejects_inverted_limits(monkeypatch):
+    """The shortest interval cannot be longer than the longest."""
+    monkeypatch.setenv("SCRAPE_INTERVAL_SECONDS", "600")
+    monkeypatch.setenv("SCRAPE_MAX_INTERVAL_SECONDS", "300")
+    with pytest.raises(ValueError):
+        get_schedule_settings()
+
+
+def test_next_interval_backs_off_unchanged_prices():
+    """A price that holds still is scraped less and less often, up to the maximum."""
+    assert next_interval(None, None, 10.0, None, SETTINGS) == 150
+    assert next_interval(150, 10.0, 10.0, None, SETTINGS) == 300
+    assert next_interval(3000, 10.0, 10.0, None, SETTINGS) == 3600
+
+
+def test_next_interval_tightens_on_price_changes():
+    """A price that moves is scraped more often, down to the minimum."""
+    assert next_interval(3600, 10.0, 9.0, None, SETTINGS) == 900
+    assert next_interval(300, 10.0, 11.0, None, SETTINGS) == 150
+
+
+def test_next_interval_near_notification_price():
+    """A price close to a subscriber's notification price is scraped as often as possible."""
+    assert next_interval(3600, 10.0, 10.0, 9.5, SETTINGS) == 150
+    assert next_interval(3600, 10.0, 10.0, 5.0, SETTINGS) == 3600
+
+
+@patch("scheduler.execute_values")
+def test_reschedule_products(mock_execute_values, monkeypatch):
+    """Every scraped product gets a new interval and due time, committed together."""
+    monkeypatch.setenv("SCRAPE_INTERVAL_SECONDS", "150")
+    monkeypatch.setenv("SCRAPE_BACKOFF", "2")
+    mock_execute_values.side_effect = [[(1, 150.0, 10.0, None), (2, None, None, 4.0)], None]
+    mock_conn = MagicMock()
+
+    reschedule_products(mock_conn, [{"product_id": 1, "price": 10.0},
+                                    {"product_id": 2, "price": 4.2}])
+
+    assert mock_execute_values.call_args_list[0][0][2] == [(1, 10.0), (2, 4.2)]
+    assert mock_execute_values.call_args_list[1][0][2] == [(1, 300.0, 300.0), (2, 150.0, 150.0)]
+    mock_conn.commit.assert_called_once()
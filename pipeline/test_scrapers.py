@@ -0,0 +1,182 @@
+# pylint: skip-file
+import pytest
+from scrapers import (PRICE_FIELDS, METADATA_FIELDS, SCRAPERS, get_scraper,
+                      get_website_from_url, scrape_product,
+                      scrape_from_steam_html, scrape_from_debenhams_html)
+
+STEAM_HTML = """
+<html>
+  <div id="game_area_purchase">
+    <div class="discount_original_price">£19.99</div>
+    <div class="discount_final_price">£9.99</div>
+  </div>
+  <div id="appHubAppName" class="apphub_AppName">Test Game</div>
+  <img class="game_header_image_full" src="https://testing.com/test.jpg">
+  <div class="game_description_snippet"> Testing Description </div>
+</html>
+"""
+
+DEBENHAMS_HTML = """
+<html>
+  <h1 class='text-xl'>Test Product</h1>
+    <span data-test-id='product-price-current'>£320.00</span>
+    <span data-test-id='product-price-was'>£330.00</span>
+    <div class='prose'>A test product.</div>
+    <img class='h-auto w-auto object-cover undefined undefined' src='product.jpg'>
+</html>
+"""
+
+
+def test_get_website_from_url_com_websites():
+    """Tests if .com websites gets replaced correctly."""
+    result = get_website_from_url("https://store.steampowered.com/app/12345")
+    assert result == "https://store.steampowered.com"
+
+    result = get_website_from_url("https://www.debenhams.com/product")
+    assert result == "https://www.debenhams.com"
+
+
+def test_get_website_from_url_co_uk_websites():
+    """Tests if website name is extracted correctly."""
+    assert get_website_from_url(
+        "something.co.uk/something-else") == "something.co.uk"
+
+
+def test_get_website_from_url_edge_cases():
+    """Test get_website_from_url with unusual input."""
+    assert get_website_from_url(
+        "https://example.com/") == "https://example.com"
+    assert get_website_from_url("http://example.com") == "http://example.com"
+    assert get_website_from_url("ftp://example.com") == "ftp://example.com"
+
+
+def test_get_scraper_by_host():
+    """Scrapers are looked up by the URL's host."""
+    assert get_scraper("https://store.steampowered.com/app/1")["scrape"] is scrape_from_steam_html
+    assert get_scraper("https://WWW.DEBENHAMS.COM/product")["scrape"] is scrape_from_debenhams_html
+    assert get_scraper("https://unknown.co.uk/store.steampowered.com") is None
+    assert all(METADATA_FIELDS <= scraper["fields"] for scraper in SCRAPERS.values())
+
+
+def test_scrape_product_rejects_undeclared_fields():
+    """Asking for a field the scraper does not declare is an error."""
+    with pytest.raises(ValueError):
+        scrape_product(STEAM_HTML, "https://store.steampowered.com/app/1",
+                       PRICE_FIELDS | {"stock_level"})
+
+
+def test_scrape_from_steam_html_valid():
+    """Test scraping product info from Steam sample HTML."""
+    result = scrape_from_steam_html(STEAM_HTML.encode(), "https://store.steampowered.com/app/12345/")
+    assert result == {
+        "original_price": "£19.99",
+        "discount_price": "£9.99",
+        "product_name": "Test Game",
+        "website": "https://store.steampowered.com"
+    }
+
+
+def test_scrape_from_steam_html_full_metadata():
+    """The full metadata path also finds the image and description."""
+    result = scrape_product(STEAM_HTML, "https://store.steampowered.com/app/12345/",
+                            METADATA_FIELDS)
+    assert result["image_url"] == "https://testing.com/test.jpg"
+    assert result["product_description"] == "Testing Description"
+    assert result["discount_price"] == "£9.99"
+
+
+def test_scrape_from_steam_html_missing_description():
+    """A Steam page without a description gets the dashboard's placeholder."""
+    steam_html = STEAM_HTML.replace(
+        '<div class="game_description_snippet"> Testing Description </div>', "")
+    result = scrape_product(steam_html, "https://store.steampowered.com/app/12345/",
+                            METADATA_FIELDS)
+    assert result["product_description"] == "No description found."
+    assert result["image_url"] == "https://testing.com/test.jpg"
+
+
+def test_scrape_from_steam_html_invalid():
+    """Test scraping product info from Steam sample HTML with missing price elements."""
+    steam_html = """
+    <html>
+      <div id="game_area_purchase"></div>
+      <div id="appHubAppName" class="apphub_AppName">Test Game</div>
+    </html>
+    """
+    result = scrape_from_steam_html(steam_html.encode(), "https://store.steampowered.com/app/12345/")
+    assert result == {
+        "original_price": "N/A",
+        "discount_price": "N/A",
+        "product_name": "Test Game",
+        "website": "https://store.steampowered.com"
+    }
+
+
+def test_scrape_from_steam_html_no_game_title():
+    """Test scrape_from_steam_html when game title is missing."""
+    steam_html = """
+    <html>
+      <div id="game_area_purchase">
+        <div class="discount_original_price">£19.99</div>
+        <div class="discount_final_price">£9.99</div>
+      </div>
+    </html>
+    """
+    result = scrape_from_steam_html(
+        steam_html.encode(), "https://store.steampowered.com/app/12345")
+    assert result == None
+
+
+def test_scrape_from_debenhams_html_valid():
+    """Tests product information is scraped successfully for debenhams."""
+    result = scrape_from_debenhams_html(
+        DEBENHAMS_HTML, "https://www.debenhams.com/product")
+    assert result == {
+        "original_price": "£330.00",
+        "discount_price": "£320.00",
+        "product_name": "Test Product",
+        "website": "https://www.debenhams.com"
+    }
+
+
+def test_scrape_from_debenhams_html_full_metadata():
+    """The full metadata path also finds the image and description."""
+    result = scrape_from_debenhams_html(
+        DEBENHAMS_HTML, "https://www.debenhams.com/product", METADATA_FIELDS)
+    assert result["image_url"] == "product.jpg"
+    assert result["product_description"] == "A test product."
+
+
+def test_scrape_from_debenhams_html_missing_metadata():
+    """A Debenhams page without an image still gives its prices, but one
+    without a description is rejected, as the dashboard always did."""
+    debenhams_html = """
+    <html>
+      <h1 class="text-xl">Test Product</h1>
+      <span data-test-id='product-price-current'>£320.00</span>
+      <div class='prose'>A test product.</div>
+    </html>
+    """
+    result = scrape_from_debenhams_html(
+        debenhams_html, "https://www.debenhams.com/product", METADATA_FIELDS)
+    assert result["original_price"] == "£320.00"
+    assert result["image_url"] is None
+    assert result["product_description"] == "A test product."
+
+    no_description = debenhams_html.replace("<div class='prose'>A test product.</div>", "")
+    assert scrape_from_debenhams_html(
+        no_description, "https://www.debenhams.com/product", METADATA_FIELDS) is None
+    assert scrape_from_debenhams_html(
+        no_description, "https://www.debenhams.com/product")["discount_price"] == "£320.00"
+
+
+def test_scrape_from_debenhams_html_no_prices():
+    """Test scrape_from_debenhams_html when prices are missing."""
+    debenhams_html = """
+    <html>
+      <h1 class="text-xl">Test Product</h1>
+    </html>
+    """
+    result = scrape_from_debenhams_html(
+        debenhams_html.encode(), "https://www.debenhams.com/product")
+    assert result is None
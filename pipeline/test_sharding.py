@@ -0,0 +1,134 @@
+# pylint: skip-file
+from unittest.mock import MagicMock, patch
+import pytest
+from sharding import (get_shard_mode, get_shard, get_worker_id, claim_products,
+                      complete_products, leased_url_batches, advisory_lock)
+from etl import notify, stream_products
+
+
+def test_get_shard_mode_defaults_to_none(monkeypatch):
+    """One worker scrapes everything unless a shard mode is chosen."""
+    monkeypatch.delenv("ETL_SHARD_MODE", raising=False)
+    assert get_shard_mode() == "none"
+
+    monkeypatch.setenv("ETL_SHARD_MODE", "random")
+    with pytest.raises(ValueError):
+        get_shard_mode()
+
+
+def test_get_shard(monkeypatch):
+    """The shard index must be below the shard count."""
+    monkeypatch.setenv("ETL_SHARD_COUNT", "4")
+    monkeypatch.setenv("ETL_SHARD_INDEX", "3")
+    assert get_shard() == (4, 3)
+
+    monkeypatch.setenv("ETL_SHARD_INDEX", "4")
+    with pytest.raises(ValueError):
+        get_shard()
+
+
+def test_get_worker_id(monkeypatch):
+    """ETL_WORKER_ID overrides the host and process name."""
+    monkeypatch.setenv("ETL_WORKER_ID", "task-1")
+    assert get_worker_id() == "task-1"
+
+
+def test_claim_products_commits_the_lease():
+    """Claims return [id, url] pairs and are committed straight away."""
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchall.return_value = [(1, "https://a"), (2, "https://b")]
+
+    assert claim_products(mock_conn, "worker", 2, 60) == [
+        [1, "https://a"], [2, "https://b"]]
+    assert mock_cursor.execute.call_args[0][1] == ("worker", 60, 2)
+    assert "FOR UPDATE SKIP LOCKED" in mock_cursor.execute.call_args[0][0]
+    mock_conn.commit.assert_called_once()
+
+
+def test_complete_products_only_releases_own_leases():
+    """Completing checks the lease is still held by this worker."""
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.rowcount = 1
+
+    assert complete_products(mock_conn, "worker", [1, 2], 150) == 1
+    assert mock_cursor.execute.call_args[0][1] == (150, [1, 2], "worker")
+    assert "leased_by = %s" in mock_cursor.execute.call_args[0][0]
+
+
+@patch("sharding.complete_products")
+@patch("sharding.claim_products", side_effect=[[[1, "a"]], [[2, "b"]], []])
+@patch("sharding.sync_leases")
+@patch("sharding.get_connection")
+def test_leased_url_batches_completes_each_batch(mock_get_connection, mock_sync, mock_claim,
+                                                 mock_complete):
+    """Each batch is completed once processed, until nothing is due."""
+    assert list(leased_url_batches("worker")) == [[[1, "a"]], [[2, "b"]]]
+
+    assert [call.args[2] for call in mock_complete.call_args_list] == [[1], [2]]
+    mock_get_connection.return_value.close.assert_called_once()
+
+
+@patch("sharding.complete_products")
+@patch("sharding.claim_products", return_value=[[1, "a"]])
+@patch("sharding.sync_leases")
+@patch("sharding.get_connection")
+def test_leased_url_batches_keeps_lease_on_failure(mock_get_connection, mock_sync, mock_claim,
+                                                   mock_complete):
+    """A batch that fails is not completed, so its lease expires and another worker retries it."""
+    batches = leased_url_batches("worker")
+    next(batches)
+    batches.close()
+
+    mock_complete.assert_not_called()
+    mock_get_connection.return_value.close.assert_called_once()
+
+
+@patch("sharding.get_connection")
+def test_advisory_lock(mock_get_connection):
+    """The lock is tried without waiting and released with its connection."""
+    mock_cursor = mock_get_connection.return_value.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.return_value = (False,)
+
+    with advisory_lock(1) as acquired:
+        assert not acquired
+    mock_get_connection.return_value.close.assert_called_once()
+
+
+@patch("etl.check_and_notify")
+@patch("etl.advisory_lock")
+def test_notify_once_when_sharded(mock_lock, mock_notify):
+    """Sharded workers only notify when they hold the notification lock."""
+    mock_lock.return_value.__enter__.return_value = False
+    notify("lease")
+    mock_notify.assert_not_called()
+
+    mock_lock.return_value.__enter__.return_value = True
+    notify("modulo")
+    mock_notify.assert_called_once()
+
+
+@patch("etl.stream_load", side_effect=lambda rows: len(list(rows)))
+@patch("extract.close_sessions")
+@patch("extract.save_cache")
+@patch("extract.load_cache")
+@patch("extract.get_html_from_url", return_value=b"<html></html>")
+@patch("extract.scrape_pricing_process",
+       side_effect=lambda html, url, product_id: {"product_id": product_id,
+                                                  "discount_price": "£1.00"})
+@patch("etl.leased_url_batches",
+       return_value=iter([[[1, "https://a.com/1"], [2, "https://a.com/2"]],
+                          [[3, "https://a.com/3"]], [[4, "https://b.com/4"]]]))
+def test_stream_products_lease_mode(mock_batches, mock_scrape, mock_get_html, mock_load_cache,
+                                    mock_save_cache, mock_close_sessions, mock_load, monkeypatch):
+    """Lease workers stream every batch they claim, loading each batch on its own
+    but setting up the cache and sessions only once for the whole run."""
+    monkeypatch.setenv("PARSE_WORKERS", "0")
+
+    assert stream_products("lease") == 4
+
+    assert mock_load.call_count == 3
+    mock_load_cache.assert_called_once()
+    mock_save_cache.assert_called_once()
+    mock_close_sessions.assert_called_once()
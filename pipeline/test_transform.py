@@ -2,7 +2,7 @@
 # pylint: skip-file
 import unittest
 from datetime import datetime
-from transform import clean_price, main_transform_product_data
+from transform import clean_price, transform_products
 
 
 def test_clean_price_valid():
@@ -25,7 +25,7 @@ def test_transform_product_data_valid():
     test_data = [
         {"product_id": 1, "discount_price": "£22.49", "game_title": "Test Game"}
     ]
-    result = main_transform_product_data(test_data)
+    result = list(transform_products(test_data))
     assert result[0]["product_id"] == 1
     assert result[0]["price"] == 22.49
     assert isinstance(result[0]["timestamp"],
@@ -40,5 +40,14 @@ def test_transform_invalid_data():
         {"discount_price": "£22.49"}
     ]
 
-    result = main_transform_product_data(invalid_data)
+    result = list(transform_products(invalid_data))
     assert len(result) == 0
+
+
+def test_transform_products_is_lazy():
+    """Tests products are cleaned one at a time as they are pulled."""
+    def products():
+        yield {"product_id": 1, "discount_price": "£1.00"}
+        raise AssertionError("Read past the first product")
+
+    assert next(transform_products(products()))["price"] == 1.0
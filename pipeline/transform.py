@@ -1,7 +1,9 @@
 """Processes and cleans the data extracted from extract.py"""
 from datetime import datetime
 import logging
+from typing import Iterable, Iterator
 from connect_to_database import configure_logging
+from metrics import increment
 
 
 def clean_price(price_str: str) -> float:
@@ -14,30 +16,27 @@ def clean_price(price_str: str) -> float:
         return None
 
 
-def main_transform_product_data(products_data: list[dict]) -> list[dict]:
-    """Transforms scraped raw product data into cleaned data ready to be uploaded"""
-    cleaned_data = []
-
+def transform_products(products_data: Iterable[dict]) -> Iterator[dict]:
+    """Cleans scraped raw product data one product at a time, skipping invalid products"""
     for product in products_data:
         try:
             price = clean_price(product["discount_price"])
             if not price:
                 logging.error("Invalid price: {%s}", product['product_id'])
+                increment("rows_invalid")
                 continue
 
-            cleaned_product_data = {
+            yield {
                 "price": price,
                 "product_id": int(product["product_id"]),
                 "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             }
-            cleaned_data.append(cleaned_product_data)
         except (KeyError, ValueError) as e:
             logging.error("Error transforming product %s: %s",
                           product.get("product_id"), str(e))
+            increment("rows_invalid")
             continue
 
-    return cleaned_data
-
 
 if __name__ == "__main__":
 
@@ -47,5 +46,5 @@ if __name__ == "__main__":
                      'game_title': 'Stardew Valley', 'website': 'https://store.steampowered.com'},
                  {'product_id': 5, 'original_price': '£149.99', 'discount_price': '£129.99', 'product_name': 'Smartwatch', 'website': 'https://www.target.com/smartwatch'}]
 
-    new_data = main_transform_product_data(fake_data)
+    new_data = list(transform_products(fake_data))
     print(new_data)
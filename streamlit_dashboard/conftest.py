@@ -0,0 +1,6 @@
+# pylint: skip-file
+import os
+import sys
+
+# The retailer scrapers are shared with the pipeline, which owns them.
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "pipeline"))
@@ -1,20 +1,20 @@
 """Runs the streamlit dashboard"""
 
 from datetime import timedelta
+import math
+import os
 import pandas as pd
 import altair as alt
 import streamlit as st
 from streamlit_option_menu import option_menu
 from streamlit_card import card
-from database_connection import (get_connection, get_cursor,
-                                 insert_initial_price, insert_into_product,
-                                 insert_into_subscription, insert_into_website,
+from database_connection import (pooled_connection, get_cursor, get_pool_stats,
+                                 enqueue_onboarding_job, get_onboarding_jobs,
                                  get_latest_price, get_product_info,
-                                 create_account, get_user_id, get_product_subscription,
+                                 create_account, get_user_id, get_product_cards,
                                  stop_tracking_product, execute_database_select_query_fetchall)
-from dashboard_etl import (get_html_from_url, get_website_from_url,
-                           scrape_pricing_process, clean_price)
 
+from query_cache import cached_query, invalidate, get_cache_stats
 from homepage import home_page
 
 st.set_page_config(page_title="Price Slashers - Sales Tracker",
@@ -27,26 +27,77 @@ logout_section = st.container()
 product_section = st.container()
 
 
-def display_charts(product_id) -> alt.Chart:
-    """Displays charts for a product"""
-    if not product_id:
-        st.warning("Please select a valid product.")
-        return None
+def get_price_steps(df: pd.DataFrame, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    """Returns the prices between start and end as a series of steps.
+    Prices are only stored when they change, so the price in force at start
+    is carried in from the last change before it, and the latest price is
+    carried on to end."""
+    df = df.sort_values('Date')
+    before_start = df[df['Date'] < start]
+    steps = df[(df['Date'] >= start) & (df['Date'] <= end)]
+
+    if not before_start.empty:
+        steps = pd.concat([pd.DataFrame({'Price': [before_start['Price'].iloc[-1]],
+                                         'Date': [start]}), steps])
+    if steps.empty:
+        return steps
+
+    steps = pd.concat([steps, pd.DataFrame({'Price': [steps['Price'].iloc[-1]],
+                                            'Date': [end]})])
+    return steps.reset_index(drop=True)
+
+
+def get_bucket_seconds(time_range: timedelta) -> int:
+    """Returns the bucket width that keeps a chart of time_range within MAX_CHART_POINTS points"""
+    max_points = int(os.environ.get("MAX_CHART_POINTS", 500))
+    return max(1, math.ceil(time_range.total_seconds() / max_points))
 
+
+@cached_query
+def get_price_history(product_id: int, range_seconds: int, bucket_seconds: int) -> list:
+    """Returns (price, timestamp) rows to chart a product over the last range_seconds,
+    with one change per bucket_seconds"""
+    # The price in force when the window opens, then the last change in each bucket.
+    # Once the raw rows before the window are rolled up and dropped, the price in
+    # force is the last daily rollup, or the latest price if it has not moved since
     query = """
-    SELECT price, timestamp 
-    FROM price_changes 
+    (SELECT price, timestamp
+    FROM price_changes
+    WHERE product_id = %s
+    AND timestamp < NOW() - make_interval(secs => %s)
+    ORDER BY timestamp DESC
+    LIMIT 1)
+    UNION ALL
+    (SELECT last_price, bucket
+    FROM price_changes_daily
+    WHERE product_id = %s
+    AND bucket < NOW() - make_interval(secs => %s)
+    ORDER BY bucket DESC
+    LIMIT 1)
+    UNION ALL
+    (SELECT price, timestamp
+    FROM product_latest_price
     WHERE product_id = %s
-    ORDER BY timestamp
+    AND timestamp < NOW() - make_interval(secs => %s))
+    UNION ALL
+    (SELECT DISTINCT ON (floor(extract(epoch FROM timestamp) / %s)) price, timestamp
+    FROM price_changes
+    WHERE product_id = %s
+    AND timestamp >= NOW() - make_interval(secs => %s)
+    ORDER BY floor(extract(epoch FROM timestamp) / %s), timestamp DESC)
     """
-    result = execute_database_select_query_fetchall(
-        query, (product_id,), f"No price data available for Product ID {product_id}.")
+    return execute_database_select_query_fetchall(
+        query, (product_id, range_seconds, product_id, range_seconds,
+                product_id, range_seconds, bucket_seconds,
+                product_id, range_seconds, bucket_seconds))
 
-    df = pd.DataFrame(result, columns=['Price', 'Date'])
 
-    df['Date'] = pd.to_datetime(df['Date'], utc=True)
+def display_charts(product_id) -> alt.Chart:
+    """Displays charts for a product"""
+    if not product_id:
+        st.warning("Please select a valid product.")
+        return None
 
-    current_time = pd.Timestamp.now(tz='UTC')
     time_ranges = {
         "Last 3 Days": timedelta(days=3),
         "Last 24 Hours": timedelta(hours=24),
@@ -56,31 +107,36 @@ def display_charts(product_id) -> alt.Chart:
     time_range = st.selectbox(
         "Select Time Range", list(time_ranges.keys()))
 
-    most_recent_timestamp = df['Date'].max()
+    range_seconds = int(time_ranges[time_range].total_seconds())
+    bucket_seconds = get_bucket_seconds(time_ranges[time_range])
 
-    if time_range == "Last 30 Minutes" or time_range == "Last 24 Hours":
-        filtered_df = df[df['Date'] >= (
-            most_recent_timestamp - time_ranges[time_range])].copy()
+    result = get_price_history(product_id, range_seconds, bucket_seconds)
+    if not result:
+        st.warning(f"No price data available for Product ID {product_id}.")
+        return None
 
-        filtered_df.loc[:, 'FormattedDate'] = filtered_df['Date'].dt.strftime(
-            '%H:%M')
-    else:
-        filtered_df = df[df["Date"] >= (
-            current_time - time_ranges[time_range])].copy()
+    df = pd.DataFrame(result, columns=['Price', 'Date'])
+
+    df['Date'] = pd.to_datetime(df['Date'], utc=True)
 
-        filtered_df.loc[:, 'FormattedDate'] = filtered_df['Date'].dt.strftime(
-            '%Y-%m-%d %H:%M:%S')
+    current_time = pd.Timestamp.now(tz='UTC')
+
+    filtered_df = get_price_steps(
+        df, current_time - time_ranges[time_range], current_time)
 
     if filtered_df.empty:
         st.warning("No price data available for the selected time range.")
         return None
 
-    chart = alt.Chart(filtered_df).mark_line().encode(
-        x=alt.X('FormattedDate:N',
+    date_format = '%Y-%m-%d %H:%M' if time_range == "Last 3 Days" else '%H:%M'
+
+    chart = alt.Chart(filtered_df).mark_line(interpolate='step-after').encode(
+        x=alt.X('Date:T',
                 title='Timestamp',
                 axis=alt.Axis(
                     labelAngle=-45,
-                    tickCount=10
+                    tickCount=10,
+                    format=date_format
                 )),
         y=alt.Y('Price:Q', title='Price / £'),
         tooltip=['Date:T', 'Price:Q']
@@ -95,20 +151,19 @@ def display_charts(product_id) -> alt.Chart:
 
 def login(email: str, password: str) -> bool:
     """Checks if email and password are in the database"""
-    conn = get_connection()
-    cursor = get_cursor(conn)
     try:
-        query = """
+        with pooled_connection() as conn:
+            cursor = get_cursor(conn)
+            query = """
         SELECT EXISTS (
             SELECT 1
             FROM users
             WHERE email_address = %s AND password = %s
         );
         """
-        cursor.execute(query, (email, password))
-        user = cursor.fetchone()[0]
-        cursor.close()
-        conn.close()
+            cursor.execute(query, (email, password))
+            user = cursor.fetchone()[0]
+            cursor.close()
         if user:
             return True
         else:
@@ -119,14 +174,45 @@ def login(email: str, password: str) -> bool:
 
 
 def track_product(user_id, url, notification_price):
-    """Inserts product details into the database"""
-    website_id = insert_into_website(get_website_from_url(url))
-    product_id = insert_into_product(website_id, url)
-    insert_into_subscription(user_id, product_id, notification_price)
-    price = (scrape_pricing_process(get_html_from_url(url), url)).get(
-        "discount_price")
-    insert_initial_price(clean_price(price), product_id)
-    st.toast("New product successfully tracked!")
+    """Queues the product for the onboarding worker, which scrapes the page and
+    inserts it in the background, and remembers the job so its progress can be shown"""
+    job_id = enqueue_onboarding_job(user_id, url, notification_price)
+    if not job_id:
+        return
+    st.session_state.setdefault("onboarding_jobs", {})[job_id] = (url, "queued", None)
+    st.toast("Product queued for tracking!")
+
+
+def get_job_status(status: str, url: str, error: str) -> tuple:
+    """Returns the st.status label and state for an onboarding job"""
+    if status == "done":
+        return f"Now tracking {url}", "complete"
+    if status == "failed":
+        return f"Could not track {url}: {error}", "error"
+    if status == "running":
+        return f"Fetching {url}...", "running"
+    return f"Waiting to fetch {url}...", "running"
+
+
+@st.fragment(run_every=float(os.environ.get("ONBOARDING_REFRESH_SECONDS", 2)))
+def show_onboarding_jobs():
+    """Shows the progress of this session's tracking requests. Only jobs still
+    pending are looked up, and the product caches are refreshed when one finishes"""
+    jobs = st.session_state.get("onboarding_jobs")
+    if not jobs:
+        return
+    pending = [job_id for job_id, (_, status, _) in jobs.items()
+               if status in ("queued", "running")]
+    if pending:
+        for job_id, url, status, error, product_id in get_onboarding_jobs(pending) or []:
+            jobs[job_id] = (url, status, error)
+            if status == "done":
+                invalidate(get_product_cards, st.session_state.get('user_id'))
+                invalidate(get_latest_price, product_id)
+                invalidate(get_price_history, product_id)
+    for url, status, error in jobs.values():
+        label, state = get_job_status(status, url, error)
+        st.status(label, state=state)
 
 
 def show_about_page():
@@ -186,19 +272,21 @@ def view_product(product_id, user_id):
                 st.toast(f"""You unsubscribed from tracking {product_name}""")
 
 
+@cached_query
 def get_user_name(user_id: int):
     """Returns the first and last name of the user from the database."""
 
-    conn = get_connection()
-    cursor = get_cursor(conn)
-    cursor.execute(
-        """
-        SELECT first_name
-        FROM users
-        WHERE user_id = %s;
-        """, (user_id,)
-    )
-    result = cursor.fetchone()
+    with pooled_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute(
+            """
+            SELECT first_name
+            FROM users
+            WHERE user_id = %s;
+            """, (user_id,)
+        )
+        result = cursor.fetchone()
+        cursor.close()
     if result:
         first_name = result[0]
         return first_name
@@ -216,6 +304,7 @@ def show_track_page():
         label="Enter the price threshold to receive email notifications about price drops: ")
     st.button("Track", on_click=track_clicked,
               args=(user_id, url, notification_price))
+    show_onboarding_jobs()
 
 
 def show_current_products_page():
@@ -227,20 +316,12 @@ def show_current_products_page():
         st.title(f"{user_name}'s Current Products")
     else:
         st.title("Current Products")
-    product_subscriptions = get_product_subscription(user_id)
-    if not product_subscriptions:
+    product_cards = get_product_cards(user_id)
+    if not product_cards:
         st.markdown("You are not currently tracking anything!")
     else:
         cols = st.columns(3, gap="small")
-        product_info = []
-        for product_id in product_subscriptions:
-            extracted_info = list(get_product_info(product_id))
-            extracted_info.append(product_id[0])
-            product_info.append(extracted_info)
-        for i, product in enumerate(product_info):
-            product_name = product[0]
-            latest_price = get_latest_price(product[-1])
-            image = product[4]
+        for i, (product_id, product_name, image, latest_price) in enumerate(product_cards):
             with cols[i % 3]:
                 card(
 
@@ -254,7 +335,8 @@ def show_current_products_page():
                     }, "div": {
                         "background": "#0000000"
                     }},
-                    on_click=lambda: set_product(product[-1])
+                    on_click=lambda product_id=product_id: set_product(
+                        product_id)
                 )
 
 
@@ -266,6 +348,12 @@ def show_main_page():
             page = option_menu(
                 menu_title="", options=["About", "Current products", "Track new products"], icons=["question-circle", "bag", "plus-lg"])
             st.button("Log Out", key="logout", on_click=logged_out_clicked)
+            if os.environ.get("SHOW_DIAGNOSTICS"):
+                with st.expander("Diagnostics"):
+                    st.caption("Database connection pool")
+                    st.json(get_pool_stats())
+                    st.caption("Query result cache")
+                    st.json(get_cache_stats())
         user_id = st.session_state.get('user_id')
         if "current_product" in st.session_state:
             view_product(st.session_state.current_product, user_id)
@@ -322,14 +410,12 @@ def create_account_clicked(first_name, last_name, new_email, new_password) -> No
 
 
 def track_clicked(user_id, url, notification_price) -> None:
-    """Tracks product"""
+    """Validates the form and queues the product. The page is fetched by the
+    onboarding worker, so the session does not wait on the retailer"""
     error_present = False
     if not url or not notification_price:
         st.error("All fields are required to track a product.")
         error_present = True
-    elif not scrape_pricing_process(get_html_from_url(url), url):
-        st.error("Cannot fetch data from that link.")
-        error_present = True
     try:
         notification_price = float(notification_price)
         if notification_price <= 0:
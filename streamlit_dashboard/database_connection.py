@@ -1,31 +1,136 @@
 """Useful functions for connecting to the database."""
 
+from contextlib import contextmanager
 from datetime import datetime
 import os
+import threading
+import traceback
+from time import monotonic
 from dotenv import load_dotenv
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 import streamlit as st
-from dashboard_etl import (scrape_pricing_process,
-                           clean_price,
-                           get_html_from_url)
+from dashboard_etl import clean_price
+from query_cache import cached_query, invalidate
 
 load_dotenv()
 
+CHECKED_OUT = {}
+CHECKED_OUT_LOCK = threading.Lock()
+POOL_STATS = {"checkouts": 0, "returns": 0, "discarded": 0, "leaks": 0,
+              "max_in_use": 0, "max_wait_seconds": 0.0}
+
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    """A ThreadedConnectionPool that waits up to timeout seconds for a free
+    connection rather than raising as soon as maxconn are in use."""
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+
+    def getconn(self, key=None):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolError("Timed out waiting for a free database connection")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self.slots.release()
+
+
+@st.cache_resource
+def get_connection_pool() -> BlockingConnectionPool:
+    """Creates the connection pool shared by every session of the dashboard"""
+    return BlockingConnectionPool(
+        int(os.environ.get("DB_POOL_MIN_CONNECTIONS", 1)),
+        int(os.environ.get("DB_POOL_MAX_CONNECTIONS", 10)),
+        float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+        dbname=os.environ["DB_NAME"],
+        user=os.environ["DB_USER"],
+        password=os.environ["DB_PASSWORD"],
+        host=os.environ["DB_HOST"],
+        port=os.environ["DB_PORT"]
+    )
+
+
+def check_for_leaks() -> None:
+    """Reports connections that have been checked out for longer than DB_POOL_LEAK_SECONDS"""
+    max_age = float(os.environ.get("DB_POOL_LEAK_SECONDS", 30))
+    now = monotonic()
+    with CHECKED_OUT_LOCK:
+        for checkout in CHECKED_OUT.values():
+            if not checkout["reported"] and now - checkout["since"] > max_age:
+                checkout["reported"] = True
+                POOL_STATS["leaks"] += 1
+                print(f"Database connection checked out for over {max_age:.0f}s "
+                      f"without being returned, checked out at:\n"
+                      f"{''.join(traceback.format_list(checkout['stack']))}")
+
 
 def get_connection():
-    """Gets connection to the database"""
+    """Checks a connection out of the pool. Return it with release_connection"""
+    check_for_leaks()
+    start = monotonic()
     try:
-        connection = psycopg2.connect(
-            dbname=os.environ["DB_NAME"],
-            user=os.environ["DB_USER"],
-            password=os.environ["DB_PASSWORD"],
-            host=os.environ["DB_HOST"],
-            port=os.environ["DB_PORT"]
-        )
-        return connection
+        connection = get_connection_pool().getconn()
     except psycopg2.Error as e:
         print(f"Error connecting to the database: {e}")
         return None
+    with CHECKED_OUT_LOCK:
+        CHECKED_OUT[id(connection)] = {"since": monotonic(), "reported": False,
+                                       "stack": traceback.extract_stack(limit=6)[:-1]}
+        POOL_STATS["checkouts"] += 1
+        POOL_STATS["max_in_use"] = max(POOL_STATS["max_in_use"], len(CHECKED_OUT))
+        POOL_STATS["max_wait_seconds"] = max(POOL_STATS["max_wait_seconds"],
+                                             monotonic() - start)
+    return connection
+
+
+def release_connection(conn, discard: bool = False) -> None:
+    """Returns a connection to the pool. Broken or discarded connections are
+    closed, and connections that did not come from the pool are just closed"""
+    if conn is None:
+        return
+    with CHECKED_OUT_LOCK:
+        checkout = CHECKED_OUT.pop(id(conn), None)
+        if checkout:
+            POOL_STATS["returns"] += 1
+            POOL_STATS["discarded"] += discard or bool(conn.closed)
+    if checkout is None:
+        conn.close()
+        return
+    get_connection_pool().putconn(conn, close=discard or bool(conn.closed))
+
+
+@contextmanager
+def pooled_connection():
+    """Checks a connection out of the pool for the length of a with block"""
+    conn = get_connection()
+    discard = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        release_connection(conn, discard)
+
+
+def get_pool_stats() -> dict:
+    """Returns the pool's size and usage counters"""
+    pool = get_connection_pool()
+    with CHECKED_OUT_LOCK:
+        return {**POOL_STATS, "in_use": len(CHECKED_OUT),
+                "idle": len(pool._pool),  # pylint: disable=protected-access
+                "max_connections": pool.maxconn}
 
 
 def get_cursor(conn):
@@ -39,54 +144,54 @@ def get_cursor(conn):
     return None
 
 
-def execute_database_select_query_fetchall(query: str,
-                                           var: tuple, error: str) -> list:
-    """Executes database select query. Returns data as a list"""
-    conn = get_connection()
-    cursor = get_cursor(conn)
-    cursor.execute(query, var)
-    result = cursor.fetchall()
-    cursor.close()
-    conn.close()
+def execute_database_select_query_fetchall(query: str, var: tuple) -> list:
+    """Executes database select query. Returns data as a list, or None if
+    there are no rows"""
+    with pooled_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute(query, var)
+        result = cursor.fetchall()
+        cursor.close()
     if not result:
-        st.warning(error)
         return None
     return result
 
 
 def execute_database_select_query_fetchone(query: str, var: tuple) -> list:
     """Executes database select query. Returns data as a list"""
-    conn = get_connection()
-    cursor = get_cursor(conn)
-    cursor.execute(query, var)
-    result = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with pooled_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute(query, var)
+        result = cursor.fetchall()
+        cursor.close()
     return result
 
 
 def get_website_id(website: str) -> int:
     """Checks if website exists and returns website id"""
     try:
-        conn = get_connection()
-        cursor = get_cursor(conn)
-        query = "SELECT website_id FROM website WHERE website_name = %s"
-        cursor.execute(query, (website,))
-        result = cursor.fetchone()
+        with pooled_connection() as conn:
+            cursor = get_cursor(conn)
+            query = "SELECT website_id FROM website WHERE website_name = %s"
+            cursor.execute(query, (website,))
+            result = cursor.fetchone()
+            cursor.close()
         return result[0] if result else None
     except psycopg2.Error as e:
         print(f"Database error: {e}")
         return None
 
 
+@cached_query
 def get_user_id(email: str) -> int:
     """Checks if user exists and returns user_id"""
     try:
-        conn = get_connection()
-        cursor = get_cursor(conn)
-        query = "SELECT user_id FROM users WHERE email_address = %s"
-        cursor.execute(query, (email,))
-        result = cursor.fetchone()
+        with pooled_connection() as conn:
+            cursor = get_cursor(conn)
+            query = "SELECT user_id FROM users WHERE email_address = %s"
+            cursor.execute(query, (email,))
+            result = cursor.fetchone()
+            cursor.close()
         return result[0] if result else None
     except psycopg2.Error as e:
         print(f"Database error: {e}")
@@ -96,11 +201,12 @@ def get_user_id(email: str) -> int:
 def get_product_id(url: str) -> int:
     """Checks if product exists and returns product_id"""
     try:
-        conn = get_connection()
-        cursor = get_cursor(conn)
-        query = "SELECT product_id FROM product WHERE url = %s"
-        cursor.execute(query, (url,))
-        result = cursor.fetchone()
+        with pooled_connection() as conn:
+            cursor = get_cursor(conn)
+            query = "SELECT product_id FROM product WHERE url = %s"
+            cursor.execute(query, (url,))
+            result = cursor.fetchone()
+            cursor.close()
         return result[0] if result else None
     except psycopg2.Error as e:
         print(f"Database error: {e}")
@@ -110,163 +216,199 @@ def get_product_id(url: str) -> int:
 def get_subscription_id(user_id: str, product_id: int) -> int:
     """Checks if subscription exists and returns subscription_id"""
     try:
-        conn = get_connection()
-        cursor = get_cursor(conn)
-        query = "SELECT subscription_id FROM subscription WHERE user_id = %s and product_id = %s"
-        cursor.execute(query, (user_id, product_id,))
-        result = cursor.fetchone()
+        with pooled_connection() as conn:
+            cursor = get_cursor(conn)
+            query = """SELECT subscription_id FROM subscription
+                WHERE user_id = %s and product_id = %s"""
+            cursor.execute(query, (user_id, product_id,))
+            result = cursor.fetchone()
+            cursor.close()
         return result[0] if result else None
     except psycopg2.Error as e:
         print(f"Database error: {e}")
         return None
 
 
+@cached_query
 def get_product_subscription(user_id) -> list:
     """Returns all product ids for a user"""
     try:
-        conn = get_connection()
-        cursor = get_cursor(conn)
-        query = "SELECT product_id FROM subscription WHERE user_id = %s"
-        cursor.execute(query, (user_id,))
-        result = cursor.fetchall()
+        with pooled_connection() as conn:
+            cursor = get_cursor(conn)
+            query = "SELECT product_id FROM subscription WHERE user_id = %s"
+            cursor.execute(query, (user_id,))
+            result = cursor.fetchall()
+            cursor.close()
         return result if result else None
     except psycopg2.Error as e:
         print(f"Database error: {e}")
         return None
 
 
-def get_product_info(product_id) -> tuple:
-    """Returns all product info"""
-    conn = get_connection()
-    cursor = get_cursor(conn)
+@cached_query
+def get_product_cards(user_id) -> list:
+    """Returns (product_id, product_name, image_url, latest price) for every
+    product a user tracks"""
     try:
-        query = """SELECT product_name, url,
-        original_price, product_description,
-        image_url FROM product WHERE product_id = %s"""
-        cursor.execute(query, (product_id,))
-        return cursor.fetchone()
-    except Exception as e:
-        st.error(f"Error getting the latest price: {e}")
+        with pooled_connection() as conn:
+            cursor = get_cursor(conn)
+            query = """SELECT p.product_id, p.product_name, p.image_url, lp.price
+            FROM subscription AS s
+            JOIN product AS p ON p.product_id = s.product_id
+            LEFT JOIN product_latest_price AS lp ON lp.product_id = p.product_id
+            WHERE s.user_id = %s
+            ORDER BY s.subscription_id"""
+            cursor.execute(query, (user_id,))
+            result = cursor.fetchall()
+            cursor.close()
+        return result
+    except psycopg2.Error as e:
+        print(f"Database error: {e}")
         return None
 
 
+@cached_query
+def get_product_info(product_id) -> tuple:
+    """Returns all product info"""
+    with pooled_connection() as conn:
+        cursor = get_cursor(conn)
+        try:
+            query = """SELECT product_name, url,
+            original_price, product_description,
+            image_url FROM product WHERE product_id = %s"""
+            cursor.execute(query, (product_id,))
+            return cursor.fetchone()
+        except Exception as e:
+            st.error(f"Error getting the latest price: {e}")
+            return None
+        finally:
+            cursor.close()
+
+
+@cached_query
 def get_latest_price(product_id) -> float:
     """Returns the latest price of a product"""
-    conn = get_connection()
-    cursor = get_cursor(conn)
-    try:
-        query = """SELECT price FROM price_changes WHERE product_id = %s
-        AND timestamp = (SELECT MAX(timestamp) FROM price_changes WHERE product_id = %s)"""
-        cursor.execute(query, (product_id, product_id,))
-        return cursor.fetchone()[0]
-    except Exception as e:
-        st.error(f"Error getting the latest price: {e}")
-        return None
+    with pooled_connection() as conn:
+        cursor = get_cursor(conn)
+        try:
+            query = """SELECT price FROM product_latest_price WHERE product_id = %s"""
+            cursor.execute(query, (product_id,))
+            return cursor.fetchone()[0]
+        except Exception as e:
+            st.error(f"Error getting the latest price: {e}")
+            return None
+        finally:
+            cursor.close()
 
 
 def stop_tracking_product(user_id, product_id):
     """Unsubscribes user from a product"""
-    conn = get_connection()
-    cursor = get_cursor(conn)
-    try:
-        cursor.execute(
-            """DELETE FROM subscription WHERE user_id = %s AND product_id = %s""", (user_id, product_id,))
-        cursor.close()
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        st.error(f"Error unsubscribing from product tracking: {e}")
+    with pooled_connection() as conn:
+        cursor = get_cursor(conn)
+        try:
+            cursor.execute(
+                """DELETE FROM subscription WHERE user_id = %s AND product_id = %s""",
+                (user_id, product_id,))
+            cursor.close()
+            conn.commit()
+            invalidate(get_product_cards, user_id)
+            invalidate(get_product_subscription, user_id)
+        except Exception as e:
+            st.error(f"Error unsubscribing from product tracking: {e}")
 
 
 def create_account(first_name, last_name, new_email, new_password) -> bool:
     """Adds new user data to database"""
-    conn = get_connection()
-    cursor = get_cursor(conn)
-    try:
-        query = """INSERT INTO users (first_name, last_name, email_address, password)
-        VALUES (%s, %s, %s, %s);"""
-        cursor.execute(query, (first_name, last_name, new_email, new_password))
-        cursor.close()
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        st.error(f"Error inserting into the database (users): {e}")
-        return False
-
-
-def insert_into_website(website: str) -> int:
-    """Inserts new websites into the website table and returns the corresponding website id"""
-    try:
-        conn = get_connection()
+    with pooled_connection() as conn:
         cursor = get_cursor(conn)
-        if get_website_id(website):
-            return get_website_id(website)
-        cursor.execute(
-            "INSERT INTO website (website_name) VALUES (%s);", (website,))
-        cursor.close()
-        conn.commit()
-        conn.close()
-        return get_website_id(website)
-    except Exception as e:
-        st.error(f"Error inserting into the database (website): {e}")
-        return None
-
-
-def insert_into_product(website_id: int, url: str) -> int:
-    """Inserts new products into the product table and returns the corresponding product id"""
-    product_info = scrape_pricing_process(get_html_from_url(url), url)
-    try:
-        conn = get_connection()
+        try:
+            query = """INSERT INTO users (first_name, last_name, email_address, password)
+            VALUES (%s, %s, %s, %s);"""
+            cursor.execute(query, (first_name, last_name, new_email, new_password))
+            cursor.close()
+            conn.commit()
+            invalidate(get_user_id, new_email)
+            return True
+        except Exception as e:
+            st.error(f"Error inserting into the database (users): {e}")
+            return False
+
+
+def enqueue_onboarding_job(user_id, url, notification_price) -> int:
+    """Queues a product for the onboarding worker to scrape and start tracking.
+    Returns the job id"""
+    with pooled_connection() as conn:
         cursor = get_cursor(conn)
-        if get_product_id(url):
-            return get_product_id(url)
-        cursor.execute(
-            """INSERT INTO product (product_name, url, website_id, original_price, image_url, product_description) VALUES (%s, %s, %s, %s, %s, %s);""",
-            (product_info.get("product_name"), url, website_id,
-             clean_price(product_info.get("original_price")), product_info.get("image_url"), product_info.get("product_description"),))
-        cursor.close()
-        conn.commit()
-        conn.close()
-        return get_product_id(url)
-    except Exception as e:
-        st.error(f"Error inserting into the database (product): {e}")
-        return None
+        try:
+            cursor.execute(
+                """INSERT INTO onboarding_job (user_id, url, notification_price) VALUES (%s, %s, %s)
+                RETURNING job_id;""", (user_id, url, notification_price))
+            job_id = cursor.fetchone()[0]
+            cursor.close()
+            conn.commit()
+            return job_id
+        except Exception as e:
+            st.error(f"Error queueing the product for tracking: {e}")
+            return None
 
 
-def insert_into_subscription(user_id, product_id, notification_price):
-    """Inserts new subscriptions into the subscription table and returns the corresponding product id"""
+def get_onboarding_jobs(job_ids) -> list:
+    """Returns (job_id, url, status, error, product_id) for each of the given jobs"""
     try:
-        conn = get_connection()
-        cursor = get_cursor(conn)
-        if get_subscription_id(user_id, product_id):
-            return get_subscription_id(user_id, product_id)
-        cursor.execute(
-            """INSERT INTO subscription (user_id, product_id, notification_price) VALUES (%s, %s, %s);""",
-            (user_id, product_id, notification_price,))
-        cursor.close()
-        conn.commit()
-        conn.close()
-        return get_subscription_id(user_id, product_id)
-    except Exception as e:
-        st.error(f"Error inserting into the database (subscription): {e}")
+        with pooled_connection() as conn:
+            cursor = get_cursor(conn)
+            cursor.execute(
+                """SELECT job_id, url, status, error, product_id
+                FROM onboarding_job WHERE job_id = ANY(%s) ORDER BY job_id""", (list(job_ids),))
+            result = cursor.fetchall()
+            cursor.close()
+        return result
+    except psycopg2.Error as e:
+        print(f"Database error: {e}")
         return None
 
 
-def insert_initial_price(price, product_id) -> None:
-    """Inserts initial price data into the price_changes table"""
-    conn = get_connection()
-    cursor = get_cursor(conn)
-    try:
+def upsert_tracked_product(cursor, user_id, url, website, product_info, notification_price) -> int:
+    """Starts tracking a product for a user from its scraped page. The website, product,
+    subscription and current price are upserted on the caller's transaction, so the
+    caller commits them together and tracking an existing product again just updates
+    the notification price. Returns the product id"""
+    cursor.execute(
+        """INSERT INTO website (website_name) VALUES (%s)
+        ON CONFLICT (website_name) DO UPDATE SET website_name = EXCLUDED.website_name
+        RETURNING website_id;""", (website,))
+    website_id = cursor.fetchone()[0]
+    cursor.execute(
+        """INSERT INTO product (product_name, url, website_id, original_price,
+            image_url, product_description)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (url) DO UPDATE SET url = EXCLUDED.url
+        RETURNING product_id;""",
+        (product_info.get("product_name"), url, website_id,
+         clean_price(product_info.get("original_price")), product_info.get("image_url"),
+         product_info.get("product_description"),))
+    product_id = cursor.fetchone()[0]
+    cursor.execute(
+        """INSERT INTO subscription (user_id, product_id, notification_price) VALUES (%s, %s, %s)
+        ON CONFLICT (user_id, product_id) DO UPDATE
+        SET notification_price = EXCLUDED.notification_price;""",
+        (user_id, product_id, notification_price,))
+    price = clean_price(product_info.get("discount_price"))
+    if price:
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         cursor.execute(
             """INSERT INTO price_changes (price, product_id, timestamp) VALUES (%s, %s, %s);""",
-            (price, product_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        cursor.close()
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        st.error(f"Error inserting into the database (price_changes): {e}")
+            (price, product_id, timestamp))
+        cursor.execute(
+            """INSERT INTO product_latest_price (product_id, price, timestamp) VALUES (%s, %s, %s)
+            ON CONFLICT (product_id) DO UPDATE
+            SET price = EXCLUDED.price, timestamp = EXCLUDED.timestamp
+            WHERE EXCLUDED.timestamp >= product_latest_price.timestamp;""",
+            (product_id, price, timestamp))
+    return product_id
 
 
 if __name__ == "__main__":
-    print(get_connection())
+    with pooled_connection() as connection:
+        print(connection)
+    print(get_pool_stats())
@@ -0,0 +1,154 @@
+"""Background worker that onboards the products users ask to track.
+
+The dashboard only queues a job in onboarding_job, so a slow retailer never
+holds up a session. This worker claims up to ONBOARDING_BATCH_SIZE queued jobs
+at a time with FOR UPDATE SKIP LOCKED (so several workers can share the queue),
+fetches their pages ONBOARDING_FETCH_THREADS at a time, and inserts each product
+in the same transaction that marks its job done. Jobs left running by a worker
+that died are retried after ONBOARDING_STALE_SECONDS, and a job that keeps
+failing is given up on after ONBOARDING_MAX_ATTEMPTS tries.
+Run it with: python onboarding_worker.py"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import time
+from dotenv import load_dotenv
+from dashboard_etl import get_html_from_url, scrape_pricing_process
+from database_connection import pooled_connection, get_cursor, upsert_tracked_product
+from scrapers import get_website_from_url
+
+CLAIM_QUERY = """UPDATE onboarding_job
+    SET status = 'running', attempts = attempts + 1, updated_at = NOW()
+    WHERE job_id IN (
+        SELECT job_id FROM onboarding_job
+        WHERE status = 'queued'
+        OR (status = 'running' AND updated_at < NOW() - make_interval(secs => %s))
+        ORDER BY job_id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED)
+    RETURNING job_id, user_id, url, notification_price, attempts;"""
+
+FINISH_QUERY = """UPDATE onboarding_job
+    SET status = %s, error = %s, product_id = %s, updated_at = NOW()
+    WHERE job_id = %s;"""
+
+CLEANUP_INTERVAL_SECONDS = 3600
+
+DELETE_OLD_JOBS_QUERY = """DELETE FROM onboarding_job
+    WHERE status IN ('done', 'failed')
+    AND updated_at < NOW() - make_interval(hours => %s);"""
+
+
+def claim_jobs(limit: int, stale_seconds: float) -> list:
+    """Marks up to limit queued (or stale running) jobs as running and returns them
+    as (job_id, user_id, url, notification_price, attempts)"""
+    with pooled_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute(CLAIM_QUERY, (stale_seconds, limit))
+        jobs = cursor.fetchall()
+        cursor.close()
+        conn.commit()
+    return jobs
+
+
+def finish_job(job_id, status, error=None, product_id=None) -> None:
+    """Records how a job ended"""
+    with pooled_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute(FINISH_QUERY, (status, error, product_id, job_id))
+        cursor.close()
+        conn.commit()
+
+
+def retry_or_fail(job_id, attempts, max_attempts, error) -> None:
+    """Queues a job that hit a passing error again, or fails it once it has had
+    max_attempts tries"""
+    if attempts < max_attempts:
+        finish_job(job_id, "queued", error)
+    else:
+        finish_job(job_id, "failed", error)
+
+
+def scrape_product(url: str) -> dict:
+    """Fetches and scrapes a product page once"""
+    return scrape_pricing_process(get_html_from_url(url), url)
+
+
+def onboard_job(job, product_info, max_attempts) -> None:
+    """Inserts a scraped product and marks its job done in one transaction"""
+    job_id, user_id, url, notification_price, attempts = job
+    if not product_info:
+        finish_job(job_id, "failed", "Cannot fetch data from that link.")
+        return
+    try:
+        with pooled_connection() as conn:
+            cursor = get_cursor(conn)
+            try:
+                product_id = upsert_tracked_product(
+                    cursor, user_id, url, get_website_from_url(url), product_info,
+                    notification_price)
+                cursor.execute(FINISH_QUERY, ("done", None, product_id, job_id))
+                cursor.close()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    except Exception as e:
+        print(f"Error onboarding job {job_id}: {e}")
+        retry_or_fail(job_id, attempts, max_attempts, str(e)[:500])
+
+
+def process_jobs(jobs: list, executor: ThreadPoolExecutor, max_attempts: int) -> None:
+    """Scrapes a batch of jobs concurrently and onboards each as its page arrives"""
+    futures = {executor.submit(scrape_product, job[2]): job for job in jobs}
+    for future in as_completed(futures):
+        job = futures[future]
+        try:
+            product_info = future.result()
+        except Exception as e:
+            print(f"Error scraping job {job[0]}: {e}")
+            retry_or_fail(job[0], job[4], max_attempts, str(e)[:500])
+            continue
+        onboard_job(job, product_info, max_attempts)
+
+
+def delete_old_jobs(retention_hours: float) -> None:
+    """Deletes finished jobs older than retention_hours"""
+    with pooled_connection() as conn:
+        cursor = get_cursor(conn)
+        cursor.execute(DELETE_OLD_JOBS_QUERY, (retention_hours,))
+        cursor.close()
+        conn.commit()
+
+
+def run_worker(max_batches: int = None) -> None:
+    """Claims and processes batches of jobs, sleeping ONBOARDING_POLL_SECONDS when the
+    queue is empty. Stops after max_batches claims if given"""
+    batch_size = int(os.environ.get("ONBOARDING_BATCH_SIZE", 20))
+    poll_seconds = float(os.environ.get("ONBOARDING_POLL_SECONDS", 1))
+    stale_seconds = float(os.environ.get("ONBOARDING_STALE_SECONDS", 120))
+    max_attempts = int(os.environ.get("ONBOARDING_MAX_ATTEMPTS", 3))
+    retention_hours = float(os.environ.get("ONBOARDING_JOB_RETENTION_HOURS", 24))
+
+    batches = 0
+    last_cleanup = None
+    with ThreadPoolExecutor(int(os.environ.get("ONBOARDING_FETCH_THREADS", 8))) as executor:
+        while max_batches is None or batches < max_batches:
+            batches += 1
+            try:
+                jobs = claim_jobs(batch_size, stale_seconds)
+                if jobs:
+                    process_jobs(jobs, executor, max_attempts)
+                    continue
+                if last_cleanup is None \
+                        or time.monotonic() - last_cleanup > CLEANUP_INTERVAL_SECONDS:
+                    delete_old_jobs(retention_hours)
+                    last_cleanup = time.monotonic()
+            except Exception as e:
+                print(f"Onboarding worker error: {e}")
+            time.sleep(poll_seconds)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    run_worker()
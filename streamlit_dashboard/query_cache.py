@@ -0,0 +1,86 @@
+"""Process-wide cache of read query results, shared by every dashboard session.
+Entries expire after QUERY_CACHE_TTL seconds (the ETL runs every 3 minutes, so
+prices are never more than one run staler than they would be anyway), the least
+recently used entries are dropped beyond QUERY_CACHE_SIZE, and writes invalidate
+the entries they make stale."""
+
+from collections import OrderedDict
+from functools import wraps
+import os
+import threading
+from time import monotonic
+
+CACHE = OrderedDict()
+CACHE_LOCK = threading.Lock()
+CACHE_STATS = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0,
+               "invalidations": 0}
+
+
+def get_ttl() -> float:
+    """Returns how many seconds a result is kept"""
+    return float(os.environ.get("QUERY_CACHE_TTL", 180))
+
+
+def get_max_entries() -> int:
+    """Returns how many results are kept at most"""
+    return int(os.environ.get("QUERY_CACHE_SIZE", 1024))
+
+
+def cached_query(function):
+    """Caches a read helper's results by its name and arguments.
+    None results are not cached, so errors and missing rows are retried"""
+    @wraps(function)
+    def wrapper(*args):
+        key = (function.__name__, args)
+        now = monotonic()
+        with CACHE_LOCK:
+            entry = CACHE.get(key)
+            if entry and entry[0] > now:
+                CACHE.move_to_end(key)
+                CACHE_STATS["hits"] += 1
+                return entry[1]
+            if entry:
+                del CACHE[key]
+                CACHE_STATS["expired"] += 1
+            CACHE_STATS["misses"] += 1
+
+        result = function(*args)
+        if result is None:
+            return result
+
+        with CACHE_LOCK:
+            CACHE[key] = (monotonic() + get_ttl(), result)
+            CACHE.move_to_end(key)
+            while len(CACHE) > get_max_entries():
+                CACHE.popitem(last=False)
+                CACHE_STATS["evictions"] += 1
+        return result
+
+    return wrapper
+
+
+def invalidate(function, *args) -> None:
+    """Drops the cached results of function whose arguments start with args,
+    or all of its results if no args are given"""
+    with CACHE_LOCK:
+        keys = [key for key in CACHE
+                if key[0] == function.__name__ and key[1][:len(args)] == args]
+        for key in keys:
+            del CACHE[key]
+        CACHE_STATS["invalidations"] += len(keys)
+
+
+def clear_cache() -> None:
+    """Empties the cache and resets its counters"""
+    with CACHE_LOCK:
+        CACHE.clear()
+        for stat in CACHE_STATS:
+            CACHE_STATS[stat] = 0
+
+
+def get_cache_stats() -> dict:
+    """Returns the cache's counters, size and hit rate"""
+    with CACHE_LOCK:
+        lookups = CACHE_STATS["hits"] + CACHE_STATS["misses"]
+        return {**CACHE_STATS, "entries": len(CACHE),
+                "hit_rate": round(CACHE_STATS["hits"] / lookups, 3) if lookups else 0.0}
@@ -7,17 +7,30 @@ import pandas as pd
 from datetime import datetime, timedelta
 import altair as alt
 from bs4 import BeautifulSoup
+import requests
+from host_guard import reset_hosts
+from query_cache import clear_cache
+from dashboard_etl import scrape_pricing_process, get_html_from_url
+from scrapers import get_website_from_url
 from dashboard import (
-    get_html_from_url,
-    get_website_from_url,
-    display_charts, login, track_product, login_clicked
+    display_charts, login, track_product, login_clicked, get_price_steps,
+    get_bucket_seconds, get_price_history, get_product_cards, get_latest_price,
+    show_current_products_page, show_onboarding_jobs, track_clicked
 )
 
 
+@pytest.fixture(autouse=True)
+def empty_query_cache():
+    """Stops cached query results leaking between tests."""
+    clear_cache()
+    yield
+    clear_cache()
+
+
 @pytest.fixture
 def mock_db_connection():
     """Mocking the connection and cursor."""
-    with patch('dashboard.get_connection') as mock_conn:
+    with patch('database_connection.get_connection') as mock_conn:
         with patch('dashboard.get_cursor') as mock_cursor:
             conn = MagicMock()
             cursor = MagicMock()
@@ -55,6 +68,33 @@ def test_get_website_from_url_invalid():
         test_website) == "https://test.testing/invalid"
 
 
+@patch('dashboard_etl.requests.get')
+def test_get_html_from_url_stops_at_open_circuit(mock_get, monkeypatch):
+    """Onboarding fetches share the pipeline's per-host circuit breaker"""
+    monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "1")
+    monkeypatch.setenv("FETCH_MAX_ATTEMPTS", "1")
+    reset_hosts()
+    mock_get.side_effect = requests.exceptions.ConnectionError
+
+    assert get_html_from_url("https://www.debenhams.com/a") == "Cannot connect to that URL."
+    assert get_html_from_url("https://www.debenhams.com/b") == "Cannot connect to that URL."
+    assert mock_get.call_count == 1
+    reset_hosts()
+
+
+def test_scrape_pricing_process_full_metadata():
+    """The dashboard asks the shared scrapers for the image and description too"""
+    page = """<div id="game_area_purchase"><div class="discount_original_price">£2</div>
+    <div class="discount_final_price">£1</div></div>
+    <div id="appHubAppName" class="apphub_AppName">Game</div>
+    <img class="game_header_image_full" src="header.jpg">
+    <div class="game_description_snippet">Fun</div>"""
+    assert scrape_pricing_process(page, "https://store.steampowered.com/app/1") == {
+        "original_price": "£2", "discount_price": "£1", "product_name": "Game",
+        "image_url": "header.jpg", "product_description": "Fun",
+        "website": "https://store.steampowered.com"}
+
+
 @patch('dashboard.st')
 def test_display_charts_no_product_id(mock_st):
     """Returns None if there is an empty product_id"""
@@ -113,6 +153,7 @@ def test_display_charts_valid_product_id_30_mins(mock_db_function, mock_st):
 def test_empty_filtered_df(mock_db_function, mock_st):
     """Test when the filtered DataFrame is empty."""
     mock_db_function.return_value = [
+        (10.99, pd.Timestamp.now(tz='UTC') + timedelta(days=1))
     ]
 
     mock_st.selectbox.return_value = "Last 24 Hours"
@@ -126,6 +167,20 @@ def test_empty_filtered_df(mock_db_function, mock_st):
     assert result == None
 
 
+@patch('dashboard.st')
+@patch('dashboard.execute_database_select_query_fetchall', return_value=None)
+def test_display_charts_no_price_data(mock_db_function, mock_st):
+    """A product without prices is warned about by the chart, not the cached query."""
+    mock_st.selectbox.return_value = "Last 24 Hours"
+
+    assert display_charts(1) == None
+    display_charts(1)
+
+    assert mock_db_function.call_count == 2
+    assert mock_st.warning.call_args_list == [
+        (("No price data available for Product ID 1.",),)] * 2
+
+
 def test_login_successful(mock_db_connection):
     """Tests successful connection with correct login credentials."""
     mock_db_connection.fetchone.return_value = [True]
@@ -161,3 +216,137 @@ def test_login_failed_incorrect_username(mock_db_connection):
     result = login('incorrectusername', 'password123')
 
     assert result == False
+
+
+def test_get_price_steps_carries_prices_across_window():
+    """The price before the window starts it, and the last price runs to the end."""
+    df = pd.DataFrame({
+        'Price': [10.0, 12.0, 11.0],
+        'Date': pd.to_datetime(['2024-12-01T10:00:00Z', '2024-12-04T10:00:00Z',
+                                '2024-12-04T11:00:00Z'], utc=True)})
+    start = pd.Timestamp('2024-12-04T09:00:00Z')
+    end = pd.Timestamp('2024-12-04T12:00:00Z')
+
+    steps = get_price_steps(df, start, end)
+
+    assert steps['Price'].tolist() == [10.0, 12.0, 11.0, 11.0]
+    assert steps['Date'].iloc[0] == start
+    assert steps['Date'].iloc[-1] == end
+
+
+def test_get_price_steps_unchanged_price():
+    """A price that has not changed inside the window is still drawn."""
+    df = pd.DataFrame({'Price': [10.0],
+                       'Date': pd.to_datetime(['2024-12-01T10:00:00Z'], utc=True)})
+    start = pd.Timestamp('2024-12-04T09:00:00Z')
+    end = pd.Timestamp('2024-12-04T12:00:00Z')
+
+    steps = get_price_steps(df, start, end)
+
+    assert steps['Price'].tolist() == [10.0, 10.0]
+    assert steps['Date'].tolist() == [start, end]
+
+
+@patch('dashboard.card')
+@patch('dashboard.st')
+@patch('dashboard.get_user_name', return_value="John")
+@patch('dashboard.get_product_cards')
+def test_show_current_products_page_renders_cards(mock_cards, mock_name, mock_st, mock_card):
+    """Every card is rendered from the one product card query."""
+    mock_st.columns.return_value = [MagicMock(), MagicMock(), MagicMock()]
+    mock_cards.return_value = [(i, f"Product {i}", None, 9.99) for i in range(100)]
+
+    show_current_products_page()
+
+    mock_cards.assert_called_once()
+    assert mock_card.call_count == 100
+    assert mock_card.call_args.kwargs["title"] == "Product 99"
+    assert mock_card.call_args.kwargs["text"] == "£9.99"
+
+
+@patch('dashboard.card')
+@patch('dashboard.st')
+@patch('dashboard.get_user_name', return_value=None)
+@patch('dashboard.get_product_cards', return_value=[])
+def test_show_current_products_page_no_products(mock_cards, mock_name, mock_st, mock_card):
+    """Users tracking nothing are told so."""
+    show_current_products_page()
+
+    mock_card.assert_not_called()
+    mock_st.markdown.assert_called_once_with("You are not currently tracking anything!")
+
+
+@patch('dashboard.st')
+@patch('dashboard.execute_database_select_query_fetchall')
+def test_display_charts_carries_in_latest_price_after_raw_rows_dropped(mock_db_function, mock_st):
+    """A product whose only raw row was dropped is charted from its latest price."""
+    now = pd.Timestamp.now(tz='UTC')
+    mock_db_function.return_value = [(15.0, now - timedelta(days=200))]
+    mock_st.selectbox.return_value = "Last 24 Hours"
+
+    chart = display_charts(1)
+
+    query = mock_db_function.call_args[0][0]
+    assert "FROM product_latest_price" in query
+    assert "FROM price_changes_daily" in query
+    assert list(chart.data['Price']) == [15.0, 15.0]
+
+
+def test_get_bucket_seconds_caps_points():
+    """Every time range is bucketed into at most MAX_CHART_POINTS points."""
+    assert get_bucket_seconds(timedelta(days=3)) == 519
+    assert get_bucket_seconds(timedelta(minutes=30)) == 4
+    with patch.dict('os.environ', {'MAX_CHART_POINTS': '100000'}):
+        assert get_bucket_seconds(timedelta(minutes=30)) == 1
+
+
+@patch('dashboard.st')
+@patch('dashboard.execute_database_select_query_fetchall')
+def test_display_charts_filters_and_buckets_in_sql(mock_db_function, mock_st):
+    """The time range and bucket width are sent to the database."""
+    now = pd.Timestamp.now(tz='UTC')
+    mock_db_function.return_value = [
+        (12.0, now - timedelta(days=4)),
+        (10.0, now - timedelta(days=1)),
+    ]
+    mock_st.selectbox.return_value = "Last 3 Days"
+
+    chart = display_charts(1)
+
+    query, params = mock_db_function.call_args[0][:2]
+    assert "DISTINCT ON" in query
+    assert params == (1, 259200, 1, 259200, 1, 259200, 519, 1, 259200, 519)
+    assert list(chart.data['Price']) == [12.0, 10.0, 10.0]
+
+
+@patch('dashboard.st')
+@patch('dashboard.enqueue_onboarding_job', return_value=12)
+@patch('dashboard_etl.requests.get')
+def test_track_clicked_queues_without_fetching(mock_get, mock_enqueue, mock_st):
+    """Tracking queues a job straight away instead of fetching the page."""
+    mock_st.session_state = {}
+
+    track_clicked(1, "https://www.debenhams.com/a", "5")
+
+    mock_get.assert_not_called()
+    mock_enqueue.assert_called_once_with(1, "https://www.debenhams.com/a", 5.0)
+    assert mock_st.session_state["onboarding_jobs"] == {
+        12: ("https://www.debenhams.com/a", "queued", None)}
+
+
+@patch('dashboard.invalidate')
+@patch('dashboard.st')
+@patch('dashboard.get_onboarding_jobs')
+def test_show_onboarding_jobs_polls_pending_jobs(mock_jobs, mock_st, mock_invalidate):
+    """Only pending jobs are looked up, and finished ones refresh the product caches."""
+    mock_st.session_state = {"user_id": 1, "onboarding_jobs": {
+        11: ("https://a", "done", None), 12: ("https://b", "queued", None)}}
+    mock_jobs.return_value = [(12, "https://b", "done", None, 7)]
+
+    show_onboarding_jobs.__wrapped__()
+
+    mock_jobs.assert_called_once_with([12])
+    assert [c.args for c in mock_invalidate.call_args_list] == [
+        (get_product_cards, 1), (get_latest_price, 7), (get_price_history, 7)]
+    assert [c.kwargs["state"] for c in mock_st.status.call_args_list] == [
+        "complete", "complete"]
@@ -1,15 +1,48 @@
 # pylint: skip-file
-from unittest.mock import patch, MagicMock
+from unittest.mock import ANY, patch, MagicMock
+import threading
+import pytest
 import psycopg2
+import database_connection
+from query_cache import clear_cache
 from database_connection import (get_connection, get_cursor,
+                                 release_connection, pooled_connection,
+                                 get_connection_pool, get_pool_stats,
                                  execute_database_select_query_fetchall,
                                  execute_database_select_query_fetchone,
                                  get_website_id, get_user_id, get_product_id,
                                  get_subscription_id, get_product_subscription,
-                                 get_product_info, get_latest_price,
+                                 get_product_info, get_latest_price, get_product_cards,
                                  stop_tracking_product, create_account,
-                                 insert_into_website, insert_into_product,
-                                 insert_into_subscription, insert_initial_price)
+                                 upsert_tracked_product, enqueue_onboarding_job,
+                                 get_onboarding_jobs)
+
+DB_ENV = {
+    "DB_USER": "test_user",
+    "DB_PASSWORD": "test_password",
+    "DB_HOST": "localhost",
+    "DB_PORT": "5432",
+    "DB_NAME": "test_db"
+}
+
+
+@pytest.fixture(autouse=True)
+def fresh_pool():
+    """Gives every test its own connection pool and counters."""
+    get_connection_pool.clear()
+    clear_cache()
+    database_connection.CHECKED_OUT.clear()
+    for stat in database_connection.POOL_STATS:
+        database_connection.POOL_STATS[stat] = 0
+    yield
+    get_connection_pool.clear()
+
+
+@pytest.fixture
+def fake_connect():
+    """Makes the pool open fake connections."""
+    with patch('psycopg2.connect', side_effect=lambda *args, **kwargs: MagicMock(closed=0)) as mock_connect:
+        yield mock_connect
 
 
 @patch("database_connection.os.environ", {
@@ -76,7 +109,7 @@ def test_execute_select_query_fetchall_valid():
             mock_cursor.fetchall.return_value = [(1, 'test')]
 
             result = execute_database_select_query_fetchall(
-                "SELECT * FROM test", ('test',), "Error message")
+                "SELECT * FROM test", ('test',))
             assert result == [(1, 'test')]
 
 
@@ -91,7 +124,7 @@ def test_execute_select_query_fetchall_no_results():
             mock_cursor.fetchall.return_value = []
 
             result = execute_database_select_query_fetchall(
-                "SELECT * FROM test", ('test',), "Error message")
+                "SELECT * FROM test", ('test',))
             assert result == None
 
 
@@ -196,50 +229,6 @@ def test_get_website_id_valid():
             assert result == 1
 
 
-def test_insert_into_website_valid():
-    """Returns new website ID inserted."""
-    with patch('database_connection.get_connection') as mock_get_conn:
-        with patch('database_connection.get_cursor') as mock_get_cursor:
-            with patch('database_connection.get_website_id') as mock_get_website_id:
-                mock_connection = MagicMock()
-                mock_cursor = MagicMock()
-                mock_get_conn.return_value = mock_connection
-                mock_get_cursor.return_value = mock_cursor
-                mock_get_website_id.side_effect = [None, 1]
-
-                result = insert_into_website("test_website")
-                assert result == 1
-
-
-def test_insert_initial_price_valid():
-    """Returns successful insertion of initial price."""
-    with patch('database_connection.get_connection') as mock_get_conn:
-        with patch('database_connection.get_cursor') as mock_get_cursor:
-            mock_connection = MagicMock()
-            mock_cursor = MagicMock()
-            mock_get_conn.return_value = mock_connection
-            mock_get_cursor.return_value = mock_cursor
-
-            insert_initial_price(10.99, 1)
-            mock_cursor.execute.assert_called_once()
-            mock_connection.commit.assert_called_once()
-
-
-def test_insert_into_subscription_new_valid():
-    """Tests successful insertion of new subscriptions after none."""
-    with patch('database_connection.get_connection') as mock_get_conn:
-        with patch('database_connection.get_cursor') as mock_get_cursor:
-            with patch('database_connection.get_subscription_id') as mock_get_sub_id:
-                mock_connection = MagicMock()
-                mock_cursor = MagicMock()
-                mock_get_conn.return_value = mock_connection
-                mock_get_cursor.return_value = mock_cursor
-                mock_get_sub_id.side_effect = [None, 1]
-
-                result = insert_into_subscription(1, 1, 10.99)
-                assert result == 1
-
-
 def test_get_user_id_valid():
     """Returns correct user ID."""
     with patch('database_connection.get_connection') as mock_get_conn:
@@ -380,85 +369,216 @@ def test_get_subscription_id_error():
             assert result == None
 
 
-def test_insert_into_website_invalid():
-    """Returns None when there is an error inserting into website"""
-    with patch('database_connection.get_connection') as mock_get_conn:
-        with patch('database_connection.get_cursor') as mock_get_cursor:
-            with patch('database_connection.get_website_id') as mock_get_website_id:
-                mock_connection = MagicMock()
-                mock_cursor = MagicMock()
-                mock_get_conn.return_value = mock_connection
-                mock_get_cursor.return_value = mock_cursor
-                mock_get_website_id.return_value = None
-                mock_cursor.execute.side_effect = Exception("Insert failed")
-
-                result = insert_into_website("test_website")
-                assert result == None
-
-
-@patch('database_connection.scrape_pricing_process')
-@patch('database_connection.get_html_from_url')
-def test_insert_into_product_new_valid(mock_get_html, mock_scrape):
-    """Tests returns new product ID after a None result beforehand"""
-    mock_get_html.return_value = "<html>test</html>"
-    mock_scrape.return_value = {
-        "game_title": "Test Game",
-        "original_price": "10.99",
-        "image_url": "test.jpg",
-        "product_description": "Test description"
-    }
-
+def test_get_subscription_id_invalid():
+    """Tests returns None when no subscriptions are found."""
     with patch('database_connection.get_connection') as mock_get_conn:
         with patch('database_connection.get_cursor') as mock_get_cursor:
-            with patch('database_connection.get_product_id') as mock_get_product_id:
-                mock_connection = MagicMock()
-                mock_cursor = MagicMock()
-                mock_get_conn.return_value = mock_connection
-                mock_get_cursor.return_value = mock_cursor
-                mock_get_product_id.side_effect = [None, 1]
+            mock_connection = MagicMock()
+            mock_cursor = MagicMock()
+            mock_get_conn.return_value = mock_connection
+            mock_get_cursor.return_value = mock_cursor
+            mock_cursor.fetchone.return_value = None
 
-                result = insert_into_product(1, "test_url")
-                assert result == 1
+            result = get_subscription_id(1, 1)
+            assert result == None
 
 
-def test_insert_initial_price_error():
-    """Tests failure inserting initial price when error occurs."""
+def test_get_product_subscription_invalid():
+    """Should return a None on database error."""
     with patch('database_connection.get_connection') as mock_get_conn:
         with patch('database_connection.get_cursor') as mock_get_cursor:
             mock_connection = MagicMock()
             mock_cursor = MagicMock()
             mock_get_conn.return_value = mock_connection
             mock_get_cursor.return_value = mock_cursor
-            mock_cursor.execute.side_effect = Exception("Insert failed")
+            mock_cursor.execute.side_effect = psycopg2.Error("Database error")
+
+            result = get_product_subscription(1)
+            assert result == None
 
-            insert_initial_price(10.99, 1)
 
 
-def test_get_subscription_id_invalid():
-    """Tests returns None when no subscriptions are found."""
+
+@patch("database_connection.os.environ", {**DB_ENV, "DB_POOL_MAX_CONNECTIONS": "2"})
+def test_pooled_connection_reuses_connections(fake_connect):
+    """Connections go back to the pool and are handed out again."""
+    for _ in range(5):
+        with pooled_connection() as conn:
+            assert conn is not None
+
+    assert fake_connect.call_count == 1
+    stats = get_pool_stats()
+    assert stats["checkouts"] == 5
+    assert stats["returns"] == 5
+    assert stats["in_use"] == 0
+    assert stats["idle"] == 1
+
+
+@patch("database_connection.os.environ", {**DB_ENV, "DB_POOL_MAX_CONNECTIONS": "2"})
+def test_pooled_connection_returned_on_error(fake_connect):
+    """A connection is returned even when the block raises."""
+    with pytest.raises(ValueError):
+        with pooled_connection():
+            raise ValueError("Query failed")
+
+    assert get_pool_stats()["in_use"] == 0
+
+
+@patch("database_connection.os.environ", {**DB_ENV, "DB_POOL_MAX_CONNECTIONS": "2"})
+def test_pooled_connection_discards_broken_connections(fake_connect):
+    """A connection that lost the server is closed rather than reused."""
+    with pytest.raises(psycopg2.OperationalError):
+        with pooled_connection() as conn:
+            raise psycopg2.OperationalError("server closed the connection")
+
+    conn.close.assert_called_once()
+    assert get_pool_stats()["idle"] == 0
+    assert get_pool_stats()["discarded"] == 1
+
+
+@patch("database_connection.os.environ", {**DB_ENV, "DB_POOL_MAX_CONNECTIONS": "1",
+                                          "DB_POOL_TIMEOUT": "0.05"})
+def test_get_connection_times_out_when_pool_exhausted(fake_connect):
+    """Checkouts wait for a free connection, then give up."""
+    held = get_connection()
+
+    assert get_connection() is None
+
+    release_connection(held)
+    assert get_connection() is held
+
+
+@patch("database_connection.os.environ", {**DB_ENV, "DB_POOL_MAX_CONNECTIONS": "1",
+                                          "DB_POOL_TIMEOUT": "5"})
+def test_get_connection_waits_for_a_returned_connection(fake_connect):
+    """A checkout blocked on a full pool gets the next returned connection."""
+    held = get_connection()
+    threading.Timer(0.05, release_connection, args=(held,)).start()
+
+    assert get_connection() is held
+    assert get_pool_stats()["max_wait_seconds"] > 0
+
+
+@patch("database_connection.os.environ", {**DB_ENV, "DB_POOL_LEAK_SECONDS": "0"})
+def test_leaked_connections_are_reported(fake_connect, capsys):
+    """Connections that are never returned are reported once."""
+    get_connection()
+    get_connection()
+    get_connection()
+
+    assert get_pool_stats()["leaks"] == 2
+    assert "without being returned" in capsys.readouterr().out
+
+
+def test_release_connection_closes_unpooled_connections():
+    """Connections that did not come from the pool are simply closed."""
+    conn = MagicMock()
+    release_connection(conn)
+    conn.close.assert_called_once()
+
+
+def test_get_product_cards_single_query():
+    """Returns every card of a user from one query."""
     with patch('database_connection.get_connection') as mock_get_conn:
         with patch('database_connection.get_cursor') as mock_get_cursor:
             mock_connection = MagicMock()
             mock_cursor = MagicMock()
             mock_get_conn.return_value = mock_connection
             mock_get_cursor.return_value = mock_cursor
-            mock_cursor.fetchone.return_value = None
+            cards = [(1, 'Game', 'game.jpg', 9.99), (2, 'Shirt', None, None)]
+            mock_cursor.fetchall.return_value = cards
 
-            result = get_subscription_id(1, 1)
-            assert result == None
+            result = get_product_cards(1)
 
+            assert result == cards
+            mock_cursor.execute.assert_called_once()
+            assert "product_latest_price" in mock_cursor.execute.call_args[0][0]
+            assert mock_get_conn.call_count == 1
 
-def test_get_product_subscription_invalid():
-    """Should return a None on database error."""
+
+def test_get_product_cards_error():
+    """Returns no cards when there is a database error."""
     with patch('database_connection.get_connection') as mock_get_conn:
         with patch('database_connection.get_cursor') as mock_get_cursor:
-            mock_connection = MagicMock()
+            mock_get_conn.return_value = MagicMock()
             mock_cursor = MagicMock()
-            mock_get_conn.return_value = mock_connection
             mock_get_cursor.return_value = mock_cursor
             mock_cursor.execute.side_effect = psycopg2.Error("Database error")
 
-            result = get_product_subscription(1)
-            assert result == None
+            assert get_product_cards(1) is None
+
+
+def test_stop_tracking_product_invalidates_cards():
+    """Unsubscribing drops the user's cached product cards."""
+    with patch('database_connection.get_connection') as mock_get_conn:
+        with patch('database_connection.get_cursor') as mock_get_cursor:
+            mock_get_conn.return_value = MagicMock()
+            mock_cursor = MagicMock()
+            mock_get_cursor.return_value = mock_cursor
+            mock_cursor.fetchall.return_value = [(1, 'Game', None, 9.99)]
+
+            get_product_cards(1)
+            get_product_cards(1)
+            assert mock_cursor.fetchall.call_count == 1
+
+            stop_tracking_product(1, 1)
+            mock_cursor.fetchall.return_value = []
+            assert get_product_cards(1) == []
+
+
+PRODUCT_INFO = {"product_name": "Test Game", "original_price": "£10.99",
+                "discount_price": "£8.99", "image_url": "test.jpg",
+                "product_description": "Test description"}
+
+
+def test_upsert_tracked_product():
+    """Website, product and subscription are upserted and the product id comes from RETURNING."""
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.side_effect = [(3,), (7,)]
+
+    assert upsert_tracked_product(mock_cursor, 1, "https://www.debenhams.com/a",
+                                  "https://www.debenhams.com", PRODUCT_INFO, 5.0) == 7
+
+    statements = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    assert len(statements) == 5
+    assert all("ON CONFLICT" in statement for statement in statements[:3])
+    assert mock_cursor.execute.call_args_list[1].args[1][2] == 3
+    assert mock_cursor.execute.call_args_list[3].args[1] == (8.99, 7, ANY)
+    assert "WHERE EXCLUDED.timestamp >= product_latest_price.timestamp" in statements[4]
+
+
+def test_upsert_tracked_product_without_price():
+    """No price rows are written when the page had no valid price."""
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.side_effect = [(3,), (7,)]
+
+    assert upsert_tracked_product(mock_cursor, 1, "url", "website",
+                                  {**PRODUCT_INFO, "discount_price": ""}, 5.0) == 7
+    assert mock_cursor.execute.call_count == 3
+
+
+@patch("database_connection.os.environ", DB_ENV)
+def test_enqueue_onboarding_job(fake_connect):
+    """Queueing a job commits it and returns its id."""
+    with patch('database_connection.get_cursor') as mock_get_cursor:
+        mock_cursor = MagicMock()
+        mock_cursor.fetchone.return_value = (12,)
+        mock_get_cursor.return_value = mock_cursor
+
+        assert enqueue_onboarding_job(1, "https://www.debenhams.com/a", 5.0) == 12
+
+    assert "INSERT INTO onboarding_job" in mock_cursor.execute.call_args.args[0]
+    mock_get_cursor.call_args.args[0].commit.assert_called_once()
+
+
+@patch("database_connection.os.environ", DB_ENV)
+def test_get_onboarding_jobs(fake_connect):
+    """Jobs are looked up by id in one query."""
+    with patch('database_connection.get_cursor') as mock_get_cursor:
+        mock_cursor = MagicMock()
+        mock_cursor.fetchall.return_value = [(12, "url", "done", None, 7)]
+        mock_get_cursor.return_value = mock_cursor
 
+        assert get_onboarding_jobs({12: None}) == [(12, "url", "done", None, 7)]
 
+    assert mock_cursor.execute.call_args.args[1] == ([12],)
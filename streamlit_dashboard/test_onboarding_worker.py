@@ -0,0 +1,102 @@
+# pylint: skip-file
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock, call
+import time
+import onboarding_worker
+from onboarding_worker import (claim_jobs, retry_or_fail, onboard_job, process_jobs,
+                               run_worker)
+
+JOB = (12, 1, "https://www.debenhams.com/a", 5.0, 1)
+PRODUCT_INFO = {"product_name": "Test", "original_price": "£10.00",
+                "discount_price": "£8.00"}
+
+
+@patch("onboarding_worker.get_cursor")
+@patch("onboarding_worker.pooled_connection")
+def test_claim_jobs_skips_locked_jobs(mock_pooled, mock_get_cursor):
+    """Jobs are claimed with SKIP LOCKED so several workers can share the queue."""
+    mock_cursor = mock_get_cursor.return_value
+    mock_cursor.fetchall.return_value = [JOB]
+
+    assert claim_jobs(20, 120) == [JOB]
+    assert "FOR UPDATE SKIP LOCKED" in mock_cursor.execute.call_args.args[0]
+    assert mock_cursor.execute.call_args.args[1] == (120, 20)
+    mock_pooled.return_value.__enter__.return_value.commit.assert_called_once()
+
+
+@patch("onboarding_worker.finish_job")
+def test_retry_or_fail(mock_finish):
+    """Passing errors are retried until the job runs out of attempts."""
+    retry_or_fail(12, 1, 3, "timeout")
+    retry_or_fail(12, 3, 3, "timeout")
+
+    assert mock_finish.call_args_list == [call(12, "queued", "timeout"),
+                                          call(12, "failed", "timeout")]
+
+
+@patch("onboarding_worker.upsert_tracked_product", return_value=7)
+@patch("onboarding_worker.get_cursor")
+@patch("onboarding_worker.pooled_connection")
+def test_onboard_job_marks_done_in_same_transaction(mock_pooled, mock_get_cursor, mock_upsert):
+    """The product and the job's done status are committed together."""
+    conn = mock_pooled.return_value.__enter__.return_value
+
+    onboard_job(JOB, PRODUCT_INFO, 3)
+
+    assert mock_upsert.call_args.args[0] is mock_get_cursor.return_value
+    assert mock_get_cursor.return_value.execute.call_args.args[1] == ("done", None, 7, 12)
+    conn.commit.assert_called_once()
+
+
+@patch("onboarding_worker.retry_or_fail")
+@patch("onboarding_worker.upsert_tracked_product", side_effect=Exception("deadlock"))
+@patch("onboarding_worker.get_cursor")
+@patch("onboarding_worker.pooled_connection")
+def test_onboard_job_rolls_back_and_retries(mock_pooled, mock_get_cursor, mock_upsert, mock_retry):
+    """A failed insert is rolled back and the job retried."""
+    conn = mock_pooled.return_value.__enter__.return_value
+
+    onboard_job(JOB, PRODUCT_INFO, 3)
+
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
+    mock_retry.assert_called_once_with(12, 1, 3, "deadlock")
+
+
+@patch("onboarding_worker.finish_job")
+def test_onboard_job_unscrapable_page_fails(mock_finish):
+    """A page that cannot be scraped fails the job straight away."""
+    onboard_job(JOB, None, 3)
+
+    mock_finish.assert_called_once_with(12, "failed", "Cannot fetch data from that link.")
+
+
+@patch("onboarding_worker.onboard_job")
+@patch("onboarding_worker.scrape_product")
+def test_process_jobs_fetches_concurrently(mock_scrape, mock_onboard):
+    """A batch's pages are fetched at the same time, not one after another."""
+    def slow_scrape(url):
+        time.sleep(0.2)
+        return PRODUCT_INFO
+    mock_scrape.side_effect = slow_scrape
+    jobs = [(i, 1, f"https://www.debenhams.com/{i}", 5.0, 1) for i in range(8)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(8) as executor:
+        process_jobs(jobs, executor, 3)
+
+    assert time.perf_counter() - start < 0.8
+    assert sorted(c.args[0][0] for c in mock_onboard.call_args_list) == list(range(8))
+
+
+@patch("onboarding_worker.time.sleep")
+@patch("onboarding_worker.delete_old_jobs")
+@patch("onboarding_worker.process_jobs")
+@patch("onboarding_worker.claim_jobs", side_effect=[[JOB], [], Exception("db down"), []])
+def test_run_worker_survives_errors(mock_claim, mock_process, mock_delete, mock_sleep):
+    """The worker keeps polling through database errors and cleans up old jobs when idle."""
+    run_worker(max_batches=4)
+
+    mock_process.assert_called_once()
+    mock_delete.assert_called_once()
+    assert mock_sleep.call_count == 3
@@ -0,0 +1,102 @@
+"""Unit Tests for query_cache.py."""
+# pylint: skip-file
+from unittest.mock import patch, MagicMock
+import pytest
+from query_cache import cached_query, invalidate, clear_cache, get_cache_stats
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    clear_cache()
+    yield
+    clear_cache()
+
+
+def make_cached(return_value="result"):
+    """Returns a cached function and the mock behind it."""
+    query = MagicMock(return_value=return_value)
+    query.__name__ = "query"
+    return cached_query(query), query
+
+
+def test_repeated_calls_are_served_from_cache():
+    """Only the first call with the same arguments runs the query."""
+    cached, query = make_cached()
+
+    assert cached(1) == "result"
+    assert cached(1) == "result"
+    cached(2)
+
+    assert query.call_count == 2
+    assert get_cache_stats()["hits"] == 1
+    assert get_cache_stats()["hit_rate"] == round(1 / 3, 3)
+
+
+def test_none_results_are_not_cached():
+    """Errors and missing rows are asked for again."""
+    cached, query = make_cached(None)
+
+    cached(1)
+    cached(1)
+
+    assert query.call_count == 2
+
+
+def test_entries_expire_after_ttl():
+    """Results older than QUERY_CACHE_TTL are fetched again."""
+    cached, query = make_cached()
+
+    with patch.dict("os.environ", {"QUERY_CACHE_TTL": "180"}), \
+            patch("query_cache.monotonic", side_effect=[0, 0, 100, 200, 200]):
+        cached(1)
+        cached(1)
+        cached(1)
+
+    assert query.call_count == 2
+    assert get_cache_stats()["expired"] == 1
+
+
+def test_least_recently_used_entries_are_evicted():
+    """The cache never holds more than QUERY_CACHE_SIZE results."""
+    cached, query = make_cached()
+
+    with patch.dict("os.environ", {"QUERY_CACHE_SIZE": "2"}):
+        cached(1)
+        cached(2)
+        cached(1)
+        cached(3)
+        cached(1)
+        cached(2)
+
+    assert query.call_count == 4
+    assert get_cache_stats()["evictions"] == 2
+    assert get_cache_stats()["entries"] == 2
+
+
+def test_invalidate_one_key_or_all():
+    """Invalidation drops the given arguments, or every result of the function."""
+    cached, query = make_cached()
+    cached(1)
+    cached(2)
+
+    invalidate(cached, 1)
+    cached(1)
+    cached(2)
+    assert query.call_count == 3
+
+    invalidate(cached)
+    assert get_cache_stats()["entries"] == 0
+
+
+def test_invalidate_leading_arguments():
+    """Invalidation with leading arguments drops every result that starts with them."""
+    cached, query = make_cached()
+    cached(1, 60)
+    cached(1, 3600)
+    cached(2, 60)
+
+    invalidate(cached, 1)
+
+    assert get_cache_stats()["entries"] == 1
+    cached(2, 60)
+    assert query.call_count == 3
@@ -101,6 +101,45 @@ resource "aws_ecs_task_definition" "c14-price-slash-dashboard-task-def" {
                 }
             }
     },
+    {
+      name         = "c14-price-slash-onboarding-worker"
+      image        = data.aws_ecr_repository.ecr_for_dashboard.repository_url
+      command      = ["python", "onboarding_worker.py"]
+      cpu          = 10
+      memory       = 256
+      essential    = false
+      environment= [
+                {
+                    "name": "DB_NAME",
+                    "value": var.DB_NAME
+                },
+                {
+                    "name": "DB_USER",
+                    "value": var.DB_USER
+                },
+                {
+                    "name": "DB_PASSWORD",
+                    "value": var.DB_PASSWORD
+                },
+                {
+                    "name": "DB_HOST",
+                    "value": var.DB_HOST
+                },
+                {
+                    "name": "DB_PORT",
+                    "value": var.DB_PORT
+                }
+            ]
+            logConfiguration = {
+                logDriver = "awslogs"
+                options = {
+                    "awslogs-create-group"  = "true"
+                    "awslogs-group"         = "/ecs/c14-price-slash-dashboard-task-def"
+                    "awslogs-region"        = "eu-west-2"
+                    "awslogs-stream-prefix" = "onboarding"
+                }
+            }
+    },
   ])
 }
 
@@ -61,6 +61,33 @@ resource "aws_iam_role_policy_attachment" "cloudwatch_logs_full_access" {
 }
 
 
+# Shared storage for the HTTP validator cache, so it outlives each Fargate task
+resource "aws_efs_file_system" "etl_http_cache" {
+  creation_token = "c14-priceslashers-ETL-http-cache"
+  encrypted      = true
+}
+
+resource "aws_security_group" "etl_http_cache_security_group" {
+  name        = "c14-priceslashers-http-cache-sg"
+  description = "Allow NFS traffic from the ETL tasks to the HTTP cache"
+  vpc_id      = var.VPC_ID
+
+  ingress {
+    from_port       = 2049
+    to_port         = 2049
+    protocol        = "tcp"
+    security_groups = [aws_security_group.task_exec_security_group.id]
+  }
+}
+
+resource "aws_efs_mount_target" "etl_http_cache_mount" {
+  for_each        = toset(var.SUBNET_IDS)
+  file_system_id  = aws_efs_file_system.etl_http_cache.id
+  subnet_id       = each.value
+  security_groups = [aws_security_group.etl_http_cache_security_group.id]
+}
+
+
 # Task Definition 
 resource "aws_ecs_task_definition" "etl-task-def" {
   family                   = "c14-priceslashers-ETL-taskdef"
@@ -119,6 +146,20 @@ resource "aws_ecs_task_definition" "etl-task-def" {
         {
           name  = "AWS_SECRET_ACCESS_KEY"
           value = var.SECRET_KEY
+        },
+        {
+          name  = "ETL_SHARD_MODE"
+          value = var.ETL_TASK_COUNT > 1 ? "lease" : "none"
+        },
+        {
+          name  = "HTTP_CACHE_PATH"
+          value = "/mnt/http_cache/priceslashers_http_cache.json"
+        }
+      ]
+      mountPoints = [
+        {
+          sourceVolume  = "http-cache"
+          containerPath = "/mnt/http_cache"
         }
       ]
       logConfiguration = {
@@ -133,6 +174,14 @@ resource "aws_ecs_task_definition" "etl-task-def" {
     }
   ])
 
+  volume {
+    name = "http-cache"
+    efs_volume_configuration {
+      file_system_id     = aws_efs_file_system.etl_http_cache.id
+      transit_encryption = "ENABLED"
+    }
+  }
+
   runtime_platform {
     operating_system_family = "LINUX"
     cpu_architecture        = "X86_64"
@@ -270,7 +319,7 @@ resource "aws_scheduler_schedule" "priceslashers-ETL-scheduler" {
 
     ecs_parameters {
       task_definition_arn = aws_ecs_task_definition.etl-task-def.arn
-      task_count = 1
+      task_count = var.ETL_TASK_COUNT
       launch_type = "FARGATE"
       group = "c14-priceslashers-ETL-task"
 
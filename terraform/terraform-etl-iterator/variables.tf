@@ -60,4 +60,10 @@ variable ACCESS_KEY {
 variable SECRET_KEY {
     type = string
     description = " SECRET_KEY for AWS"
-}
\ No newline at end of file
+}
+
+variable ETL_TASK_COUNT {
+    type = number
+    default = 1
+    description = " Number of ETL tasks started each run; more than one shares the catalogue with leases "
+}
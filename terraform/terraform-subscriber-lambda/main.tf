@@ -73,4 +73,51 @@ resource "aws_lambda_permission" "allow-eventbridge-c14-price-slash-subscription
   function_name = aws_lambda_function.c14-price-slash-subscription-checker.function_name
   principal     = "events.amazonaws.com"
   source_arn    = aws_cloudwatch_event_rule.c14-price-slash-subscription-checker-schedule.arn
-}
\ No newline at end of file
+}
+
+# Lambda Function for the price_changes retention policy
+resource "aws_lambda_function" "c14-price-slash-price-retention" {
+  function_name = "c14-price-slash-price-retention"
+  image_uri     = var.RETENTION_IMAGE_URI
+  role          = aws_iam_role.c14-price-slash-lambda-execution-role.arn
+  package_type  = "Image"
+  timeout       = 900
+  memory_size   = 512
+
+  environment {
+    variables = {
+      DB_HOST     = var.DB_HOST
+      DB_NAME     = var.DB_NAME
+      DB_USER     = var.DB_USER
+      DB_PASSWORD = var.DB_PASSWORD
+      DB_PORT     = var.DB_PORT
+    }
+  }
+
+  image_config {
+    command = ["price_retention.lambda_handler"]
+  }
+}
+
+# EventBridge Rule to trigger the retention Lambda daily, well within the
+# PARTITIONS_AHEAD months of price_changes partitions it creates in advance
+
+resource "aws_cloudwatch_event_rule" "c14-price-slash-price-retention-schedule" {
+  name        = "c14-price-slash-price-retention-schedule"
+  description = "EventBridge rule to trigger the price retention Lambda daily"
+  schedule_expression = "cron(30 1 * * ? *)"
+}
+
+resource "aws_cloudwatch_event_target" "c14-price-slash-price-retention-target" {
+  rule      = aws_cloudwatch_event_rule.c14-price-slash-price-retention-schedule.name
+  target_id = "c14-price-slash-price-retention"
+  arn       = aws_lambda_function.c14-price-slash-price-retention.arn
+}
+
+resource "aws_lambda_permission" "allow-eventbridge-c14-price-slash-price-retention" {
+  statement_id  = "AllowExecutionFromEventBridge"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.c14-price-slash-price-retention.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.c14-price-slash-price-retention-schedule.arn
+}
@@ -21,4 +21,8 @@ variable "DB_PORT" {
 variable "IMAGE_URI" {
     type = string
     description = "The IMAGE URI of the container image to be used for the Lambda Function"
-}
\ No newline at end of file
+}
+variable "RETENTION_IMAGE_URI" {
+    type = string
+    description = "The IMAGE URI of the container image to be used for the price retention Lambda Function"
+}